@@ -1,7 +1,8 @@
 import click
-from typing import Dict
+from typing import Dict, Optional, Tuple
 from kubails.services.service import Service
 from kubails.resources.templates import SERVICES_CONFIG, SERVICE_TEMPLATES
+from kubails.utils.sharding import parse_shard
 
 
 SERVICE_GENERATION_PROMPTS = {
@@ -56,6 +57,17 @@ def generate_service(
     service_service.generate(service_type, title, name, subdomain, extra_config)
 
 
+def validate_shard(context: click.Context, param: click.Parameter, value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Click callback that parses a shard option like '1/4'."""
+    if value is None:
+        return None
+
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 def _build_extra_service_generation_options(service_type: str) -> Dict[str, str]:
     extra_config_options = SERVICES_CONFIG[service_type].extra_config_options
     config_options = {}
@@ -1,10 +1,10 @@
 import click
 import logging
 import sys
-from typing import Tuple
+from typing import Optional, Tuple
 from kubails.commands import helpers
 from kubails.services.config_store import ConfigStore
-from kubails.services.service import Service
+from kubails.services.service import Service, PUSH_STRATEGIES
 from kubails.resources.templates import SERVICE_TEMPLATES
 from kubails.utils.command_helpers import log_command_args_factory
 
@@ -48,42 +48,64 @@ def destroy() -> None:
 @service.command()
 @click.argument("service", nargs=-1)
 @click.option("--tag")
+@click.option("--jobs", "-j", type=int, default=1, help="The number of services to run concurrently.")
+@click.option("--keep-going", is_flag=True, help="Keep running the rest of the services after a failure.")
 @log_command_args
-def lint(service: Tuple[str], tag: str) -> None:
+def lint(service: Tuple[str], tag: str, jobs: int, keep_going: bool) -> None:
     """
     Lint SERVICE.
 
     If SERVICE is not specified, lint all services.
     """
-    if not service_service.lint(list(service), tag):
+    if not service_service.lint(list(service), tag, jobs=jobs, keep_going=keep_going):
         sys.exit(1)
 
 
 @service.command()
 @click.argument("service", nargs=-1)
 @click.option("--tag")
+@click.option("--jobs", "-j", type=int, default=1, help="The number of services to run concurrently.")
+@click.option("--keep-going", is_flag=True, help="Keep running the rest of the services after a failure.")
+@click.option("--no-cache", is_flag=True, help="Run every service, even ones that already passed unchanged.")
 @log_command_args
-def test(service: Tuple[str], tag) -> None:
+def test(service: Tuple[str], tag: str, jobs: int, keep_going: bool, no_cache: bool) -> None:
     """
     Test SERVICE.
 
     If SERVICE is not specified, test all services.
     """
-    if not service_service.test(list(service), tag):
+    if not service_service.test(list(service), tag, jobs=jobs, keep_going=keep_going, use_cache=not no_cache):
         sys.exit(1)
 
 
 @service.command()
 @click.argument("service", nargs=-1)
 @click.option("--tag")
+@click.option("--jobs", "-j", type=int, default=1, help="The number of services to run concurrently.")
+@click.option("--keep-going", is_flag=True, help="Keep running the rest of the services after a failure.")
+@click.option("--no-cache", is_flag=True, help="Run every service, even ones that already passed unchanged.")
+@click.option(
+    "--shard",
+    callback=helpers.validate_shard,
+    help="Only run the i-th of N shards (e.g. '1/4'), split by how long each service has previously taken."
+)
 @log_command_args
-def ci(service: Tuple[str], tag: str) -> None:
+def ci(
+    service: Tuple[str],
+    tag: str,
+    jobs: int,
+    keep_going: bool,
+    no_cache: bool,
+    shard: Optional[Tuple[int, int]]
+) -> None:
     """
     Run CI on SERVICE.
 
     If SERVICE is not specified, run CI on all services.
     """
-    if not service_service.ci(list(service), tag):
+    if not service_service.ci(
+        list(service), tag, jobs=jobs, keep_going=keep_going, use_cache=not no_cache, shard=shard
+    ):
         sys.exit(1)
 
 
@@ -151,14 +173,48 @@ def images():
 @click.argument("service", nargs=-1)
 @click.option("--branch", help="The branch to tag the image with.")
 @click.option("--commit", help="The commit to tag the image with.")
+@click.option("--jobs", "-j", type=int, default=1, help="The number of services to build concurrently.")
+@click.option(
+    "--pull-cache-images/--no-pull-cache-images",
+    default=True,
+    help="Whether to pull cache images before building, or let BuildKit read their inline cache from the registry."
+)
+@click.option(
+    "--skip-unchanged",
+    is_flag=True,
+    help="Tag images with a hash of their build context and skip builds whose hash has already been built."
+)
+@click.option(
+    "--bake",
+    is_flag=True,
+    help="Build every service with a single 'docker buildx bake' and write a build summary (bake-summary.json)."
+)
 @log_command_args
-def build(service: Tuple[str], branch: str, commit: str) -> None:
+def build(
+    service: Tuple[str],
+    branch: str,
+    commit: str,
+    jobs: int,
+    pull_cache_images: bool,
+    skip_unchanged: bool,
+    bake: bool
+) -> None:
     """
     Build the Docker image for SERVICE.
 
     If SERVICE is not specified, build all services' Docker images.
     """
-    if not service_service.build(list(service), branch, commit):
+    result = service_service.build(
+        list(service),
+        branch,
+        commit,
+        jobs=jobs,
+        pull_cache_images=pull_cache_images,
+        skip_unchanged=skip_unchanged,
+        bake=bake
+    )
+
+    if not result:
         sys.exit(1)
 
 
@@ -166,12 +222,35 @@ def build(service: Tuple[str], branch: str, commit: str) -> None:
 @click.argument("service", nargs=-1)
 @click.option("--branch", help="The branch the image was tagged with.")
 @click.option("--commit", help="The commit the image was tagged with.")
+@click.option("--jobs", "-j", type=int, default=1, help="The number of images to push concurrently.")
+@click.option(
+    "--strategy",
+    type=click.Choice(PUSH_STRATEGIES),
+    default=PUSH_STRATEGIES[0],
+    help="'retag' pushes each image once and adds the rest of its tags in the registry."
+)
 @log_command_args
-def push(service: Tuple[str], branch: str, commit: str) -> None:
+def push(service: Tuple[str], branch: str, commit: str, jobs: int, strategy: str) -> None:
     """
     Push the Docker image for SERVICE.
 
     If SERVICE is not specified, push all services' Docker images.
     """
-    if not service_service.push(list(service), branch, commit):
+    if not service_service.push(list(service), branch, commit, jobs=jobs, strategy=strategy):
+        sys.exit(1)
+
+
+@images.command()
+@click.argument("service", nargs=-1)
+@click.option("--branch", help="The branch to tag the images with.")
+@click.option("--commit", help="The commit to tag the images with.")
+@log_command_args
+def promote(service: Tuple[str], branch: str, commit: str) -> None:
+    """
+    Tag the last built image of SERVICE with the given branch and commit.
+
+    If SERVICE is not specified, promote all of the services that were filtered out by --only-changed-services.
+    The images are tagged in the registry; nothing gets pulled or pushed.
+    """
+    if not service_service.promote(list(service), branch, commit):
         sys.exit(1)
@@ -1,16 +1,43 @@
+import json
 import logging
 import os
-from typing import List
-from kubails.utils.service_helpers import call_command
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List  # noqa
+from kubails.utils.dockerfile import parse_dockerfile
+from kubails.utils.service_helpers import call_command, get_command_output, run_concurrently, stream_command
 
 
 logger = logging.getLogger(__name__)
 
+# The name of the buildx builder used for registry cache builds.
+# The default 'docker' driver can't export a registry cache, so a 'docker-container' builder is needed.
+BUILDX_BUILDER = "kubails"
+
+# The maximum number of images to pull at once when pre-pulling.
+# Pulls are mostly limited by bandwidth, so more than a few at a time just makes each one slower.
+PRE_PULL_JOBS = 4
+
+# How many of an image's extra tags are pushed at once (once its first tag has uploaded the layers).
+PUSH_TAGS_JOBS = 4
+
 
 class Docker:
     def __init__(self):
         self.base_command = ["docker"]
 
+        # Every image that has been pulled (or is being pulled) during this invocation,
+        # so that each distinct image only ever gets pulled once.
+        self._pulls = {}  # type: Dict[str, Future]
+        self._pulls_lock = threading.Lock()
+
+        # The registry digests looked up during this invocation, since the same images get checked repeatedly.
+        self._remote_digests = {}  # type: Dict[str, str]
+        self._remote_digests_lock = threading.Lock()
+
+        self._buildx_builder_ready = False
+        self._buildx_builder_lock = threading.Lock()
+
     def build(
         self,
         context: str,
@@ -18,6 +45,8 @@ class Docker:
         target_stage: str = None,
         cache_images: List[str] = [],
         branch: str = None,
+        pull_cache_images: bool = True,
+        line_callback: Callable[[str], None] = None
     ) -> bool:
         command = self.base_command + [
             "build",
@@ -35,7 +64,9 @@ class Docker:
             command.extend(["--target", target_stage])
 
         for cache_image in cache_images:
-            self.pull(cache_image)
+            if pull_cache_images:
+                self.pull_once(cache_image, check_digest=True)
+
             logger.info("Using {} as a cache image.".format(cache_image))
             command.extend(["--cache-from", cache_image])
 
@@ -53,28 +84,316 @@ class Docker:
         # 'pre pull' them.
         #
         # VERY JANK. Just like BuildKit.
-        self._pull_from_images(context)
+        self._pull_from_images(context, {"branch": branch} if branch else {}, target_stage)
 
         # Enable BuildKit to get 'faster' builds (supposedly).
+        if line_callback:
+            return stream_command(command, line_callback, env={"DOCKER_BUILDKIT": "1"})
+
         return call_command(command, env={"DOCKER_BUILDKIT": "1"})
 
+    def build_with_registry_cache(
+        self,
+        context: str,
+        tags: List[str] = [],
+        cache_from: List[str] = [],
+        cache_to: str = None,
+        branch: str = None,
+        line_callback: Callable[[str], None] = None
+    ) -> bool:
+        """
+        Builds an image (with all of its stages) in a single BuildKit invocation, using a registry cache.
+
+        With `mode=max`, the cache exported to `cache_to` includes the layers of every intermediate stage,
+        so the stages don't need to be built (and pushed) as separate images just to be cached.
+        """
+        if not self._ensure_buildx_builder():
+            return False
+
+        command = self.base_command + [
+            "buildx", "build",
+            "--builder", BUILDX_BUILDER,
+            # Need this in CI so that every log is output as its own line.
+            "--progress=plain",
+            # Load the result into the local daemon so that it can be pushed (and used by CI) like any other build.
+            "--load"
+        ]
+
+        if branch:
+            command.extend(["--build-arg", "branch={}".format(branch)])
+
+        for cache_ref in cache_from:
+            logger.info("Using {} as a registry cache.".format(cache_ref))
+            command.extend(["--cache-from", "type=registry,ref={}".format(cache_ref)])
+
+        if cache_to:
+            command.extend(["--cache-to", "type=registry,ref={},mode=max".format(cache_to)])
+
+        for tag in tags:
+            command.extend(["-t", tag])
+
+        command.append(context)
+
+        if line_callback:
+            return stream_command(command, line_callback)
+
+        return call_command(command)
+
+    def bake(self, bake_file: str, metadata_file: str = None, use_kubails_builder: bool = False) -> bool:
+        """
+        Builds every target in a bake file in a single BuildKit session.
+
+        `use_kubails_builder` is needed whenever a target exports a registry cache, since the default
+        builder can't do that (see BUILDX_BUILDER).
+        """
+        command = self.base_command + ["buildx", "bake", "--file", bake_file, "--progress=plain"]
+
+        if metadata_file:
+            command.extend(["--metadata-file", metadata_file])
+
+        if use_kubails_builder:
+            if not self._ensure_buildx_builder():
+                return False
+
+            command.extend(["--builder", BUILDX_BUILDER, "--load"])
+
+        return call_command(command)
+
     def pull(self, image: str) -> bool:
         command = self.base_command + ["pull", image]
         return call_command(command)
 
+    def pull_once(self, image: str, check_digest: bool = False) -> bool:
+        """
+        Pulls an image, unless it has already been pulled during this invocation.
+
+        If another thread is currently pulling the image, this waits for that pull to finish
+        and returns its result instead of pulling the image again.
+
+        If `check_digest` is set, the image isn't pulled when the local copy is already
+        the same as the one in the registry.
+        """
+        with self._pulls_lock:
+            pull = self._pulls.get(image)
+            is_new_pull = pull is None
+
+            if pull is None:
+                pull = Future()
+                self._pulls[image] = pull
+
+        if is_new_pull:
+            try:
+                pull.set_result(self.pull_if_outdated(image) if check_digest else self.pull(image))
+            except Exception as e:
+                # Make sure that anyone waiting on this pull doesn't end up waiting forever.
+                pull.set_exception(e)
+
+        return pull.result()
+
+    def pull_if_outdated(self, image: str) -> bool:
+        """Pulls an image only if the local copy's digest doesn't match the registry's digest."""
+        remote_digest = self.get_remote_digest(image)
+
+        if remote_digest and remote_digest in self.get_local_digests(image):
+            logger.info("{} is already up to date; not pulling it.".format(image))
+            return True
+
+        return self.pull(image)
+
+    def pre_pull(self, images: List[str], cache_images: List[str] = [], jobs: int = PRE_PULL_JOBS) -> bool:
+        """
+        Pulls all of the distinct images (up to `jobs` at once), so that subsequent builds can reuse them.
+
+        Cache images are only pulled when they differ from the local copies, since they're usually
+        already present from a previous build step.
+        """
+        distinct_images = sorted(set(images) | set(cache_images))
+
+        if not distinct_images:
+            return True
+
+        logger.info("Pre-pulling {} images...".format(len(distinct_images)))
+
+        def pull_function(image: str) -> bool:
+            return self.pull_once(image, check_digest=image in cache_images and image not in images)
+
+        results = run_concurrently(pull_function, distinct_images, jobs=min(jobs, len(distinct_images)))
+        return all(results.values())
+
+    def get_remote_digest(self, image: str) -> str:
+        """
+        Gets the digest of an image in the registry without pulling it.
+        Returns a blank string if the image doesn't exist.
+
+        For a multi-platform image (i.e. a manifest list), this is the digest of its first platform's manifest.
+        That's enough to know that the image exists, but it won't match the (manifest list) digest of a local copy,
+        so such images are always considered outdated and get re-pulled.
+        """
+        with self._remote_digests_lock:
+            if image in self._remote_digests:
+                return self._remote_digests[image]
+
+        command = self.base_command + ["manifest", "inspect", "-v", image]
+
+        # Older versions of the Docker CLI hide `docker manifest` behind the experimental flag.
+        output = get_command_output(command, env=dict(os.environ, DOCKER_CLI_EXPERIMENTAL="enabled"))
+
+        try:
+            manifest = json.loads(output)
+
+            # `docker manifest inspect -v` outputs a list with an entry per platform for manifest lists.
+            if isinstance(manifest, list):
+                manifest = manifest[0]
+
+            digest = manifest["Descriptor"]["digest"]
+        except (ValueError, KeyError, TypeError, IndexError):
+            digest = ""
+
+        with self._remote_digests_lock:
+            self._remote_digests[image] = digest
+
+        return digest
+
+    def get_image_layers(self, image: str) -> List[str]:
+        """Gets the IDs of a local image's layers, from the bottom (i.e. the base image) up."""
+        command = self.base_command + ["image", "inspect", "--format", "{{json .RootFS.Layers}}", image]
+        output = get_command_output(command)
+
+        try:
+            return json.loads(output) if output else []
+        except ValueError:
+            return []
+
+    def get_image_size(self, image: str) -> int:
+        """Gets the (uncompressed) size of a local image, in bytes."""
+        command = self.base_command + ["image", "inspect", "--format", "{{.Size}}", image]
+        output = get_command_output(command)
+
+        try:
+            return int(output)
+        except ValueError:
+            return 0
+
+    def get_image_history(self, image: str) -> List[Dict[str, Any]]:
+        """
+        Gets the history of a local image (i.e. the instructions that created each of its layers),
+        from the top (i.e. the last instruction) down.
+        """
+        command = self.base_command + [
+            "history", "--no-trunc", "--human=false", "--format", "{{.Size}}\t{{.CreatedBy}}", image
+        ]
+
+        output = get_command_output(command)
+        history = []
+
+        for line in output.split("\n") if output else []:
+            size, _, created_by = line.partition("\t")
+
+            try:
+                history.append({"size": int(size), "created_by": created_by.strip()})
+            except ValueError:
+                continue
+
+        return history
+
+    def get_local_digests(self, image: str) -> List[str]:
+        """Gets the registry digests (e.g. 'sha256:abc...') that the local copy of an image is known by."""
+        command = self.base_command + ["image", "inspect", "--format", "{{json .RepoDigests}}", image]
+        output = get_command_output(command)
+
+        try:
+            repo_digests = json.loads(output) if output else []
+        except ValueError:
+            return []
+
+        return [repo_digest.split("@")[-1] for repo_digest in repo_digests]
+
+    def get_from_images(self, context: str, build_args: Dict[str, str] = {}, target_stage: str = None) -> List[str]:
+        """
+        Gets the external images (i.e. not other stages or 'scratch') that building
+        the context's Dockerfile (up to the target stage) needs.
+        """
+        dockerfile = os.path.join(context, "Dockerfile")
+
+        try:
+            return parse_dockerfile(dockerfile).get_external_images(build_args, target_stage)
+        except (OSError, ValueError) as e:
+            # Let the build itself report the problem with the Dockerfile (or the lack of one).
+            logger.warning("Couldn't determine the FROM images of {}: {}".format(dockerfile, e))
+            return []
+
     def push(self, image: str) -> bool:
         command = self.base_command + ["push", image]
         return call_command(command)
 
-    def _pull_from_images(self, context: str) -> bool:
-        dockerfile = os.path.join(context, "Dockerfile")
+    def tag(self, source_image: str, target_image: str) -> bool:
+        command = self.base_command + ["tag", source_image, target_image]
+        return call_command(command)
+
+    def image_exists_in_registry(self, image: str) -> bool:
+        return bool(self.get_remote_digest(image))
+
+    def push_tags(self, repository: str, tags: List[str], jobs: int = PUSH_TAGS_JOBS) -> bool:
+        """
+        Pushes the given tags of a repository (i.e. an image name without a tag).
+
+        When the given tags are exactly the repository's local tags, they all get pushed in one go
+        with `--all-tags`. Otherwise (e.g. there's a local 'latest' tag or pulled cache tags that shouldn't
+        be pushed), the first tag is pushed on its own to upload the image's layers, and then the rest
+        are pushed concurrently; they only need to upload a manifest, since the layers are already there.
+        """
+        if not tags:
+            return True
+
+        if set(self.get_local_tags(repository)) == set(tags):
+            command = self.base_command + ["push", "--all-tags", repository]
+            return call_command(command)
+
+        images = ["{}:{}".format(repository, tag) for tag in tags]
+
+        if not self.push(images[0]):
+            return False
+
+        results = run_concurrently(self.push, images[1:], jobs=min(jobs, len(images[1:])))
+        return all(results.values())
+
+    def get_image_tags(self, image: str) -> List[str]:
+        """Gets every tag of a local image within its repository (e.g. 'abc123' and 'master' for 'repo:abc123')."""
+        repository = image.rpartition(":")[0]
+        command = self.base_command + ["image", "inspect", "--format", "{{json .RepoTags}}", image]
+        output = get_command_output(command)
+
+        try:
+            repo_tags = json.loads(output) if output else []
+        except ValueError:
+            return []
+
+        return [repo_tag.rpartition(":")[2] for repo_tag in repo_tags if repo_tag.rpartition(":")[0] == repository]
+
+    def get_local_tags(self, repository: str) -> List[str]:
+        command = self.base_command + ["image", "ls", "--format", "{{.Tag}}", repository]
+        output = get_command_output(command)
+
+        return [tag for tag in output.split("\n") if tag and tag != "<none>"]
+
+    def _ensure_buildx_builder(self) -> bool:
+        with self._buildx_builder_lock:
+            if not self._buildx_builder_ready:
+                inspect_command = self.base_command + ["buildx", "inspect", BUILDX_BUILDER]
+                create_command = self.base_command + [
+                    "buildx", "create", "--name", BUILDX_BUILDER, "--driver", "docker-container"
+                ]
+
+                self._buildx_builder_ready = (
+                    bool(get_command_output(inspect_command)) or call_command(create_command)
+                )
+
+            return self._buildx_builder_ready
 
+    def _pull_from_images(self, context: str, build_args: Dict[str, str] = {}, target_stage: str = None) -> bool:
         result = True
 
-        with open(dockerfile, "r") as file:
-            for line in file:
-                if "FROM" in line:
-                    image = line.split(" ")[1].strip()
-                    result = result and self.pull(image)
+        for image in self.get_from_images(context, build_args, target_stage):
+            result = result and self.pull_once(image)
 
         return result
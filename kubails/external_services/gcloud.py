@@ -2,11 +2,14 @@ import json
 import logging
 import os
 import shutil
+import threading
 from functools import reduce
-from typing import Callable, Dict, List
+from typing import Dict, List
 from kubails.external_services import git
+from kubails.utils.cache import Cache, get_workspace_backends
 from kubails.utils.service_helpers import (
-    call_command, get_command_output, get_codebase_folder, get_resources_subfolder, STDERR_INTO_OUTPUT
+    call_command, get_command_output, get_codebase_folder, get_resources_subfolder, run_concurrently,
+    STDERR_INTO_OUTPUT
 )
 
 
@@ -14,7 +17,13 @@ logger = logging.getLogger(__name__)
 
 BUILDER_IMAGE = "kubails-builder"
 BUILDER_FOLDER = "builder"
-CLOUD_BUILD_FOLDER = "/workspace"
+
+# How long (in seconds) to reuse the last built tag of an image for.
+LAST_BUILT_TAG_CACHE_TTL = 600
+
+# The number of services to look up the last built tag of at once.
+# Each lookup is its own gcloud process, which spends most of its time starting up and waiting on the network.
+LAST_BUILT_TAG_LOOKUP_JOBS = 8
 
 
 class GoogleCloud:
@@ -27,6 +36,9 @@ class GoogleCloud:
 
         self.git = git.Git()
 
+        # The last built tags of several services are looked up at once, but they all fetch into the same repo.
+        self._fetch_lock = threading.Lock()
+
     def set_project(self) -> bool:
         logger.info("Switching to project {}...".format(self.project_id))
 
@@ -304,6 +316,14 @@ class GoogleCloud:
 
         return call_command(command)
 
+    def add_image_tags(self, source_image: str, target_images: List[str]) -> bool:
+        """Adds tags to an image that's already in the registry, without pulling or pushing anything."""
+        if not target_images:
+            return True
+
+        command = self.base_command + ["container", "images", "add-tag", "--quiet", source_image] + target_images
+        return call_command(command)
+
     def get_current_user_email(self) -> str:
         command = self.base_command + ["config", "get-value", "account"]
         return get_command_output(command)
@@ -319,6 +339,13 @@ class GoogleCloud:
     def get_last_built_tag_for_service(self, project_name: str, service_name: str) -> str:
         image = self.format_gcr_image(project_name, service_name)
 
+        # The same lookups happen across several steps of a build (e.g. change detection and promoting images),
+        # so reuse them for the rest of the build.
+        last_built_tags = Cache("last-built-tags", backends=get_workspace_backends(), ttl=LAST_BUILT_TAG_CACHE_TTL)
+
+        return last_built_tags.get_or_compute(lambda: self._get_last_built_tag(image), image)
+
+    def _get_last_built_tag(self, image: str) -> str:
         command = self.base_command + ["container", "images", "list-tags", "--format=json", "--limit=1", image]
 
         result = get_command_output(command)
@@ -329,38 +356,37 @@ class GoogleCloud:
 
             # Note: Our original assumption that the first tag is the 'latest' was in fact wrong.
             # As such, we need to check _all_ of the tags to find the latest one.
-            tags_with_timestamps = [
-                {"tag": tag, "timestamp": self.git.get_commit_timestamp(tag)} for tag in tags
-            ]
+            commit_tags = [tag for tag in tags if git.COMMIT_SHA_PATTERN.match(tag)]
+
+            # In a shallow clone (e.g. in Cloud Build), the tagged commits might not have been fetched yet,
+            # in which case they'd all have a timestamp of 0 and the 'latest' one would be picked arbitrarily.
+            if commit_tags:
+                with self._fetch_lock:
+                    self.git.ensure_commits_fetched(commit_tags)
+
+            timestamps = self.git.get_commit_timestamps(tags)
+            tags_with_timestamps = [{"tag": tag, "timestamp": timestamps[tag]} for tag in tags]
 
             sorted_tags = sorted(tags_with_timestamps, key=lambda i: i["timestamp"], reverse=True)
             return sorted_tags[0]["tag"]
 
         return ""
 
-    # This takes advantage of the `/workspace` volume mounted in Cloud Build to cache the result.
-    def cache_in_cloud_build(self, filename: str, callback: Callable[[], str]) -> str:
-        filename = os.path.join(CLOUD_BUILD_FOLDER, filename)
-
-        try:
-            with open(filename, "r") as file:
-                result = file.read().strip()  # Need to strip the ending newline.
-                logger.info("Read value '{}' from {}".format(result, filename))
-
-                return result
-        except FileNotFoundError:
-            result = callback()
-
-            # If the Cloud Build folder doesn't exist, then we're probably not running in Cloud Build.
-            # Fallback to just returning the value.
-            if os.path.isdir(CLOUD_BUILD_FOLDER):
-                with open(filename, "w") as file:
-                    file.write(result)
-                    logger.info("Wrote value '{}' to {}".format(result, filename))
-            else:
-                logger.info("Cloud Build volume is not mounted; not writing {}".format(filename))
-
-            return result
+    def get_last_built_tags_for_services(
+        self,
+        project_name: str,
+        service_names: List[str],
+        jobs: int = LAST_BUILT_TAG_LOOKUP_JOBS
+    ) -> Dict[str, str]:
+        """
+        Looks up the last built tag of each of the services concurrently.
+
+        :return: A map of each service to its last built tag (or "" if it has never been built).
+        """
+        def lookup_function(service_name: str) -> str:
+            return self.get_last_built_tag_for_service(project_name, service_name)
+
+        return run_concurrently(lookup_function, service_names, jobs=jobs)
 
     def format_gcr_image(self, project_name: str, base_image: str, tag: str = "") -> str:
         image = "gcr.io/{}/{}-{}".format(self.project_id, project_name, base_image)
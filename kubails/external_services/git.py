@@ -1,16 +1,31 @@
 import logging
-from typing import List
-from kubails.utils.service_helpers import call_command, get_command_output
+import os
+import re
+import subprocess
+import threading
+from typing import Dict, List, Optional, Tuple
+from kubails.utils.service_helpers import call_command, capture_command, get_command_output, log_command
 
 
 logger = logging.getLogger(__name__)
 
+# How many more commits of history to fetch at a time when looking for a commit in a shallow clone.
+# If the commit still can't be found after all of these, the full history is fetched.
+DEEPEN_STEPS = [50, 200, 1000]
+
+# Matches (full or abbreviated) commit SHAs, e.g. to tell which image tags are commits.
+COMMIT_SHA_PATTERN = re.compile(r"^[0-9a-f]{7,40}$")
+
+# The first version of git with `git cat-file --batch-command`.
+BATCH_COMMAND_GIT_VERSION = (2, 36)
+
 
 class Git:
     def __init__(self):
         self.base_command = ["git"]
+        self.batch_session = GitBatchSession(self.base_command)
 
-    def fetch(self, remote: str, prune: bool = False, unshallow: bool = False) -> bool:
+    def fetch(self, remote: str, prune: bool = False, unshallow: bool = False, deepen: int = None) -> bool:
         command = self.base_command + ["fetch", remote]
 
         if prune:
@@ -19,37 +34,325 @@ class Git:
         if unshallow:
             command.append("--unshallow")
 
-        return call_command(command)
+        if deepen:
+            command.append("--deepen={}".format(deepen))
+
+        result = call_command(command)
+
+        # Make sure the batch session sees the newly fetched objects and refs.
+        self.batch_session.close()
 
-    def get_remote_branches(self) -> List[str]:
-        command = self.base_command + ["branch", "-r"]
-        result = get_command_output(command)
+        return result
 
-        cleaned_branches = list(map(lambda x: x.strip().lower().replace("origin/", ""), result.split("\n")))
-        filtered_branches = list(filter(None, cleaned_branches))
+    def get_remote_heads(self, remote: str = "origin") -> Optional[List[str]]:
+        """
+        Gets the (lower cased) names of the branches that exist on the remote right now,
+        straight from the remote (i.e. without having to fetch anything).
 
-        return sorted(filtered_branches)
+        :return: The branch names, or None if the remote couldn't be reached.
+        """
+        command = self.base_command + ["ls-remote", "--heads", remote]
+        result, output = capture_command(command)
 
-    def folder_changed(self, folder: str, current_branch: str, since_commit: str) -> bool:
-        # Need the full git history to diff commits.
+        if not result:
+            logger.error("Couldn't list the branches of {}:\n{}".format(remote, output.strip()))
+            return None
+
+        branches = [line.partition("refs/heads/")[2].strip().lower() for line in output.split("\n")]
+        return sorted(filter(None, branches))
+
+    def prepare_diff(self, current_branch: str, since_commits: List[str] = []) -> bool:
+        """
+        Gets the repo ready for diffing the current branch against older commits: checks out the current branch
+        (otherwise, it doesn't exist for the diff command) and makes sure that the older commits have been fetched.
+
+        This only needs to be done once, no matter how many diffs are run afterwards.
+        """
         self.fetch("origin", prune=True)
-        self.fetch("origin", prune=True, unshallow=True)
+        result = call_command(self.base_command + ["checkout", current_branch])
+
+        return self.ensure_commits_fetched(since_commits) and result
+
+    def ensure_commits_fetched(self, revisions: List[str], remote: str = "origin") -> bool:
+        """
+        Makes sure that the commits (e.g. SHAs or things like 'master~') are available in the local repo.
+
+        Cloud Build only provides a shallow clone, but fetching the entire history of a big repo can take minutes.
+        Diffing two commits only needs the commits themselves (not the history between them), so the history is
+        deepened in steps until every commit is found, and only as a last resort is the full history fetched.
+
+        :return: Whether all of the commits are available.
+        """
+        missing_revisions = self.get_missing_commits(revisions)
+
+        if not missing_revisions or not self.is_shallow():
+            return not missing_revisions
+
+        for depth in DEEPEN_STEPS:
+            logger.info("Fetching {} more commits of history to find {}...".format(depth, ", ".join(missing_revisions)))
+            self.fetch(remote, deepen=depth)
+
+            missing_revisions = self.get_missing_commits(missing_revisions)
+
+            if not missing_revisions:
+                return True
+            elif not self.is_shallow():
+                # There's no more history to fetch; the commits just don't exist.
+                return False
+
+        logger.info("Fetching the full history to find {}...".format(", ".join(missing_revisions)))
+        self.fetch(remote, unshallow=True)
+
+        return not self.get_missing_commits(missing_revisions)
+
+    def get_missing_commits(self, revisions: List[str]) -> List[str]:
+        """Finds which of the revisions don't resolve to a commit in the local repo."""
+        resolved_commits = self._resolve_commits(revisions)
+        return [revision for revision in revisions if revision not in resolved_commits]
+
+    def get_changed_files(self, current_branch: str, since_commit: str) -> Optional[List[str]]:
+        """
+        Gets the paths of every file that differs between the two commits.
 
-        # Need to checkout the current_branch, otherwise it doesn't exist for the diff command.
-        call_command(self.base_command + ["checkout", current_branch])
+        The paths are relative to the current directory (i.e. the project, which isn't necessarily
+        the root of the repo) and files outside of it are left out, just like a pathspec diff.
+        They're also separated by NULs, so that paths with unusual characters don't get quoted.
 
-        command = self.base_command + ["diff", "--quiet", current_branch, since_commit, "--", folder]
+        Renames are reported as the old path and the new path, so that a file moving between folders
+        counts as a change to both.
 
-        # If the command is successful, then that means there _no_ changes.
-        # But since we want to know if the folder _did_ change, we have to invert the result.
-        return not call_command(command)
+        :return: The changed paths, or None if the diff failed (e.g. the commit doesn't exist).
+        """
+        command = self.base_command + [
+            "diff", "--name-only", "--no-renames", "--relative", "-z", current_branch, since_commit, "--"
+        ]
+
+        result, output = capture_command(command)
+
+        if not result:
+            logger.debug("Failed to diff {} against {}: {}".format(current_branch, since_commit, output))
+            return None
+
+        return [path for path in output.split("\0") if path]
+
+    def get_recent_commits(self, branch: str, count: int, remote: str = "origin") -> List[str]:
+        """Gets the (full) SHAs of the most recent commits on a remote branch, newest first."""
+        ref = "{}/{}".format(remote, branch)
+        command = self.base_command + ["log", "--format=%H", "-n", str(count), ref, "--"]
+
+        commits = [commit for commit in get_command_output(command).split("\n") if commit]
+
+        if len(commits) < count:
+            is_shallow = self.is_shallow()
+
+            # The branch might not have been fetched (e.g. Cloud Build only clones the branch being built),
+            # or not enough of its history has been. Only fetch as much history as is needed,
+            # unless the repo already has all of it.
+            if not commits or is_shallow:
+                self.fetch_branch(remote, branch, deepen=count if is_shallow else None)
+                commits = [commit for commit in get_command_output(command).split("\n") if commit]
+
+        return commits
+
+    def is_shallow(self) -> bool:
+        command = self.base_command + ["rev-parse", "--is-shallow-repository"]
+        return get_command_output(command) == "true"
+
+    def fetch_branch(self, remote: str, branch: str, deepen: int = None) -> bool:
+        """
+        Fetches a single branch from the remote.
+
+        In a shallow clone, `deepen` fetches that many more commits of history past the current shallow boundary.
+        Unlike `--depth`, this never cuts off history that has already been fetched (e.g. by ensure_commits_fetched).
+        """
+        command = self.base_command + ["fetch", remote, "{0}:refs/remotes/{1}/{0}".format(branch, remote)]
+
+        if deepen:
+            command.append("--deepen={}".format(deepen))
+
+        result = call_command(command)
+
+        # Make sure the batch session sees the newly fetched objects and refs.
+        self.batch_session.close()
+
+        return result
+
+    def get_commit_timestamps(self, commit_shas: List[str]) -> Dict[str, int]:
+        """
+        Gets the (Unix epoch) timestamps of many commits through the batch session,
+        rather than starting a git process per commit.
+
+        :return: A map of each of the given SHAs to its commit's timestamp (or 0 if it isn't a valid commit).
+        """
+        return {commit_sha: self.get_commit_timestamp(commit_sha) for commit_sha in commit_shas}
 
     def get_commit_timestamp(self, commit_sha: str) -> int:
-        # Note: "--format=%ct" gets the timestamp as a Unix epoch timestamp.
-        # Makes it easier for sorting.
-        command = self.base_command + ["show", "--quiet", "-s", "--format=%ct", commit_sha]
+        # Tags that aren't commits (e.g. 'latest') won't resolve to a commit (hence the `^{commit}`).
+        contents = self.batch_session.contents("{}^{{commit}}".format(commit_sha)) if commit_sha else None
+
+        # If the commit_sha isn't a valid commit, then there are no contents. Return 0 instead.
+        if not contents:
+            return 0
+
+        # The timestamp is the committer's, which is what "--format=%ct" would give.
+        # e.g. "committer Some Person <person@example.com> 1609459200 +0000"
+        for line in contents.decode("utf8", errors="replace").split("\n"):
+            if line.startswith("committer "):
+                timestamp = line.rsplit(" ", 2)[-2]
+                return int(timestamp) if timestamp.isdigit() else 0
+            elif not line:
+                break  # The end of the headers; the rest is the commit message.
+
+        return 0
+
+    def get_commit_sha(self, revision: str) -> str:
+        """Gets the full SHA of the commit that a revision (e.g. 'HEAD') points to, or "" if it doesn't exist."""
+        return self._resolve_commits([revision]).get(revision, "")
+
+    def get_tree_id(self, revision: str, path: str = "") -> str:
+        """
+        Gets the ID of the tree (i.e. the folder) at the path in a revision, or "" if it doesn't exist.
+        Since trees are content addressed, a folder is unchanged between two commits if its tree IDs match.
+
+        The path is relative to the current directory (like a pathspec), not to the root of the repo.
+        """
+        info = self.batch_session.info("{}:./{}".format(revision, path.strip("/")))
+        return info[0] if info else ""
+
+    def _resolve_commits(self, revisions: List[str]) -> Dict[str, str]:
+        """
+        Resolves revisions (e.g. short SHAs or things like 'master~') to full commit SHAs through the batch session.
+
+        :return: A map of each revision that resolves to a commit to that commit's full SHA.
+        """
+        resolved_commits = {}  # type: Dict[str, str]
+
+        for revision in revisions:
+            info = self.batch_session.info("{}^{{commit}}".format(revision)) if revision else None
+
+            if info:
+                resolved_commits[revision] = info[0]
+
+        return resolved_commits
+
+
+class GitBatchSession:
+    """
+    A long-lived `git cat-file` process that objects (and their metadata) can be looked up through over a pipe,
+    so that each lookup doesn't have to pay for starting up a new git process.
+
+    Uses `--batch-command` (git 2.36+), which can look up just an object's info or its full contents,
+    and otherwise falls back to `--batch`, which always returns the contents (the info is read from its header).
+
+    The session is tied to the repo that it was started in (i.e. the current directory at the time);
+    if the current directory changes, it restarts itself in the new one.
+    """
+
+    def __init__(self, base_command: List[str]) -> None:
+        self.base_command = base_command
+        self.process = None  # type: subprocess.Popen
+        self.cwd = None  # type: str
+        self.supports_batch_command = False
+        self.lock = threading.Lock()
+
+    def info(self, object_name: str) -> Optional[Tuple[str, str, int]]:
+        """
+        Looks up an object (anything that `git rev-parse` understands, like 'HEAD~', 'abc1234^{commit}',
+        or 'master:services/frontend').
+
+        :return: The object's full SHA, its type, and its size; or None if it doesn't exist.
+        """
+        result = self._request(object_name, with_contents=False)
+        return result[0] if result else None
+
+    def contents(self, object_name: str) -> Optional[bytes]:
+        """:return: The object's raw contents, or None if it doesn't exist."""
+        result = self._request(object_name, with_contents=True)
+        return result[1] if result else None
+
+    def close(self) -> None:
+        with self.lock:
+            self._stop()
+
+    def _request(self, object_name: str, with_contents: bool) -> Optional[Tuple[Tuple[str, str, int], bytes]]:
+        # A newline would end the request early (and break the protocol for the rest of the session).
+        if "\n" in object_name:
+            return None
+
+        with self.lock:
+            process = self._get_process()
+
+            if self.supports_batch_command:
+                request = "{} {}\n".format("contents" if with_contents else "info", object_name)
+            else:
+                request = "{}\n".format(object_name)
+
+            try:
+                process.stdin.write(request.encode("utf8"))
+                process.stdin.flush()
+
+                header = process.stdout.readline().decode("utf8").rstrip("\n")
+                parts = header.split(" ")
+
+                # Anything that isn't "<sha> <type> <size>" (e.g. "<name> missing" or "<name> ambiguous")
+                # means that the object couldn't be found.
+                if len(parts) != 3 or not parts[2].isdigit():
+                    return None
+
+                info = (parts[0], parts[1], int(parts[2]))
+                contents = b""
+
+                if with_contents or not self.supports_batch_command:
+                    contents = process.stdout.read(info[2])
+                    process.stdout.read(1)  # The newline after the contents.
+
+                return info, contents
+            except (OSError, ValueError):
+                logger.debug("Git batch session failed; restarting it.", exc_info=True)
+                self._stop()
+
+                return None
+
+    def _get_process(self) -> subprocess.Popen:
+        cwd = os.getcwd()
+
+        if self.process is not None and (self.cwd != cwd or self.process.poll() is not None):
+            self._stop()
+
+        if self.process is None:
+            self.supports_batch_command = _get_git_version(self.base_command) >= BATCH_COMMAND_GIT_VERSION
+            mode = "--batch-command" if self.supports_batch_command else "--batch"
+
+            command = self.base_command + ["cat-file", mode]
+            log_command(command)
+
+            self.process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+
+            self.cwd = cwd
+
+        return self.process
+
+    def _stop(self) -> None:
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+        self.process.stdout.close()
+
+        self.process = None
+
 
-        output = get_command_output(command)
+def _get_git_version(base_command: List[str]) -> Tuple[int, ...]:
+    # e.g. "git version 2.39.2" or "git version 2.32.1 (Apple Git-133)"
+    output = get_command_output(base_command + ["version"])
+    match = re.search(r"(\d+)\.(\d+)", output)
 
-        # If the commit_sha isn't a valid commit, then the output will be blank. Return 0 instead.
-        return int(output) if output else 0
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
@@ -1,9 +1,12 @@
 import click
+import json
 import logging
 import os
+import threading
 from functools import reduce
 from numbers import Number
 from typing import Any, Callable, Dict, List
+from kubails.utils.cache import Cache, get_workspace_backends
 from kubails.utils.service_helpers import call_command, get_command_output
 
 
@@ -11,11 +14,27 @@ logger = logging.getLogger(__name__)
 
 TERRAFORM_FOLDER = "terraform"
 
+# The file that the variables are written to, which is passed to Terraform with '-var-file'.
+# It deliberately isn't named like 'terraform.tfvars.json' or '*.auto.tfvars.json', since Terraform would
+# automatically load it for every command, including the ones that are meant to be run without the variables.
+VAR_FILE_NAME = "kubails.tfvars.json"
+
+# Every output of a Terraform root folder, keyed by the (absolute) root folder.
+# Reading the outputs means reading the remote state, which is slow, so they're only read once per process
+# (or until Kubails changes the infrastructure).
+_outputs = {}  # type: Dict[str, Dict[str, Any]]
+_outputs_lock = threading.Lock()
+
 
 class Terraform:
-    def __init__(self, variables: Dict[str, Any] = {}, root_folder: str = ".") -> None:
+    def __init__(self, variables: Dict[str, Any] = {}, root_folder: str = ".", use_var_file: bool = True) -> None:
+        """
+        :param use_var_file: Pass the variables to Terraform through a tfvars JSON file (see VAR_FILE_NAME);
+                             otherwise, they're passed as 'TF_VAR' environment variables.
+        """
         self.root_folder = root_folder
         self.variables = variables
+        self.use_var_file = use_var_file
         self.base_command = ["terraform"]
 
     def init(self) -> bool:
@@ -77,10 +96,13 @@ class Terraform:
         return self._run_terraform_command(get_state_command, call_function=get_command_output).split("\n")
 
     def get_output(self, output: str) -> str:
-        command = self.base_command + ["output", "-json", output]
-        result = self._run_terraform_command(command, get_command_output)
+        outputs = self.get_outputs()
+
+        # The saved outputs could be out of date (e.g. another step of the build changed the infrastructure).
+        if output not in outputs:
+            outputs = self.get_outputs(refresh=True)
 
-        if not result:
+        if output not in outputs:
             logger.error(
                 "Terraform output '{}' doesn't exist. "
                 "Has the infrastructure been deployed?".format(output)
@@ -88,13 +110,81 @@ class Terraform:
 
             raise click.Abort()
 
-        return result.strip('"')
+        value = outputs[output]["value"]
+
+        # Non-string values (e.g. the list of name servers) are returned as JSON, like `terraform output -json` does.
+        return value if isinstance(value, str) else json.dumps(value, indent=2)
+
+    def get_outputs(self, refresh: bool = False) -> Dict[str, Any]:
+        """
+        Gets every output (as `terraform output -json` gives them, i.e. with their value, type, and sensitivity)
+        with a single Terraform command, rather than running a separate command for each output.
+
+        The outputs are memoized for the rest of the process and, when running in Cloud Build, for the rest of
+        the build. Sensitive outputs never get written to disk, so outputs that include any aren't saved to
+        the build at all (otherwise, later steps would find the sensitive outputs missing).
+
+        :param refresh: Get the outputs from Terraform, even if they've already been memoized.
+        """
+        root_folder = os.path.abspath(self.root_folder)
+
+        with _outputs_lock:
+            if root_folder in _outputs and not refresh:
+                return _outputs[root_folder]
+
+            outputs_cache = self._get_outputs_cache()
+            outputs = outputs_cache.get(root_folder) if not refresh else None
+
+            if outputs is None:
+                command = self.base_command + ["output", "-json"]
+                result = self._run_terraform_command(command, get_command_output)
+
+                try:
+                    outputs = json.loads(result) if result else {}
+                except ValueError:
+                    outputs = {}
+
+                # No outputs probably means the infrastructure hasn't been deployed (yet), so don't hold onto that.
+                if not outputs:
+                    return {}
+
+                if not any(output.get("sensitive") for output in outputs.values()):
+                    outputs_cache.set(outputs, root_folder)
+
+            _outputs[root_folder] = outputs
+
+            return outputs
 
     def run_command(self, subcommand: str, arguments: List[str] = [], with_vars=True) -> bool:
-        command = self.base_command + [subcommand] + arguments
-        var_options = self._convert_config_to_var_options(self.variables) if self.variables and with_vars else None
+        var_file_options = []  # type: List[str]
+        var_options = None
+
+        if self.variables and with_vars:
+            if self.use_var_file:
+                self._write_var_file(self.variables)
+                var_file_options = ["-var-file={}".format(VAR_FILE_NAME)]
+            else:
+                var_options = self._convert_config_to_var_options(self.variables)
+
+        # The options have to come before any positional arguments (e.g. the address and ID for `import`).
+        command = self.base_command + [subcommand] + var_file_options + arguments
 
-        return self._run_terraform_command(command, env_vars=var_options)
+        result = self._run_terraform_command(command, env_vars=var_options)
+
+        # Commands like `apply` and `destroy` can change the outputs.
+        self._clear_outputs()
+
+        return result
+
+    def _clear_outputs(self) -> None:
+        root_folder = os.path.abspath(self.root_folder)
+
+        with _outputs_lock:
+            _outputs.pop(root_folder, None)
+            self._get_outputs_cache().delete(root_folder)
+
+    def _get_outputs_cache(self) -> Cache:
+        return Cache("terraform-outputs", backends=get_workspace_backends())
 
     def _run_terraform_command(
         self,
@@ -134,6 +224,47 @@ class Terraform:
 
         return result
 
+    def _write_var_file(self, config: Dict[str, Any]) -> bool:
+        """
+        Writes the config to the var file, for the commands that are run with the variables.
+
+        Unlike '-var' options, undeclared variables in a var file only cause a warning, so the whole config
+        can be dumped into it (see _convert_config_to_var_options). And since the values keep their JSON types,
+        Terraform converts them to the declared types itself (e.g. a number for a 'string' variable).
+
+        The file is only rewritten when the config has changed, so that it isn't touched on every command.
+
+        :return: Whether the file was (re)written.
+        """
+        var_file_path = os.path.join(self.root_folder, TERRAFORM_FOLDER, VAR_FILE_NAME)
+        content = json.dumps(self._convert_null_values(config), indent=4, sort_keys=True) + "\n"
+
+        try:
+            with open(var_file_path, "r") as file:
+                if file.read() == content:
+                    return False
+        except FileNotFoundError:
+            pass
+
+        logger.debug("Writing Terraform variables to {}".format(var_file_path))
+
+        with open(var_file_path, "w") as file:
+            file.write(content)
+
+        return True
+
+    def _convert_null_values(self, value: Any) -> Any:
+        # Null values have always been passed to Terraform as empty strings (see _stringify_value);
+        # a null would make Terraform fall back to the variable's default (or fail, if there isn't one).
+        if isinstance(value, dict):
+            return {key: self._convert_null_values(item) for key, item in value.items()}
+        elif isinstance(value, list):
+            return [self._convert_null_values(item) for item in value]
+        elif value is None:
+            return ""
+        else:
+            return value
+
     def _convert_config_to_var_options(self, config: Dict[str, Any]) -> Dict[str, str]:
         var_options = {}
 
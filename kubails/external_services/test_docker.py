@@ -0,0 +1,178 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock, TestCase
+from . import docker
+
+
+class TestDocker(TestCase):
+    def setUp(self):
+        self.docker = docker.Docker()
+
+        call_command_patcher = mock.patch.object(docker, "call_command", return_value=True)
+        self.call_command = call_command_patcher.start()
+        self.addCleanup(call_command_patcher.stop)
+
+        get_command_output_patcher = mock.patch.object(docker, "get_command_output", return_value="")
+        self.get_command_output = get_command_output_patcher.start()
+        self.addCleanup(get_command_output_patcher.stop)
+
+    def test_push_tags_pushes_all_tags_at_once_when_they_are_the_local_tags(self):
+        self.get_command_output.return_value = "abc123\nmaster"
+
+        self.assertTrue(self.docker.push_tags("gcr.io/project/image", ["master", "abc123"]))
+        self.call_command.assert_called_once_with(["docker", "push", "--all-tags", "gcr.io/project/image"])
+
+    def test_push_tags_pushes_the_first_tag_then_the_rest_when_there_are_other_local_tags(self):
+        self.get_command_output.return_value = "abc123\nmaster\nlatest\nbuildcache\n<none>"
+
+        self.assertTrue(self.docker.push_tags("gcr.io/project/image", ["abc123", "master", "ctx-def"]))
+        self.assertEqual(
+            self.call_command.call_args_list[0],
+            mock.call(["docker", "push", "gcr.io/project/image:abc123"])
+        )
+        self.assertCountEqual(self.call_command.call_args_list[1:], [
+            mock.call(["docker", "push", "gcr.io/project/image:master"]),
+            mock.call(["docker", "push", "gcr.io/project/image:ctx-def"])
+        ])
+
+    def test_push_tags_stops_when_the_first_push_fails(self):
+        self.call_command.return_value = False
+
+        self.assertFalse(self.docker.push_tags("gcr.io/project/image", ["master", "abc123"]))
+        self.call_command.assert_called_once_with(["docker", "push", "gcr.io/project/image:master"])
+
+    def test_push_tags_fails_when_any_of_the_other_pushes_fail(self):
+        self.call_command.side_effect = lambda command: not command[-1].endswith(":abc123")
+
+        self.assertFalse(self.docker.push_tags("gcr.io/project/image", ["master", "abc123", "ctx-def"]))
+        self.assertEqual(self.call_command.call_count, 3)
+
+    def test_pull_once_only_pulls_each_image_once(self):
+        self.assertTrue(self.docker.pull_once("node:14"))
+        self.assertTrue(self.docker.pull_once("node:14"))
+        self.assertTrue(self.docker.pull_once("python:3"))
+
+        self.assertEqual(self.call_command.call_args_list, [
+            mock.call(["docker", "pull", "node:14"]),
+            mock.call(["docker", "pull", "python:3"])
+        ])
+
+    def test_concurrent_pulls_of_the_same_image_wait_for_the_first_one(self):
+        def slow_pull(command):
+            time.sleep(0.05)
+            return True
+
+        self.call_command.side_effect = slow_pull
+        threads = [threading.Thread(target=self.docker.pull_once, args=("node:14",)) for _ in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.call_command.call_count, 1)
+
+    def test_failed_pulls_are_remembered(self):
+        self.call_command.return_value = False
+
+        self.assertFalse(self.docker.pull_once("node:14"))
+        self.assertFalse(self.docker.pull_once("node:14"))
+        self.assertEqual(self.call_command.call_count, 1)
+
+    def test_pre_pull_pulls_every_distinct_image_with_bounded_concurrency(self):
+        running_pulls = []
+        max_running_pulls = []
+        lock = threading.Lock()
+
+        def pull(command):
+            with lock:
+                running_pulls.append(command)
+                max_running_pulls.append(len(running_pulls))
+
+            time.sleep(0.02)
+
+            with lock:
+                running_pulls.remove(command)
+
+            return True
+
+        self.call_command.side_effect = pull
+        images = ["image-{}".format(index) for index in range(8)]
+
+        self.assertTrue(self.docker.pre_pull(images + images[:2], jobs=2))
+        self.assertEqual(self.call_command.call_count, 8)
+        self.assertLessEqual(max(max_running_pulls), 2)
+
+    def test_remote_digests_are_looked_up_once(self):
+        self.get_command_output.return_value = json.dumps({"Descriptor": {"digest": "sha256:abc"}})
+
+        self.assertEqual(self.docker.get_remote_digest("node:14"), "sha256:abc")
+        self.assertEqual(self.docker.get_remote_digest("node:14"), "sha256:abc")
+        self.assertTrue(self.docker.image_exists_in_registry("node:14"))
+
+        self.assertEqual(self.get_command_output.call_count, 1)
+        self.assertEqual(self.get_command_output.call_args[0][0], ["docker", "manifest", "inspect", "-v", "node:14"])
+
+    def test_missing_images_have_no_remote_digest(self):
+        for output in ["", "no such manifest", "[]"]:
+            self.get_command_output.return_value = output
+            self.docker._remote_digests.clear()
+
+            self.assertEqual(self.docker.get_remote_digest("node:14"), "")
+
+    def test_multi_platform_images_use_the_first_platforms_digest(self):
+        self.get_command_output.return_value = json.dumps([
+            {"Descriptor": {"digest": "sha256:amd64", "platform": {"architecture": "amd64"}}},
+            {"Descriptor": {"digest": "sha256:arm64", "platform": {"architecture": "arm64"}}}
+        ])
+
+        self.assertEqual(self.docker.get_remote_digest("node:14"), "sha256:amd64")
+        self.assertTrue(self.docker.image_exists_in_registry("node:14"))
+
+    def test_up_to_date_images_are_not_pulled(self):
+        outputs = {
+            "manifest": json.dumps({"Descriptor": {"digest": "sha256:abc"}}),
+            "image": json.dumps(["gcr.io/project/image@sha256:abc"])
+        }
+
+        self.get_command_output.side_effect = lambda command, **kwargs: outputs[command[1]]
+
+        self.assertTrue(self.docker.pull_once("gcr.io/project/image:master", check_digest=True))
+        self.call_command.assert_not_called()
+
+        outputs["image"] = json.dumps(["gcr.io/project/image@sha256:old"])
+
+        self.assertTrue(self.docker.pull_if_outdated("gcr.io/project/image:master"))
+        self.call_command.assert_called_once_with(["docker", "pull", "gcr.io/project/image:master"])
+
+    def test_can_get_an_images_tags_in_its_repository(self):
+        self.get_command_output.return_value = json.dumps([
+            "gcr.io/project/image:abc123", "gcr.io/project/image:ctx-def", "gcr.io/project/other:abc123"
+        ])
+
+        self.assertEqual(self.docker.get_image_tags("gcr.io/project/image:abc123"), ["abc123", "ctx-def"])
+
+    def test_can_get_the_external_from_images_of_a_context(self):
+        with tempfile.TemporaryDirectory() as context:
+            with open(os.path.join(context, "Dockerfile"), "w") as file:
+                file.write(
+                    "ARG branch=master\n"
+                    "FROM gcr.io/project/deps:${branch} AS deps\n"
+                    "FROM node:14 AS build\n"
+                    "COPY --from=deps /deps /deps\n"
+                    "FROM build AS final\n"
+                )
+
+            self.assertEqual(
+                sorted(self.docker.get_from_images(context, {"branch": "feature"})),
+                ["gcr.io/project/deps:feature", "node:14"]
+            )
+            self.assertEqual(self.docker.get_from_images(context, target_stage="deps"), ["gcr.io/project/deps:master"])
+
+    def test_contexts_without_a_dockerfile_have_no_from_images(self):
+        with tempfile.TemporaryDirectory() as context:
+            self.assertEqual(self.docker.get_from_images(context), [])
@@ -0,0 +1,27 @@
+import json
+from unittest import mock, TestCase
+from . import gcloud
+
+
+class TestGoogleCloud(TestCase):
+    def setUp(self):
+        self.gcloud = gcloud.GoogleCloud("gcp-project", "region", "zone")
+        self.gcloud.git = mock.Mock()
+
+        get_command_output_patcher = mock.patch.object(gcloud, "get_command_output")
+        self.get_command_output = get_command_output_patcher.start()
+        self.addCleanup(get_command_output_patcher.stop)
+
+    def test_tagged_commits_are_fetched_before_picking_the_last_built_tag(self):
+        self.get_command_output.return_value = json.dumps([{"tags": ["master", "abc1234", "def5678", "latest"]}])
+        self.gcloud.git.get_commit_timestamps.side_effect = lambda tags: {
+            tag: {"abc1234": 100, "def5678": 200}.get(tag, 0) for tag in tags
+        }
+
+        self.assertEqual(self.gcloud._get_last_built_tag("gcr.io/gcp-project/project-frontend"), "def5678")
+        self.gcloud.git.ensure_commits_fetched.assert_called_once_with(["abc1234", "def5678"])
+
+    def test_images_without_tags_have_no_last_built_tag(self):
+        self.get_command_output.return_value = "[]"
+
+        self.assertEqual(self.gcloud._get_last_built_tag("gcr.io/gcp-project/project-frontend"), "")
@@ -0,0 +1,174 @@
+import os
+import subprocess
+import tempfile
+from unittest import mock, TestCase
+from . import git
+
+
+class TestGit(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_dir = os.getcwd()
+        os.chdir(self.temp_dir.name)
+
+        self._git("init", "-q")
+        self.first_commit = self._commit("first", "2020-01-01T00:00:00Z")
+        self.second_commit = self._commit("second", "2021-01-01T00:00:00Z")
+
+        self.git = git.Git()
+
+    def tearDown(self):
+        self.git.batch_session.close()
+        os.chdir(self.original_dir)
+        self.temp_dir.cleanup()
+
+    def test_can_get_many_commit_timestamps_at_once(self):
+        timestamps = self.git.get_commit_timestamps([
+            self.second_commit[:7], "latest", self.first_commit, "ctx-abc123", self.second_commit[:7]
+        ])
+
+        self.assertEqual(timestamps, {
+            self.second_commit[:7]: 1609459200,
+            "latest": 0,
+            self.first_commit: 1577836800,
+            "ctx-abc123": 0
+        })
+
+    def test_batched_timestamps_match_single_timestamps(self):
+        timestamps = self.git.get_commit_timestamps([self.first_commit, self.second_commit])
+
+        for commit in [self.first_commit, self.second_commit]:
+            self.assertEqual(timestamps[commit], self.git.get_commit_timestamp(commit))
+
+    def test_batch_session_falls_back_to_batch_mode_on_old_git_versions(self):
+        with mock.patch.object(git, "BATCH_COMMAND_GIT_VERSION", (99, 0)):
+            self.assertEqual(self.git.get_commit_timestamp(self.first_commit), 1577836800)
+            self.assertEqual(self.git.get_commit_timestamp("latest"), 0)
+            self.assertEqual(self.git.batch_session.info(self.second_commit)[:2], (self.second_commit, "commit"))
+
+        self.assertFalse(self.git.batch_session.supports_batch_command)
+
+    def test_batch_session_is_reused_between_lookups(self):
+        with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen:
+            self.git.get_commit_timestamps([self.first_commit, self.second_commit, "latest"])
+            self.git.get_missing_commits([self.first_commit, "HEAD~5"])
+
+        cat_file_calls = [call for call in popen.call_args_list if "cat-file" in call[0][0]]
+        self.assertEqual(len(cat_file_calls), 1)
+
+    def test_can_compare_folder_trees(self):
+        os.makedirs("services/frontend")
+        os.makedirs("services/backend")
+
+        for path in ["services/frontend/index.js", "services/backend/app.py"]:
+            with open(path, "w") as file:
+                file.write("initial")
+
+        self._git("add", ".")
+        base_commit = self._commit("add services", "2022-01-01T00:00:00Z")
+
+        with open("services/backend/app.py", "w") as file:
+            file.write("changed")
+
+        self._git("add", ".")
+        self._commit("change backend", "2022-01-02T00:00:00Z")
+
+        for folder, changed in [("services/frontend", False), ("services/backend", True)]:
+            tree_changed = self.git.get_tree_id("HEAD", folder) != self.git.get_tree_id(base_commit, folder)
+            self.assertEqual(tree_changed, changed)
+
+        self.assertEqual(self.git.get_tree_id("HEAD", "services/missing"), "")
+
+    def test_folder_trees_are_relative_to_a_project_in_a_subfolder(self):
+        os.makedirs("project/services/frontend")
+
+        with open("project/services/frontend/index.js", "w") as file:
+            file.write("initial")
+
+        self._git("add", ".")
+        self._commit("add project", "2022-01-01T00:00:00Z")
+        os.chdir("project")
+
+        tree_id = self.git.get_tree_id("HEAD", "services/frontend")
+
+        self.assertTrue(tree_id)
+        self.assertEqual(tree_id, self._git("rev-parse", "HEAD:project/services/frontend").strip())
+        self.assertEqual(self.git.get_tree_id("HEAD", "project/services/frontend"), "")
+
+    def test_changed_files_are_relative_to_a_project_in_a_subfolder(self):
+        for path in ["project/services/frontend/index.js", "project/services/frontend/file \"quoted\".js", "other.txt"]:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+            with open(path, "w") as file:
+                file.write("changed")
+
+        self._git("add", ".")
+        self._commit("change files", "2022-01-01T00:00:00Z")
+        os.chdir("project")
+
+        self.assertEqual(
+            sorted(self.git.get_changed_files("HEAD", self.second_commit)),
+            ["services/frontend/file \"quoted\".js", "services/frontend/index.js"]
+        )
+
+    def test_no_commits_have_no_timestamps(self):
+        self.assertEqual(self.git.get_commit_timestamps([]), {})
+
+    def test_shallow_clones_are_deepened_until_commits_are_found(self):
+        for index in range(3):
+            self._commit("commit {}".format(index), "2022-01-0{}T00:00:00Z".format(index + 1))
+
+        self._git("clone", "-q", "--depth=1", "file://{}".format(self.temp_dir.name), "clone")
+        os.chdir("clone")
+
+        self.assertEqual(self.git.get_missing_commits([self.first_commit, "HEAD"]), [self.first_commit])
+
+        with mock.patch.object(git, "DEEPEN_STEPS", [2, 1, 100]):
+            with mock.patch.object(self.git, "fetch", wraps=self.git.fetch) as fetch:
+                self.assertTrue(self.git.ensure_commits_fetched([self.second_commit, "HEAD~"]))
+
+        # Only as much history as was needed was fetched.
+        self.assertEqual(fetch.call_args_list, [mock.call("origin", deepen=2), mock.call("origin", deepen=1)])
+        self.assertTrue(self.git.is_shallow())
+        self.assertEqual(self.git.get_missing_commits([self.first_commit]), [self.first_commit])
+
+    def test_fetching_recent_commits_of_another_branch_keeps_fetched_history(self):
+        for index in range(4):
+            self._commit("commit {}".format(index), "2022-01-0{}T00:00:00Z".format(index + 1))
+
+        self._git("branch", "production", "HEAD~2")
+        production_commits = self._git("log", "--format=%H", "-n", "2", "production").split()
+
+        self._git("clone", "-q", "--depth=1", "--single-branch", "file://{}".format(self.temp_dir.name), "clone")
+        os.chdir("clone")
+
+        self.git.fetch("origin", deepen=3)
+        self.assertEqual(self._git("rev-list", "--count", "HEAD").strip(), "4")
+
+        self.assertEqual(self.git.get_recent_commits("production", 2), production_commits)
+        self.assertGreaterEqual(int(self._git("rev-list", "--count", "HEAD")), 4)
+
+    def test_can_get_remote_heads_without_fetching(self):
+        default_branch = self._git("rev-parse", "--abbrev-ref", "HEAD").strip()
+        self._git("branch", "Feature/Thing")
+
+        self._git("clone", "-q", "--depth=1", "--single-branch", "file://{}".format(self.temp_dir.name), "clone")
+        os.chdir("clone")
+
+        self.assertEqual(self.git.get_remote_heads("origin"), sorted(["feature/thing", default_branch.lower()]))
+
+    def test_unreachable_remotes_have_no_heads(self):
+        self.assertIsNone(self.git.get_remote_heads("file:///nonexistent/repo"))
+
+    def _commit(self, message, date):
+        env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+        self._git(
+            "-c", "user.name=Test", "-c", "user.email=test@example.com",
+            "commit", "-q", "--allow-empty", "-m", message,
+            env=env
+        )
+
+        return self._git("rev-parse", "HEAD").strip()
+
+    def _git(self, *args, env=None):
+        return subprocess.check_output(["git"] + list(args), env=env).decode("utf8")
@@ -1,5 +1,10 @@
+import click
+import json
+import os
+import tempfile
 from parameterized import parameterized
-from unittest import TestCase
+from unittest import mock, TestCase
+from kubails.utils import cache
 from . import terraform
 
 
@@ -8,6 +13,14 @@ class TestTerraform(TestCase):
         self.terraform = terraform.Terraform()
         self.maxDiff = None
 
+        terraform._outputs.clear()
+        self.addCleanup(terraform._outputs.clear)
+
+        self.workspace_backends = []
+        workspace_patcher = mock.patch.object(terraform, "get_workspace_backends", return_value=self.workspace_backends)
+        workspace_patcher.start()
+        self.addCleanup(workspace_patcher.stop)
+
     @parameterized.expand([
         # Case 1: Boolean
         (True, "true"),
@@ -58,3 +71,138 @@ class TestTerraform(TestCase):
     def test_can_not_stringify_value(self):
         with self.assertRaises(ValueError):
             self.terraform._stringify_value(self.terraform)
+
+    def test_outputs_are_fetched_once(self):
+        outputs = {
+            "cluster_name": {"sensitive": False, "type": "string", "value": "cluster"},
+            "dns_name_servers": {"sensitive": False, "type": ["list", "string"], "value": ["ns1.", "ns2."]}
+        }
+
+        with mock.patch.object(self.terraform, "_run_terraform_command", return_value=json.dumps(outputs)) as run:
+            self.assertEqual(self.terraform.get_cluster_name(), "cluster")
+            self.assertEqual(json.loads(self.terraform.get_name_servers()), ["ns1.", "ns2."])
+            self.assertEqual(terraform.Terraform().get_cluster_name(), "cluster")
+
+        run.assert_called_once_with(["terraform", "output", "-json"], terraform.get_command_output)
+
+    def test_outputs_are_refetched_after_running_commands(self):
+        first_outputs = json.dumps({"cluster_name": {"sensitive": False, "type": "string", "value": "old"}})
+        second_outputs = json.dumps({"cluster_name": {"sensitive": False, "type": "string", "value": "new"}})
+
+        results = [first_outputs, True, second_outputs]
+
+        with mock.patch.object(self.terraform, "_run_terraform_command", side_effect=results):
+            self.assertEqual(self.terraform.get_cluster_name(), "old")
+            self.terraform.run_command("apply")
+            self.assertEqual(self.terraform.get_cluster_name(), "new")
+
+    @parameterized.expand([
+        [""],
+        ["{}"],
+        ["not json"],
+    ])
+    def test_missing_outputs_abort_and_are_not_memoized(self, result):
+        with mock.patch.object(self.terraform, "_run_terraform_command", return_value=result):
+            with self.assertRaises(click.Abort):
+                self.terraform.get_cluster_name()
+
+        self.assertEqual(terraform._outputs, {})
+
+    def test_variables_are_written_to_var_file_only_when_changed(self):
+        with tempfile.TemporaryDirectory() as root_folder:
+            os.makedirs(os.path.join(root_folder, terraform.TERRAFORM_FOLDER))
+            var_file_path = os.path.join(root_folder, terraform.TERRAFORM_FOLDER, terraform.VAR_FILE_NAME)
+
+            variables = {"__project_name": "project", "cluster_preemptible": True, "__services": ["a", None]}
+            tf = terraform.Terraform(variables, root_folder=root_folder)
+
+            self.assertTrue(tf._write_var_file(variables))
+            self.assertFalse(tf._write_var_file(variables))
+
+            with open(var_file_path, "r") as file:
+                self.assertEqual(
+                    json.load(file),
+                    {"__project_name": "project", "cluster_preemptible": True, "__services": ["a", ""]}
+                )
+
+            self.assertTrue(tf._write_var_file(dict(variables, __project_name="other")))
+
+    @parameterized.expand([
+        [True, ["terraform", "apply", "-var-file=kubails.tfvars.json"], None],
+        [False, ["terraform", "apply"], {"TF_VAR_key": "value"}],
+    ])
+    def test_variables_are_passed_by_var_file_or_env(self, use_var_file, expected_command, expected_env_vars):
+        tf = terraform.Terraform({"key": "value"}, use_var_file=use_var_file)
+
+        with mock.patch.object(tf, "_write_var_file") as write_var_file:
+            with mock.patch.object(tf, "_run_terraform_command") as run:
+                tf.run_command("apply")
+
+        self.assertEqual(write_var_file.called, use_var_file)
+        run.assert_called_once_with(expected_command, env_vars=expected_env_vars)
+
+    def test_var_file_comes_before_positional_arguments(self):
+        tf = terraform.Terraform({"key": "value"}, use_var_file=True)
+
+        with mock.patch.object(tf, "_write_var_file"):
+            with mock.patch.object(tf, "_run_terraform_command") as run:
+                tf.run_command("import", ["google_dns_managed_zone.zone", "project/zone"])
+
+        run.assert_called_once_with(
+            ["terraform", "import", "-var-file=kubails.tfvars.json", "google_dns_managed_zone.zone", "project/zone"],
+            env_vars=None
+        )
+
+    def test_commands_without_vars_leave_no_var_file_for_terraform_to_load(self):
+        with tempfile.TemporaryDirectory() as root_folder:
+            terraform_folder = os.path.join(root_folder, terraform.TERRAFORM_FOLDER)
+            os.makedirs(terraform_folder)
+
+            tf = terraform.Terraform({"key": "value"}, root_folder=root_folder)
+
+            with mock.patch.object(tf, "_run_terraform_command") as run:
+                tf.run_command("apply")
+                tf.run_command("plan", with_vars=False)
+
+            run.assert_called_with(["terraform", "plan"], env_vars=None)
+
+            # Terraform only loads 'terraform.tfvars(.json)' and '*.auto.tfvars(.json)' on its own.
+            self.assertEqual(os.listdir(terraform_folder), [terraform.VAR_FILE_NAME])
+            self.assertNotIn(".auto.", terraform.VAR_FILE_NAME)
+            self.assertFalse(terraform.VAR_FILE_NAME.startswith("terraform.tfvars"))
+
+    def test_outputs_with_sensitive_values_are_not_saved_to_the_build(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.workspace_backends.append(cache.DirectoryBackend(temp_dir.name))
+
+        outputs = {
+            "cluster_name": {"sensitive": False, "type": "string", "value": "cluster"},
+            "secrets_key_name": {"sensitive": True, "type": "string", "value": "key"}
+        }
+
+        with mock.patch.object(self.terraform, "_run_terraform_command", return_value=json.dumps(outputs)) as run:
+            self.assertEqual(self.terraform.get_cluster_name(), "cluster")
+
+            # i.e. a later step of the same build
+            terraform._outputs.clear()
+            self.assertEqual(self.terraform.get_kms_key_name(), "key")
+
+        self.assertEqual(run.call_count, 2)
+
+    def test_outputs_are_refetched_when_saved_outputs_are_missing_one(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.workspace_backends.append(cache.DirectoryBackend(temp_dir.name))
+
+        saved_outputs = {"cluster_name": {"sensitive": False, "type": "string", "value": "cluster"}}
+        self.terraform._get_outputs_cache().set(saved_outputs, os.path.abspath(self.terraform.root_folder))
+
+        outputs = dict(saved_outputs, ingress_ip={"sensitive": False, "type": "string", "value": "1.2.3.4"})
+
+        with mock.patch.object(self.terraform, "_run_terraform_command", return_value=json.dumps(outputs)) as run:
+            self.assertEqual(self.terraform.get_cluster_name(), "cluster")
+            self.assertEqual(run.call_count, 0)
+
+            self.assertEqual(self.terraform.get_public_ip(), "1.2.3.4")
+            self.assertEqual(run.call_count, 1)
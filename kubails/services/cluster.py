@@ -6,6 +6,7 @@ from dotenv import dotenv_values
 from typing import List
 from kubails.external_services import dependency_checker, gcloud, helm, kubectl, terraform
 from kubails.services import config_store, manifest_manager
+from kubails.utils.cache import Cache, get_workspace_backends
 from kubails.utils.service_helpers import call_command, sanitize_name
 
 
@@ -199,15 +200,17 @@ class Cluster:
         logger.info("Created {} and updated kubails.json with secrets info.".format(encrypted_file))
 
     def is_new_namespace(self, namespace: str) -> bool:
-        def callback() -> str:
+        def callback() -> bool:
             sanitized_namespace = sanitize_name(namespace)
             namespaces = self.kubectl.get_namespaces()
 
-            return "True" if sanitized_namespace not in namespaces else "False"
+            return sanitized_namespace not in namespaces
 
         # Need to use Cloud Build caching because there might be steps in Cloud Build that happen after the
         # namespace ends up being created but that still rely on knowing whether or not the namespace is new.
-        return self.gcloud.cache_in_cloud_build("is_new_namespace.txt", callback) == "True"
+        new_namespaces = Cache("new-namespaces", backends=get_workspace_backends())
+
+        return new_namespaces.get_or_compute(callback, self.config.gcp_project_id, namespace)
 
     def _deploy_storage_classes(self) -> None:
         storage_class_manifests = self.manifest_manager.static_manifest_location("storage-classes")
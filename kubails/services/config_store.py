@@ -5,8 +5,10 @@ import os
 import operator
 import traceback
 from functools import reduce
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Set, Union  # noqa
 from kubails.external_services import gcloud, git
+from kubails.utils.cache import Cache, get_workspace_backends, hash_inputs
+from kubails.utils.path_trie import PathTrie
 
 
 logger = logging.getLogger(__name__)
@@ -14,6 +16,9 @@ logger = logging.getLogger(__name__)
 CONFIG_FILE_NAME = "kubails.json"
 SERVICES_FOLDER = "services"
 
+# The service config keys that determine which paths a service watches for changes (see `get_watched_paths`).
+WATCHED_PATHS_KEYS = ["watch_paths", "depends_on_services"]
+
 
 # See the definition of ConfigStore at the bottom of the file for why this has an underscore.
 # tl;dr It's a singleton.
@@ -122,17 +127,29 @@ class _ConfigStore(object):
         return self.services.get(service, {}).get("folder", service)
 
     def get_changed_services(self, current_branch: str) -> List[str]:
-        def callback() -> str:
-            # Need to convert the list to a string for caching.
-            return ",".join(self._get_service_names_with_changes(current_branch))
+        def callback() -> List[str]:
+            return self._get_service_names_with_changes(current_branch)
 
         # Leverage Cloud Build caching so that the changed services don't need to be re-computed every step.
-        return self.gcloud.cache_in_cloud_build("changed_services.txt", callback).split(",")
+        # The result depends on the branch, the commit being built, and the services' config.
+        changed_services = Cache("changed-services", backends=get_workspace_backends())
+
+        return changed_services.get_or_compute(
+            callback,
+            current_branch,
+            self.git.get_commit_sha("HEAD"),
+            hash_inputs(self.services)
+        )
 
     def use_changed_services(self, current_branch: str) -> None:
         service_names = self.get_changed_services(current_branch)
         logger.info("Using only changed services: {}".format(service_names))
 
+        # Keep track of the services that got filtered out, since they still need their images promoted.
+        self.unchanged_services_with_code = [
+            s for s in self.services_with_code if s not in service_names
+        ]  # type: List[str]
+
         self.services = filter_dict(self.services, service_names)  # type: Dict[str, Dict[str, Any]]
         self.services_with_code = filter_dict(self.services_with_code, service_names)  # type: Dict[str, Dict[str, Any]]
 
@@ -227,8 +244,10 @@ class _ConfigStore(object):
         self.project_iam_admin_role = "roles/resourcemanager.projectIamAdmin"
 
         self.services = config.get("__services", {})  # type: Dict[str, Dict[str, Any]]
+        self._validate_watched_paths(self.services)
         self.services_with_code = self._parse_services_with_code(self.services)
         self.services_with_secrets = self._parse_services_with_secrets(self.services)
+        self.unchanged_services_with_code = []
 
         self.domain = config.get("__domain")
 
@@ -252,6 +271,22 @@ class _ConfigStore(object):
 
         return flattened_config
 
+    def _validate_watched_paths(self, services: Dict[str, Dict[str, Any]]) -> None:
+        """Makes sure that every service's `watch_paths` and `depends_on_services` are lists of strings."""
+        if not isinstance(services, dict):
+            return
+
+        for service, service_config in services.items():
+            for key in WATCHED_PATHS_KEYS:
+                value = service_config.get(key, [])
+
+                if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                    logger.error("Invalid {} for service {}: it must be a list of strings, not '{}'.".format(
+                        key, service, value
+                    ))
+
+                    raise click.Abort()
+
     def _parse_services_with_code(self, services: Dict[str, Any]) -> Dict[str, Any]:
         if isinstance(services, dict):
             return {k: v for k, v in services.items() if "folder" not in v or v.get("folder")}
@@ -266,46 +301,142 @@ class _ConfigStore(object):
 
     def _get_service_names_with_changes(self, current_branch: str) -> List[str]:
         services = self.services
-        services_with_changes = []
 
-        if isinstance(services, dict):
-            for service in services:
-                folder = services[service].get("folder", None)
-
-                fixed_tag = services[service].get("fixed_tag", None)
-
-                # When checking for changes on the production branch, we actually need to compare
-                # the service against the previous on the production branch, rather than the latest
-                # tag on the image. Why? Because the latest (commit) tag on the image will have been
-                # removed from the (remote) repo as part of our "delete branch after merging PR" workflow.
-                #
-                # As such, whatever tag we pull will be invalid.
-                #
-                # Not to mention that, since we use squash merges with the production branch, it only
-                # makes sense to compare the latest squashed commit vs the last squashed commit.
-                #
-                # Obviously, this assumption breaks down for any git workflow that doesn't use squash merges.
-                if current_branch == self.production_namespace and not fixed_tag:
-                    tag = "{}~".format(self.production_namespace)
-                else:
-                    tag = self.gcloud.get_last_built_tag_for_service(self.project_name, service)
-
-                if folder and tag:
-                    if (
-                        # If the service has a fixed tag, then we'll never actually know if it has changed
-                        # or not, because we don't have old commit tags to cache bust on.
-                        #
-                        # As such, just always include them.
-                        (fixed_tag and tag == fixed_tag) or
-                        # Otherwise, use our magic function for determining whether the service changed.
-                        self.git.folder_changed(os.path.join(SERVICES_FOLDER, folder), current_branch, tag)
-                    ):
-                        services_with_changes.append(service)
-
-            return services_with_changes
-        else:
+        if not isinstance(services, dict):
             return []
 
+        services_with_changes = []
+
+        # Maps each service to the commit that it needs to be compared against.
+        base_commits = {}  # type: Dict[str, str]
+
+        # Look up the last built tags of all of the services at once, rather than one at a time.
+        last_built_tags = self.gcloud.get_last_built_tags_for_services(self.project_name, [
+            service for service in services
+            if services[service].get("fixed_tag", None) or current_branch != self.production_namespace
+        ])
+
+        for service in services:
+            folder = services[service].get("folder", None)
+
+            fixed_tag = services[service].get("fixed_tag", None)
+
+            # When checking for changes on the production branch, we actually need to compare
+            # the service against the previous on the production branch, rather than the latest
+            # tag on the image. Why? Because the latest (commit) tag on the image will have been
+            # removed from the (remote) repo as part of our "delete branch after merging PR" workflow.
+            #
+            # As such, whatever tag we pull will be invalid.
+            #
+            # Not to mention that, since we use squash merges with the production branch, it only
+            # makes sense to compare the latest squashed commit vs the last squashed commit.
+            #
+            # Obviously, this assumption breaks down for any git workflow that doesn't use squash merges.
+            if current_branch == self.production_namespace and not fixed_tag:
+                tag = "{}~".format(self.production_namespace)
+            else:
+                tag = last_built_tags[service]
+
+            if not folder or not tag:
+                continue
+
+            # If the service has a fixed tag, then we'll never actually know if it has changed
+            # or not, because we don't have old commit tags to cache bust on.
+            #
+            # As such, just always include them.
+            if fixed_tag and tag == fixed_tag:
+                services_with_changes.append(service)
+            else:
+                base_commits[service] = tag
+
+        if base_commits:
+            services_with_changes.extend(self._get_services_changed_since(current_branch, base_commits))
+
+        # Keep the services in the same order as the config.
+        return [service for service in services if service in services_with_changes]
+
+    def _get_services_changed_since(self, current_branch: str, base_commits: Dict[str, str]) -> List[str]:
+        """
+        Determines which services changed between the current branch and each service's base commit.
+
+        Rather than diffing each service's folder separately, the history is fetched once and then each
+        distinct base commit (usually there's only one or two) is diffed once; the changed paths are then
+        mapped back to the services that watch them (see `get_watched_paths`).
+        """
+        self.git.prepare_diff(current_branch, sorted(set(base_commits.values())))
+
+        service_folders = PathTrie()
+
+        for service in base_commits:
+            for path in self.get_watched_paths(service):
+                service_folders.insert(path, service)
+
+        changed_services = []
+
+        for base_commit in sorted(set(base_commits.values())):
+            services_to_check = [service for service, commit in base_commits.items() if commit == base_commit]
+            changed_files = self.git.get_changed_files(current_branch, base_commit)
+
+            # If the diff failed (e.g. the base commit doesn't exist anymore), then there's no telling
+            # what changed, so it's safest to assume that everything did.
+            if changed_files is None:
+                logger.warning("Couldn't diff against {}; assuming {} changed.".format(
+                    base_commit, ", ".join(services_to_check)
+                ))
+
+                changed_services.extend(services_to_check)
+                continue
+
+            services_with_changed_files = set()  # type: Set[str]
+
+            for path in changed_files:
+                services_with_changed_files.update(service_folders.find_containing(path))
+
+            changed_services.extend(service for service in services_to_check if service in services_with_changed_files)
+
+        return changed_services
+
+    def get_watched_paths(self, service: str) -> List[str]:
+        """
+        Gets the paths (relative to the project) that a change to means the service has changed.
+
+        These are the service's folder and its `watch_paths` (e.g. shared code like 'services/common',
+        proto files, or the helm chart), plus the watched paths of every service it `depends_on_services`
+        (and every service that those depend on, and so on).
+
+        For example, given the following config:
+
+            "frontend": {"folder": "frontend", "depends_on_services": ["backend"]},
+            "backend": {"folder": "backend", "watch_paths": ["services/common"]}
+
+        the frontend watches 'services/frontend', 'services/backend', and 'services/common'.
+        """
+        watched_paths = []  # type: List[str]
+        visited_services = set()  # type: Set[str]
+        services_to_visit = [service]
+
+        while services_to_visit:
+            current_service = services_to_visit.pop()
+
+            if current_service in visited_services:
+                continue
+
+            visited_services.add(current_service)
+
+            if current_service not in self.services:
+                logger.warning("{} depends on unknown service '{}'.".format(service, current_service))
+                continue
+
+            service_config = self.services[current_service]
+
+            if service_config.get("folder"):
+                watched_paths.append(os.path.join(SERVICES_FOLDER, service_config["folder"]))
+
+            watched_paths.extend(service_config.get("watch_paths", []))
+            services_to_visit.extend(service_config.get("depends_on_services", []))
+
+        return watched_paths
+
 
 # This is how we turn ConfigStore into a singleton: by tricking the end-developer into thinking
 # this function call of "ConfigStore" is a class definition. We just store the singleton instance
@@ -15,12 +15,15 @@ class KubeGitSyncer:
         self.kubectl = kubectl.Kubectl()
 
     def cleanup_namespaces(self) -> bool:
-        # Fetch and prune the branches so that the current repo copy is in
-        # sync with the branches on origin
-        self.git.fetch("origin", prune=True)
-        self.git.fetch("origin", prune=True, unshallow=True)
+        # Ask origin for its branches directly, rather than fetching (let alone unshallowing) the repo
+        # just to get the current repo copy in sync with the branches on origin.
+        remote_branches = self.git.get_remote_heads("origin")
+
+        # Every namespace would look unused if the branches couldn't be listed, so don't delete anything.
+        if not remote_branches:
+            logger.error("Couldn't get any branches from origin; not cleaning up any namespaces.")
+            return False
 
-        remote_branches = self.git.get_remote_branches()
         existing_namespaces = self.kubectl.get_namespaces(["kube-git-syncer=true"])
 
         unused_namespaces = _get_unused_namespaces(remote_branches, existing_namespaces)
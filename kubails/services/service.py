@@ -1,16 +1,66 @@
+import click
+import hashlib
+import json
 import logging
 import os
-from typing import Callable, Dict, List
-from kubails.external_services import dependency_checker, docker, docker_compose, gcloud
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+from kubails.external_services import dependency_checker, docker, docker_compose, gcloud, git
 from kubails.services import config_store, manifest_manager, templater
 from kubails.resources.templates import ConfigGenerator, SERVICES_CONFIG
-from kubails.utils.service_helpers import call_command, sanitize_name
+from kubails.utils.build_context import DOCKERFILE, hash_build_context, hash_folder
+from kubails.utils.build_telemetry import BuildTelemetry, summarize_steps
+from kubails.utils.cache import CACHE_BUCKET_ENV_VARIABLE, CLOUD_BUILD_FOLDER, Cache, get_workspace_backends
+from kubails.utils.image_size import format_size, get_budget_violations, parse_size, summarize_image
+from kubails.utils.service_helpers import call_command, capture_command, run_concurrently, sanitize_name
+from kubails.utils.sharding import shard_by_duration
 
 
 logger = logging.getLogger(__name__)
 
 SERVICES_FOLDER = config_store.SERVICES_FOLDER
 
+# Images are tagged with a hash of their build context (prefixed by this) so that unchanged builds can be skipped.
+CONTEXT_TAG_PREFIX = "ctx-"
+
+# The cache sources used when a service doesn't configure its own `cache_sources`.
+DEFAULT_CACHE_SOURCES = ["branch", "latest"]
+
+# The ways that images can be pushed:
+# - "push" pushes every tag with Docker.
+# - "retag" pushes each image once (or not at all, if its digest is already in the registry)
+#   and then adds the rest of its tags in the registry itself.
+PUSH_STRATEGIES = ["push", "retag"]
+
+# Commit tags are the short SHAs that Cloud Build provides (i.e. ${SHORT_SHA}).
+SHORT_SHA_LENGTH = 7
+
+# The per-service (and per-stage) build telemetry of a build.
+BUILD_REPORT_FILE = "build-report.json"
+
+# The machine-readable summary of a `--bake` build.
+BAKE_SUMMARY_FILE = "bake-summary.json"
+
+# The cache namespace for the records of services that passed `make test` or `make ci`.
+TEST_RESULTS_CACHE_NAMESPACE = "test-results"
+
+# The cache namespace for the (smoothed) durations of each service's make targets, used for sharding.
+DURATIONS_CACHE_NAMESPACE = "durations"
+
+# How much of a service's previous duration carries over when recording a new one.
+DURATION_HISTORY_WEIGHT = 0.5
+
+# The cache namespace for the service shards of a Cloud Build build.
+SHARD_PLANS_CACHE_NAMESPACE = "shard-plans"
+
+# What to do when a service's image is over its `image_size_budget`.
+IMAGE_SIZE_BUDGET_ACTIONS = ["warn", "fail"]
+
+# Services that use a registry cache store it in their image's repository, under a tag prefixed by this.
+REGISTRY_CACHE_TAG_PREFIX = "buildcache-"
+
 DEFAULT_KUBAILS_SERVICE_CONFIG = {
     "container_port": "",
     "env": [],
@@ -48,6 +98,8 @@ class Service:
             self.config.gcp_project_zone
         )
 
+        self.git = git.Git()
+
         self.manifest_manager = manifest_manager.ManifestManager(
             manifests_folder=self.config.get_project_path("manifests")
         )
@@ -66,89 +118,277 @@ class Service:
 
         self.docker_compose.down()
 
-    def lint(self, services: List[str], tag: str) -> bool:
-        return self._run_services_make_command("lint", services, tag)
+    def lint(self, services: List[str], tag: str, jobs: int = 1, keep_going: bool = False) -> bool:
+        return self._run_services_make_command("lint", services, tag, jobs=jobs, keep_going=keep_going)
 
-    def test(self, services: List[str], tag: str) -> bool:
-        return self._run_services_make_command("test", services, tag)
+    def test(
+        self,
+        services: List[str],
+        tag: str,
+        jobs: int = 1,
+        keep_going: bool = False,
+        use_cache: bool = True
+    ) -> bool:
+        return self._run_services_make_command(
+            "test", services, tag, jobs=jobs, keep_going=keep_going, use_cache=use_cache
+        )
 
-    def ci(self, services: List[str], tag: str) -> bool:
-        return self._run_services_make_command("ci", services, tag)
+    def ci(
+        self,
+        services: List[str],
+        tag: str,
+        jobs: int = 1,
+        keep_going: bool = False,
+        use_cache: bool = True,
+        shard: Tuple[int, int] = None
+    ) -> bool:
+        if shard:
+            services = self._get_shard_services("ci", services, shard)
+
+            if not services:
+                logger.info("No services in shard {}/{}.".format(*shard))
+                return True
+
+        return self._run_services_make_command(
+            "ci", services, tag, jobs=jobs, keep_going=keep_going, use_cache=use_cache
+        )
 
     def make(self, command: str) -> bool:
         """Run a make command across all of the services."""
         return self._run_services_make_command(command)
 
-    def build(self, services: List[str], branch_tag: str = None, commit_tag: str = None) -> bool:
+    def build(
+        self,
+        services: List[str],
+        branch_tag: str = None,
+        commit_tag: str = None,
+        jobs: int = 1,
+        pull_cache_images: bool = True,
+        skip_unchanged: bool = False,
+        bake: bool = False
+    ) -> bool:
         branch_tag = sanitize_name(branch_tag)
+        services_iterable = services if services else list(self.config.services_with_code)
 
-        def build_function(service: str) -> bool:
-            service_path = self._get_service_path(service)
-            fixed_tag = self._get_fixed_tag(service)
-            base_images = self._get_base_images(service)
+        # Check the budgets now, rather than only finding out that one is invalid after the image has been built.
+        for service in services_iterable:
+            self._get_image_size_budget(service)
 
-            stage_images = []  # type: List[str]
-            result = True
+        build_steps = {
+            service: self._get_build_steps(service, branch_tag, commit_tag, with_context_tag=skip_unchanged)
+            for service in services_iterable
+        }
 
-            for index, base_image in enumerate(base_images):
-                is_last_image = index == len(base_images) - 1
-                tagged_images = self._generate_tagged_images(base_image, branch_tag, commit_tag, fixed_tag=fixed_tag)
+        self._drop_missing_cache_sources(build_steps)
 
-                if not branch_tag and not commit_tag:  # Local dev use case
-                    result = result and self.docker.build(service_path, [tagged_images["latest"]])
-                else:  # CI/CD pipeline use case
-                    cache_image = tagged_images["fixed_tag"] if fixed_tag else tagged_images["branch"]
+        # Any service whose build context hasn't changed since it was last built (on any branch) doesn't
+        # need to be built again; its existing image just needs to be re-tagged.
+        unchanged_services = [
+            service for service, steps in build_steps.items()
+            if skip_unchanged and self._is_build_context_unchanged(steps)
+        ]
 
-                    # Each previous stage image is used to build the next stage.
-                    cache_images = stage_images + [cache_image, tagged_images["latest"]]
-                    stage_images.append(tagged_images["commit"])
+        # Pull every distinct FROM and cache image up front (and all at once), rather than pulling
+        # them one by one (and over and over again, for shared base images) as part of each build.
+        #
+        # Since we build with BuildKit's inline cache, the cache images don't strictly need to be pulled:
+        # BuildKit can read the cache metadata straight from the registry and only fetch the layers it reuses.
+        images_to_pull = []  # type: List[str]
+        cache_images_to_pull = []  # type: List[str]
+
+        for service, steps in build_steps.items():
+            if service in unchanged_services:
+                images_to_pull.extend([step["context_image"] for step in steps])
+                continue
+
+            # Registry cache builds run in their own BuildKit container, which pulls whatever it needs itself.
+            if any(step.get("registry_cache_to") for step in steps):
+                continue
+
+            for step in steps:
+                images_to_pull.extend(self.docker.get_from_images(
+                    self._get_service_path(service),
+                    {"branch": branch_tag} if branch_tag else {},
+                    step["target_stage"]
+                ))
+
+            if pull_cache_images:
+                for step in steps:
+                    cache_images_to_pull.extend(step["remote_cache_images"])
+
+        # Pulls are limited by bandwidth rather than by how many builds run at once,
+        # so they always use the Docker wrapper's own (fixed) concurrency.
+        self.docker.pre_pull(images_to_pull, cache_images=cache_images_to_pull)
+
+        build_report = {}  # type: Dict[str, Dict[str, Any]]
+
+        if bake:
+            baked_steps = {s: steps for s, steps in build_steps.items() if s not in unchanged_services}
+            bake_result = self._build_with_bake(baked_steps, branch_tag)
+            result = bake_result
+
+            for service in unchanged_services:
+                build_report[service] = {"skipped": True}
+                result = self._retag_unchanged_build(service, build_steps[service]) and result
+
+            # Bake only reports on the build as a whole (in the bake summary), so there's no per-step telemetry
+            # for each service; just its result and the size of its final image.
+            for service, steps in baked_steps.items():
+                build_report[service] = {"baked": True, "result": bake_result}
+
+                if bake_result:
+                    image_report, image_result = self._report_image_size(service, steps[-1]["tags"][0])
+                    build_report[service].update({"image": image_report, "result": image_result})
+                    result = image_result and result
+
+            self._write_build_report(build_report)
+
+            return result
+
+        # Each service's stages are built in order (since each stage is the cache for the next one),
+        # but separate services don't depend on each other, so they can be built concurrently.
+
+        def build_function(service: str) -> bool:
+            if service in unchanged_services:
+                build_report[service] = {"skipped": True}
+                return self._retag_unchanged_build(service, build_steps[service])
+
+            service_path = self._get_service_path(service)
+            stage_summaries = []
+            result = True
 
-                    # If we're on the last image, then that means it's the final stage and
-                    # we don't need to specify a target stage.
-                    # Otherwise, each previous stage needs to specify a target in the Dockerfile to be
-                    # built (and pushed) separately.
-                    target_stage = None if is_last_image else base_image
+            for step in build_steps[service]:
+                telemetry = BuildTelemetry()
 
-                    result = result and self.docker.build(
+                if step.get("registry_cache_to"):
+                    result = self.docker.build_with_registry_cache(
+                        service_path,
+                        step["tags"],
+                        cache_from=step["registry_cache_from"],
+                        cache_to=step["registry_cache_to"],
+                        branch=branch_tag,
+                        line_callback=telemetry.parse_line
+                    )
+                else:
+                    result = self.docker.build(
                         service_path,
-                        list(tagged_images.values()),
-                        target_stage=target_stage,
-                        cache_images=cache_images,
-                        branch=branch_tag
+                        step["tags"],
+                        target_stage=step["target_stage"],
+                        cache_images=step["cache_images"],
+                        branch=branch_tag,
+                        # The remote cache images have already been pulled and the rest were built locally.
+                        pull_cache_images=False,
+                        line_callback=telemetry.parse_line
                     )
 
+                telemetry.finish()
+
+                stage_summary = telemetry.summary()
+                stage_summary.update({"stage": step["target_stage"] or "final", "result": result})
+                stage_summaries.append(stage_summary)
+
+                if not result:
+                    break
+
+                # Only CI builds use (remote) cache sources; local builds and registry cache builds don't.
+                if self._has_cache_sources(service) and step["remote_cache_images"]:
+                    stage_summary["cache_hits"] = self._report_cache_hits(service, step)
+
+            build_report[service] = summarize_steps(stage_summaries)
+
+            if result:
+                # The final step builds the service's final image, which is what actually gets deployed.
+                image_report, result = self._report_image_size(service, build_steps[service][-1]["tags"][0])
+                build_report[service]["image"] = image_report
+
+            build_report[service]["result"] = result
+
             return result
 
-        return self._apply_to_services(build_function, services)
+        result = self._apply_to_services(build_function, services, jobs=jobs)
+        self._write_build_report(build_report)
+
+        return result
+
+    def push(
+        self,
+        services: List[str],
+        branch_tag: str = None,
+        commit_tag: str = None,
+        jobs: int = 1,
+        strategy: str = "push"
+    ) -> bool:
+        branch_tag = sanitize_name(branch_tag)
+        services_iterable = services if services else list(self.config.services_with_code)
 
-    def push(self, services: List[str], branch_tag: str = None, commit_tag: str = None) -> bool:
+        # Maps each image repository to the tags that need to be pushed for it.
+        images_to_push = {}  # type: Dict[str, List[str]]
+
+        for service in services_iterable:
+            images_to_push.update(self._get_images_to_push(service, branch_tag, commit_tag))
+
+        def push_function(repository: str) -> bool:
+            if strategy == "retag":
+                return self._push_and_retag(repository, images_to_push[repository])
+
+            return self.docker.push_tags(repository, images_to_push[repository])
+
+        if jobs <= 1:
+            for repository in images_to_push:
+                if not push_function(repository):
+                    return False  # Fail fast to optimize the CI/CD pipeline
+
+            return True
+
+        results = run_concurrently(push_function, list(images_to_push), jobs=jobs)
+
+        print()
+        logger.info("Push results:")
+
+        for repository, result in results.items():
+            logger.info("{} {} ({})".format(
+                "OK    " if result else "FAILED", repository, ", ".join(images_to_push[repository])
+            ))
+
+        return all(results.values())
+
+    def promote(self, services: List[str], branch_tag: str = None, commit_tag: str = None) -> bool:
+        """
+        Tags the last built images of services that weren't built for this commit (i.e. the services filtered
+        out by `--only-changed-services`) with the current branch and commit, entirely in the registry.
+
+        This way, every service has an image for the commit that its deployment gets tagged with.
+        """
         branch_tag = sanitize_name(branch_tag)
+        services_to_promote = services if services else self.config.unchanged_services_with_code
 
-        def push_function(service: str) -> bool:
-            fixed_tag = self._get_fixed_tag(service)
-            base_images = self._get_base_images(service)
+        if not services_to_promote:
+            logger.info("No unchanged services to promote.")
+            return True
 
+        def promote_function(service: str) -> bool:
             result = True
 
-            for base_image in base_images:
-                tagged_images = self._generate_tagged_images(base_image, branch_tag, commit_tag, fixed_tag=fixed_tag)
+            for base_image in self._get_built_images(service):
+                last_built_tag = self.gcloud.get_last_built_tag_for_service(self.config.project_name, base_image)
 
-                if not branch_tag and not commit_tag:  # Local dev use case
-                    result = result and self.docker.push(tagged_images["latest"])
-                else:  # CI/CD pipeline use case
+                if not last_built_tag:
+                    logger.error("{} has no previously built image to promote.".format(base_image))
+                    result = False
+                    continue
 
-                    if fixed_tag:
-                        result = result and self.docker.push(tagged_images["fixed_tag"])
-                    else:
-                        result = result and self.docker.push(tagged_images["branch"])
-                        result = result and self.docker.push(tagged_images["commit"])
+                source_image = self.gcloud.format_gcr_image(self.config.project_name, base_image, last_built_tag)
+                target_images = [
+                    self.gcloud.format_gcr_image(self.config.project_name, base_image, tag)
+                    for tag in [commit_tag, branch_tag] if tag and tag != last_built_tag
+                ]
 
-                        if branch_tag == self.config.production_namespace:
-                            result = result and self.docker.push(tagged_images["latest"])
+                logger.info("Promoting {} to {}".format(source_image, ", ".join(target_images)))
+                result = self.gcloud.add_image_tags(source_image, target_images) and result
 
             return result
 
-        return self._apply_to_services(push_function, services)
+        return self._apply_to_services(promote_function, services_to_promote)
 
     def generate(
         self,
@@ -171,10 +411,50 @@ class Service:
         if config_generator.is_external_service():
             self._update_wildcard_certificate()
 
-    def _run_services_make_command(self, command: str, services: List[str] = [], tag: str = "") -> bool:
+    def _run_services_make_command(
+        self,
+        command: str,
+        services: List[str] = [],
+        tag: str = "",
+        jobs: int = 1,
+        keep_going: bool = False,
+        use_cache: bool = False
+    ) -> bool:
+        """
+        Runs a make command for each of the services (up to `jobs` at once) and then logs a summary
+        of how long each service took and whether it passed.
+
+        When `use_cache` is set, a record is kept of each service (i.e. a hash of its contents) that passed,
+        and a service that already passed with the exact same contents is skipped.
+
+        When running services concurrently, each service's output is buffered and printed all together
+        (with every line prefixed by the service's name) once it finishes, so that the outputs don't get mixed up.
+
+        Unless `keep_going` is set, the services that haven't started yet are skipped after the first failure.
+        """
         tag = sanitize_name(tag)
+        services_iterable = list(services if services else self.config.services_with_code)
+        prefix_width = max([len(service) for service in services_iterable], default=0)
+
+        # Maps each service to its result ("PASS", "FAIL", or "SKIPPED") and its duration.
+        results = {}  # type: Dict[str, Tuple[str, float]]
+        output_lock = threading.Lock()
+        failed = threading.Event()
+        test_results = Cache(TEST_RESULTS_CACHE_NAMESPACE)
+        duration_history = Cache(DURATIONS_CACHE_NAMESPACE)
 
         def function(service: str) -> bool:
+            if failed.is_set() and not keep_going:
+                results[service] = ("SKIPPED", 0.0)
+                return False
+
+            cache_key = self._get_test_result_key(service, command, tag) if use_cache else ""
+
+            if cache_key and test_results.get(cache_key):
+                logger.info("{} already passed 'make {}' with the same contents; skipping.".format(service, command))
+                results[service] = ("CACHED", 0.0)
+                return True
+
             base_image = self._get_base_images(service)[-1]
 
             cache_image = self.gcloud.format_gcr_image(self.config.project_name, base_image, tag)
@@ -184,15 +464,148 @@ class Service:
                 "make", "-C", self._get_service_path(service), command, "CACHE={}".format(cache_option)
             ]
 
-            return call_command(full_command, shell=True)
+            start_time = time.time()
+
+            if jobs <= 1:
+                result = call_command(full_command, shell=True)
+            else:
+                result, output = capture_command(full_command, shell=True)
+
+                with output_lock:
+                    for line in output.splitlines():
+                        print("[{}] {}".format(service.ljust(prefix_width), line))
+
+            results[service] = ("PASS" if result else "FAIL", time.time() - start_time)
+            self._record_duration(duration_history, service, command, results[service][1])
+
+            if not result:
+                failed.set()
+            elif cache_key:
+                test_results.set({"service": service, "target": command, "tag": tag}, cache_key)
+
+            return result
+
+        run_concurrently(function, services_iterable, jobs=jobs)
+        self._log_make_command_summary(command, services_iterable, results)
+
+        return all(results[service][0] in ("PASS", "CACHED") for service in services_iterable)
+
+    def _log_make_command_summary(
+        self,
+        command: str,
+        services: List[str],
+        results: Dict[str, Tuple[str, float]]
+    ) -> None:
+        service_width = max([len(service) for service in services] + [len("Service")])
+
+        print()
+        logger.info("'make {}' results:".format(command))
+        logger.info("{}  {:<7}  {:>9}".format("Service".ljust(service_width), "Result", "Duration"))
+
+        for service in services:
+            status, duration = results[service]
+            logger.info("{}  {:<7}  {:>8.1f}s".format(service.ljust(service_width), status, duration))
+
+    def _record_duration(self, duration_history: Cache, service: str, target: str, duration: float) -> None:
+        previous_duration = duration_history.get(target, service)
+
+        # Smooth out the odd slow (or fast) run, so that one outlier doesn't reshuffle all of the shards.
+        if previous_duration is not None:
+            duration = DURATION_HISTORY_WEIGHT * previous_duration + (1 - DURATION_HISTORY_WEIGHT) * duration
+
+        duration_history.set(duration, target, service)
+
+    def _get_shard_services(self, target: str, services: List[str], shard: Tuple[int, int]) -> List[str]:
+        """
+        Splits the services across `shard_count` shards so that each shard takes about as long to run the target,
+        based on how long the target has previously taken for each service.
+
+        Services without any history are assumed to take the average time of the services with history.
+
+        Since every shard works out the split on its own, the split is saved in the Cloud Build workspace
+        the first time that it's computed, so that shards that start later (i.e. after other shards have already
+        recorded new durations) still agree on it.
+        """
+        shard_index, shard_count = shard
+        services_iterable = sorted(services if services else self.config.services_with_code)
+
+        def compute_shards() -> List[List[str]]:
+            duration_history = Cache(DURATIONS_CACHE_NAMESPACE)
+            durations = {}  # type: Dict[str, float]
+
+            for service in services_iterable:
+                duration = duration_history.get(target, service)
+
+                if duration is not None:
+                    durations[service] = duration
+
+            if not durations:
+                logger.warning(
+                    "No previous durations of 'make {}' were found, so the services are split evenly by count. "
+                    "To keep durations between builds, set {} to a folder that's shared between them.".format(
+                        target, CACHE_BUCKET_ENV_VARIABLE
+                    )
+                )
 
-        return self._apply_to_services(function, services)
+            default_duration = sum(durations.values()) / len(durations) if durations else 1.0
+
+            return shard_by_duration(
+                {service: durations.get(service, default_duration) for service in services_iterable},
+                shard_count
+            )
+
+        # The workspace only lasts for a single build, so each build gets its own split.
+        shard_plans = Cache(SHARD_PLANS_CACHE_NAMESPACE, backends=get_workspace_backends())
+        shards = shard_plans.get_or_compute(compute_shards, target, shard_count, services_iterable)
+
+        shard_services = shards[shard_index - 1]
+        logger.info("Shard {}/{}: {}".format(shard_index, shard_count, ", ".join(shard_services)))
+
+        return shard_services
+
+    def _get_test_result_key(self, service: str, target: str, tag: str = "") -> str:
+        """
+        Hashes everything that determines the result of running a make target for a service:
+        the target, the tag (i.e. the cache image), the files in the service's folder, its Dockerfile
+        and Makefile (which could be excluded by the .dockerignore), and the paths that it watches
+        (e.g. shared code, or the folders of the services it depends on).
 
-    def _apply_to_services(self, function: Callable[[str], bool], services: List[str] = []) -> bool:
+        The folder is hashed as a plain folder, rather than as a build context, since a service's
+        make targets don't need it to have a Dockerfile.
+        """
+        service_path = self._get_service_path(service)
+        key_hash = hashlib.sha256()
+
+        key_hash.update("{}\0{}\0{}\0".format(target, tag, hash_folder(service_path)).encode("utf8"))
+
+        for file_name in [DOCKERFILE, "Makefile"]:
+            file_path = os.path.join(service_path, file_name)
+
+            if os.path.isfile(file_path):
+                with open(file_path, "rb") as file:
+                    key_hash.update(file_name.encode("utf8") + b"\0" + file.read() + b"\0")
+
+        for watched_path in self.config.get_watched_paths(service):
+            full_path = self.config.get_project_path(watched_path)
+
+            if os.path.isfile(full_path):
+                with open(full_path, "rb") as file:
+                    path_hash = hashlib.sha256(file.read()).hexdigest()
+            else:
+                path_hash = hash_folder(full_path)
+
+            key_hash.update("{}\0{}\0".format(watched_path, path_hash).encode("utf8"))
+
+        return key_hash.hexdigest()
+
+    def _apply_to_services(self, function: Callable[[str], bool], services: List[str] = [], jobs: int = 1) -> bool:
         """
         Takes a function and 'applies' it to each of the services (either the given services or
         all of the services that have code). i.e. it just runs the function with each service.
 
+        When `jobs` is greater than 1, the function is run for up to `jobs` services at once.
+        In that case, every service is run to completion and all of the failures are reported together.
+
         It is important that this (and functions that use this) can exit with False,
         so that the CLI layer can catch it and exit with an error code.
         Otherwise, the CI pipeline won't know when a step has failed.
@@ -200,11 +613,480 @@ class Service:
 
         services_iterable = services if services else self.config.services_with_code
 
-        for service in services_iterable:  # type: ignore
-            if not function(service):
-                return False  # Fail fast to optimize the CI/CD pipeline
+        if jobs <= 1:
+            for service in services_iterable:  # type: ignore
+                if not function(service):
+                    return False  # Fail fast to optimize the CI/CD pipeline
+
+            return True
+
+        results = run_concurrently(function, list(services_iterable), jobs=jobs)  # type: ignore
+        failed_services = [service for service, result in results.items() if not result]
+
+        if failed_services:
+            logger.error("Failed services: {}".format(", ".join(failed_services)))
+
+        return not failed_services
 
-        return True
+    def _get_build_steps(
+        self,
+        service: str,
+        branch_tag: str = "",
+        commit_tag: str = "",
+        with_context_tag: bool = False
+    ) -> List[Dict[str, Any]]:
+        """Determines the (ordered) builds needed to build each stage of a service's image."""
+        fixed_tag = self._get_fixed_tag(service)
+        is_ci_build = bool(branch_tag or commit_tag)
+        base_images = self._get_built_images(service, is_ci_build)
+        context_tag = self._get_context_tag(service, branch_tag) if with_context_tag and is_ci_build else None
+
+        stage_images = []  # type: List[str]
+        steps = []
+
+        for index, base_image in enumerate(base_images):
+            is_last_image = index == len(base_images) - 1
+            tagged_images = self._generate_tagged_images(
+                base_image, branch_tag, commit_tag, fixed_tag=fixed_tag, context_tag=context_tag
+            )
+
+            if not branch_tag and not commit_tag:  # Local dev use case
+                steps.append({
+                    "tags": [tagged_images["latest"]],
+                    "target_stage": None,
+                    "cache_images": [],
+                    "remote_cache_images": []
+                })
+            elif self._uses_registry_cache(service):  # CI/CD pipeline use case, with a registry cache
+                cache_tag = fixed_tag if fixed_tag else branch_tag
+                cache_from_tags = [cache_tag, fixed_tag if fixed_tag else self.config.production_namespace]
+
+                steps.append({
+                    "tags": list(tagged_images.values()),
+                    "target_stage": None,
+                    "cache_images": [],
+                    "remote_cache_images": [],
+                    "registry_cache_from": [
+                        self._format_registry_cache_ref(base_image, tag) for tag in dict.fromkeys(cache_from_tags)
+                    ],
+                    "registry_cache_to": self._format_registry_cache_ref(base_image, cache_tag),
+                    "context_image": tagged_images.get("context")
+                })
+            else:  # CI/CD pipeline use case
+                remote_cache_images = self._get_cache_sources(service, base_image, branch_tag, fixed_tag)
+
+                # If we're on the last image, then that means it's the final stage and
+                # we don't need to specify a target stage.
+                # Otherwise, each previous stage needs to specify a target in the Dockerfile to be
+                # built (and pushed) separately.
+                steps.append({
+                    "image": tagged_images["fixed_tag"] if fixed_tag else tagged_images["commit"],
+                    "tags": list(tagged_images.values()),
+                    "target_stage": None if is_last_image else base_image,
+                    # Each previous stage image is used to build the next stage.
+                    "cache_images": stage_images + remote_cache_images,
+                    "remote_cache_images": remote_cache_images,
+                    "context_image": tagged_images.get("context")
+                })
+
+                stage_images = stage_images + [tagged_images["commit"]]
+
+        return steps
+
+    def _has_cache_sources(self, service: str) -> bool:
+        return "cache_sources" in self.config.services.get(service, {})
+
+    def _get_cache_sources(
+        self,
+        service: str,
+        base_image: str,
+        branch_tag: str = "",
+        fixed_tag: str = None
+    ) -> List[str]:
+        """
+        Resolves a service's `cache_sources` config into the images to use as build cache, in order of preference.
+
+        The sources can be any of:
+
+        - "branch": The image for the branch being built (or the service's fixed tag).
+        - "production": The image for the production branch.
+        - "latest": The latest image (only pushed from the production branch).
+        - "production_commits:N": The images for the last N commits on the production branch.
+
+        This way, a new branch can fall back to production's cache instead of starting with a cold cache.
+        Services that use a `registry_cache` don't use these; they use the branch's and production's registry caches.
+        """
+        sources = self.config.services.get(service, {}).get("cache_sources", DEFAULT_CACHE_SOURCES)
+        tags = []  # type: List[str]
+
+        for source in sources:
+            source_type, _, count = source.partition(":")
+
+            if source_type == "branch":
+                tags.append(fixed_tag if fixed_tag else branch_tag)
+            elif source_type == "production":
+                tags.append(self.config.production_namespace)
+            elif source_type == "latest":
+                tags.append("latest")
+            elif source_type == "production_commits":
+                commits = self.git.get_recent_commits(
+                    self.config.production_namespace, self._parse_cache_source_count(service, source, count)
+                )
+                tags.extend([commit[:SHORT_SHA_LENGTH] for commit in commits])
+            else:
+                logger.warning("Unknown cache source '{}' for service {}; ignoring it.".format(source, service))
+
+        images = [self.gcloud.format_gcr_image(self.config.project_name, base_image, tag) for tag in tags if tag]
+
+        # Remove duplicates while preserving the order of preference.
+        return list(dict.fromkeys(images))
+
+    def _parse_cache_source_count(self, service: str, source: str, count: str) -> int:
+        try:
+            parsed_count = int(count or "1")
+        except ValueError:
+            parsed_count = 0
+
+        if parsed_count < 1:
+            logger.error(
+                "Invalid cache source '{}' for service {}: "
+                "the number of commits must be a positive integer.".format(source, service)
+            )
+
+            raise click.Abort()
+
+        return parsed_count
+
+    def _drop_missing_cache_sources(self, build_steps: Dict[str, List[Dict[str, Any]]]) -> None:
+        """
+        Removes the configured cache sources that don't exist in the registry, so that they aren't pulled
+        or passed to the build. Existence is checked (concurrently) against the registry without pulling anything.
+        """
+        steps_with_sources = [
+            step for service, steps in build_steps.items() if self._has_cache_sources(service) for step in steps
+        ]
+
+        cache_sources = sorted(set(image for step in steps_with_sources for image in step["remote_cache_images"]))
+
+        if not cache_sources:
+            return
+
+        exists = run_concurrently(self.docker.image_exists_in_registry, cache_sources, jobs=len(cache_sources))
+        missing_sources = [image for image in cache_sources if not exists[image]]
+
+        if missing_sources:
+            logger.info("Dropping cache sources that don't exist: {}".format(", ".join(missing_sources)))
+
+        for step in steps_with_sources:
+            step["remote_cache_images"] = [image for image in step["remote_cache_images"] if exists[image]]
+            step["cache_images"] = [image for image in step["cache_images"] if exists.get(image, True)]
+
+    def _report_cache_hits(self, service: str, step: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Reports how many of the built image's layers came from each of its cache sources,
+        by comparing the layers of the built image against the (pulled) cache source images.
+        """
+        built_layers = self.docker.get_image_layers(step["image"])
+        reused_layers = {}
+
+        for cache_source in step["remote_cache_images"]:
+            source_layers = self.docker.get_image_layers(cache_source)
+
+            if not source_layers:
+                logger.info("{}: cache source {} wasn't pulled; can't count its cache hits.".format(
+                    service, cache_source
+                ))
+                continue
+
+            shared_layers = 0
+
+            for built_layer, source_layer in zip(built_layers, source_layers):
+                if built_layer != source_layer:
+                    break
+
+                shared_layers += 1
+
+            reused_layers[cache_source] = shared_layers
+
+            logger.info("{}: cache source {} provided {}/{} layers.".format(
+                service, cache_source, shared_layers, len(built_layers)
+            ))
+
+        if reused_layers and max(reused_layers.values()):
+            best_source = max(reused_layers, key=lambda source: reused_layers[source])
+            logger.info("{}: most cache hits came from {}.".format(service, best_source))
+
+        return reused_layers
+
+    def _build_with_bake(self, build_steps: Dict[str, List[Dict[str, Any]]], branch_tag: str = "") -> bool:
+        """
+        Builds every step of every service as one `docker buildx bake` invocation, so that BuildKit can
+        dedupe shared base layers and schedule all of the builds itself.
+        """
+        if not build_steps:
+            return True
+
+        bake_definition, targets = self._generate_bake_definition(build_steps, branch_tag)
+        uses_registry_cache = any(step.get("registry_cache_to") for steps in build_steps.values() for step in steps)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bake_file = os.path.join(temp_dir, "docker-bake.json")
+            metadata_file = os.path.join(temp_dir, "metadata.json")
+
+            with open(bake_file, "w") as file:
+                json.dump(bake_definition, file, indent=4)
+
+            start_time = time.time()
+            result = self.docker.bake(bake_file, metadata_file, use_kubails_builder=uses_registry_cache)
+            duration = time.time() - start_time
+
+            try:
+                with open(metadata_file, "r") as file:
+                    metadata = json.load(file)
+            except (IOError, ValueError):
+                metadata = {}
+
+        for name, target in targets.items():
+            target["digest"] = metadata.get(name, {}).get("containerimage.digest")
+
+        summary = {"result": "success" if result else "failure", "duration": round(duration, 2), "targets": targets}
+        summary_file = self._get_report_path(BAKE_SUMMARY_FILE)
+
+        with open(summary_file, "w") as file:
+            json.dump(summary, file, indent=4, sort_keys=True)
+
+        logger.info("Wrote build summary to {}".format(summary_file))
+        return result
+
+    def _generate_bake_definition(
+        self,
+        build_steps: Dict[str, List[Dict[str, Any]]],
+        branch_tag: str = ""
+    ) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+        """
+        Converts the build steps into a bake file definition.
+
+        Returns the definition and a summary of each of its targets (keyed by target name).
+        """
+        bake_targets = {}  # type: Dict[str, Dict[str, Any]]
+        targets = {}  # type: Dict[str, Dict[str, Any]]
+
+        build_args = {"BUILDKIT_INLINE_CACHE": "1"}
+
+        if branch_tag:
+            build_args["branch"] = branch_tag
+
+        for service, steps in build_steps.items():
+            for step in steps:
+                stage = step["target_stage"]
+                name = sanitize_name("{}-{}".format(service, stage) if stage else service)
+
+                bake_target = {
+                    "context": self._get_service_path(service),
+                    "dockerfile": "Dockerfile",
+                    "tags": step["tags"],
+                    "args": build_args
+                }  # type: Dict[str, Any]
+
+                if stage:
+                    bake_target["target"] = stage
+
+                if step.get("registry_cache_to"):
+                    bake_target["cache-from"] = [
+                        "type=registry,ref={}".format(ref) for ref in step["registry_cache_from"]
+                    ]
+                    bake_target["cache-to"] = ["type=registry,ref={},mode=max".format(step["registry_cache_to"])]
+                else:
+                    # The previous stages are built as part of the same session, so only the remote
+                    # cache images are needed as cache sources.
+                    bake_target["cache-from"] = step["remote_cache_images"]
+
+                bake_targets[name] = bake_target
+                targets[name] = {"service": service, "stage": stage, "tags": step["tags"]}
+
+        bake_definition = {"group": {"default": {"targets": sorted(bake_targets)}}, "target": bake_targets}
+        return bake_definition, targets
+
+    def _write_build_report(self, build_report: Dict[str, Dict[str, Any]]) -> None:
+        report_file = self._get_report_path(BUILD_REPORT_FILE)
+
+        with open(report_file, "w") as file:
+            json.dump({"services": build_report}, file, indent=4, sort_keys=True)
+
+        logger.info("Wrote build report to {}".format(report_file))
+
+        for service, report in sorted(build_report.items()):
+            if report.get("skipped"):
+                logger.info("{}: skipped (unchanged)".format(service))
+            elif report.get("baked"):
+                logger.info("{}: built with bake{}".format(
+                    service, ", {} image".format(format_size(report["image"]["size"])) if "image" in report else ""
+                ))
+            else:
+                logger.info("{}: {}s, {} cached steps, {} executed steps{}".format(
+                    service, report["duration"], report["cached_steps"], report["executed_steps"],
+                    ", {} image".format(format_size(report["image"]["size"])) if "image" in report else ""
+                ))
+
+    def _report_image_size(self, service: str, image: str) -> Tuple[Dict[str, Any], bool]:
+        """
+        Reports the size, layer count, and largest layers of a service's built image,
+        and checks them against the service's `image_size_budget` (if it has one).
+
+        :return: The image's size report and whether the image is within its budget
+                 (or is over budget, but the budget only warns).
+        """
+        summary = summarize_image(
+            self.docker.get_image_size(image),
+            self.docker.get_image_layers(image),
+            self.docker.get_image_history(image)
+        )
+
+        logger.info("{}: {} in {} layers".format(image, format_size(summary["size"]), summary["layers"]))
+
+        for layer in summary["largest_layers"]:
+            logger.info("    {:>10} {}".format(format_size(layer["size"]), layer["created_by"][:100]))
+
+        budget = self._get_image_size_budget(service)
+
+        if not budget:
+            return summary, True
+
+        violations = get_budget_violations(summary, budget)
+        summary["budget"] = budget
+        summary["over_budget"] = bool(violations)
+
+        for violation in violations:
+            message = "{} is over its image size budget: {}".format(service, violation)
+
+            if budget["action"] == "fail":
+                logger.error(message)
+            else:
+                logger.warning(message)
+
+        return summary, not violations or budget["action"] != "fail"
+
+    def _get_image_size_budget(self, service: str) -> Dict[str, Any]:
+        """
+        Gets a service's `image_size_budget`, which can either be just a maximum size (e.g. "500MB")
+        or an object like the following:
+
+            {
+                "max_size": "500MB",
+                "max_layers": 40,
+                "action": "fail"
+            }
+
+        Being over budget only warns, unless the action is "fail".
+        """
+        budget = self.config.services.get(service, {}).get("image_size_budget")
+
+        if budget is None:
+            return {}
+
+        if not isinstance(budget, dict):
+            budget = {"max_size": budget}
+
+        budget = dict({"action": "warn"}, **budget)
+        problem = None
+
+        if budget["action"] not in IMAGE_SIZE_BUDGET_ACTIONS:
+            problem = "the action must be one of {}, not '{}'".format(
+                ", ".join(IMAGE_SIZE_BUDGET_ACTIONS), budget["action"]
+            )
+        elif budget.get("max_layers") is not None and not isinstance(budget["max_layers"], int):
+            problem = "max_layers must be a number, not '{}'".format(budget["max_layers"])
+        elif budget.get("max_size") is not None:
+            try:
+                parse_size(budget["max_size"])
+            except (TypeError, ValueError):
+                problem = "max_size must be a size like '500MB', not '{}'".format(budget["max_size"])
+
+        if problem:
+            logger.error("Invalid image_size_budget for {}: {}".format(service, problem))
+            raise click.Abort()
+
+        return budget
+
+    def _get_report_path(self, file_name: str) -> str:
+        # Reports go in the `/workspace` volume when running in Cloud Build, so that later steps can use them.
+        if os.path.isdir(CLOUD_BUILD_FOLDER):
+            return os.path.join(CLOUD_BUILD_FOLDER, file_name)
+
+        return self.config.get_project_path(file_name)
+
+    def _get_context_tag(self, service: str, branch_tag: str = "") -> str:
+        context_hash = hash_build_context(self._get_service_path(service), build_args={"branch": branch_tag})
+        return "{}{}".format(CONTEXT_TAG_PREFIX, context_hash)
+
+    def _is_build_context_unchanged(self, steps: List[Dict[str, Any]]) -> bool:
+        context_images = [step.get("context_image") for step in steps]
+
+        # Every stage needs to have already been built for the service's build to be skipped.
+        return all(context_images) and all(map(self.docker.image_exists_in_registry, context_images))
+
+    def _retag_unchanged_build(self, service: str, steps: List[Dict[str, Any]]) -> bool:
+        logger.info("Build context of {} is unchanged; re-using its existing images.".format(service))
+
+        result = True
+
+        for step in steps:
+            for tag in step["tags"]:
+                if tag != step["context_image"]:
+                    result = result and self.docker.tag(step["context_image"], tag)
+
+        return result
+
+    def _push_and_retag(self, repository: str, tags: List[str]) -> bool:
+        """
+        Pushes an image once and then adds the rest of its tags in the registry.
+
+        If a rebuild produced an image whose digest is already in the registry, nothing is pushed at all;
+        the digest just gets re-tagged.
+        """
+        first_image = "{}:{}".format(repository, tags[0])
+        other_images = ["{}:{}".format(repository, tag) for tag in tags[1:]]
+
+        existing_digests = [
+            digest for digest in self.docker.get_local_digests(first_image)
+            if self.docker.image_exists_in_registry("{}@{}".format(repository, digest))
+        ]
+
+        if existing_digests:
+            logger.info("{} is already in the registry; only re-tagging it.".format(first_image))
+            source_image = "{}@{}".format(repository, existing_digests[0])
+
+            return self.gcloud.add_image_tags(source_image, [first_image] + other_images)
+
+        return self.docker.push(first_image) and self.gcloud.add_image_tags(first_image, other_images)
+
+    def _get_images_to_push(self, service: str, branch_tag: str = "", commit_tag: str = "") -> Dict[str, List[str]]:
+        fixed_tag = self._get_fixed_tag(service)
+        images_to_push = {}
+
+        for base_image in self._get_built_images(service, bool(branch_tag or commit_tag)):
+            repository = self.gcloud.format_gcr_image(self.config.project_name, base_image)
+
+            if not branch_tag and not commit_tag:  # Local dev use case
+                images_to_push[repository] = ["latest"]
+            elif fixed_tag:  # CI/CD pipeline use case
+                images_to_push[repository] = [fixed_tag]
+            else:
+                images_to_push[repository] = [branch_tag, commit_tag]
+
+                if branch_tag == self.config.production_namespace:
+                    images_to_push[repository].append("latest")
+
+                # If the build tagged the image with its context hash, then that tag needs to be pushed
+                # so that later builds of the same context can be skipped. The tag is taken from the built image
+                # itself, since the context could have changed (and would hash differently) since the build.
+                built_image = "{}:{}".format(repository, commit_tag or branch_tag)
+
+                images_to_push[repository].extend([
+                    tag for tag in self.docker.get_image_tags(built_image) if tag.startswith(CONTEXT_TAG_PREFIX)
+                ])
+
+        return images_to_push
 
     def _get_service_path(self, service: str) -> str:
         folder = self.config.get_service_folder(service)
@@ -226,6 +1108,24 @@ class Service:
         # This is because the images are tagged the same as the stages.
         return image_stages + [base_image]
 
+    def _get_built_images(self, service: str, is_ci_build: bool = True) -> List[str]:
+        """
+        Services with `registry_cache` enabled in the config build all of their stages in one go and cache
+        the intermediate stages in a registry cache, so only their final image gets built (and pushed).
+        """
+        if is_ci_build and self._uses_registry_cache(service):
+            return self._get_base_images(service)[-1:]
+
+        return self._get_base_images(service)
+
+    def _uses_registry_cache(self, service: str) -> bool:
+        return bool(self.config.services.get(service, {}).get("registry_cache", False))
+
+    def _format_registry_cache_ref(self, base_image: str, tag: str) -> str:
+        return self.gcloud.format_gcr_image(
+            self.config.project_name, base_image, "{}{}".format(REGISTRY_CACHE_TAG_PREFIX, tag)
+        )
+
     def _get_fixed_tag(self, service: str) -> str:
         return self.config.services.get(service, {}).get("fixed_tag", None)
 
@@ -234,7 +1134,8 @@ class Service:
         base_image: str,
         branch_tag: str = "",
         commit_tag: str = "",
-        fixed_tag: str = None
+        fixed_tag: str = None,
+        context_tag: str = None
     ) -> Dict[str, str]:
         images = {}
 
@@ -246,6 +1147,9 @@ class Service:
         if fixed_tag:
             images["fixed_tag"] = "{}:{}".format(images["base"], fixed_tag)
 
+        if context_tag:
+            images["context"] = "{}:{}".format(images["base"], context_tag)
+
         return images
 
     def _template_service(self, service_type: str, title: str, name: str) -> None:
@@ -1,5 +1,6 @@
+import click
 from parameterized import parameterized
-from unittest import TestCase
+from unittest import mock, TestCase
 from . import config_store
 
 
@@ -182,3 +183,78 @@ class TestConfigStore(TestCase):
         config_service = config_store.ConfigStore(config=config, reset_instance=True)
         flattened_config = config_service.get_flattened_config()
         self.assertDictEqual(flattened_config, expected_flattened_config)
+
+    def test_changed_services_are_detected_with_one_diff_per_base_commit(self):
+        config = {
+            "__production_namespace": "master",
+            "__services": {
+                "frontend": {"folder": "frontend"},
+                "admin": {"folder": "frontend/admin"},
+                "backend": {"folder": "backend"},
+                "database": {},
+                "legacy": {"folder": "legacy", "fixed_tag": "v1"}
+            }
+        }
+
+        config_service = config_store.ConfigStore(config=config, reset_instance=True)
+        config_service.gcloud = mock.Mock()
+        config_service.git = mock.Mock()
+
+        last_built_tags = {"frontend": "abc", "admin": "abc", "backend": "def", "legacy": "v1"}
+        config_service.gcloud.get_last_built_tags_for_services.side_effect = lambda _, services: {
+            service: last_built_tags.get(service, "") for service in services
+        }
+
+        changed_files = {"abc": ["services/frontend/index.js", "README.md"], "def": None}
+        config_service.git.get_changed_files.side_effect = lambda _, commit: changed_files[commit]
+
+        result = config_service._get_service_names_with_changes("feature")
+
+        # The admin service is nested in the frontend service's folder, but none of its own files changed;
+        # the backend service is assumed to have changed since its diff failed.
+        self.assertEqual(result, ["frontend", "backend", "legacy"])
+        self.assertEqual(config_service.git.prepare_diff.call_count, 1)
+        self.assertEqual(config_service.git.get_changed_files.call_count, 2)
+
+    def test_changes_propagate_through_watch_paths_and_service_dependencies(self):
+        config = {
+            "__production_namespace": "master",
+            "__services": {
+                "frontend": {"folder": "frontend", "depends_on_services": ["backend"]},
+                "backend": {"folder": "backend", "watch_paths": ["services/common"], "depends_on_services": ["api"]},
+                "api": {"folder": "api", "watch_paths": ["protos"], "depends_on_services": ["backend"]},
+                "docs": {"folder": "docs", "watch_paths": ["helm"]}
+            }
+        }
+
+        config_service = config_store.ConfigStore(config=config, reset_instance=True)
+        config_service.gcloud = mock.Mock()
+        config_service.git = mock.Mock()
+
+        config_service.gcloud.get_last_built_tags_for_services.side_effect = lambda _, services: {
+            service: "abc" for service in services
+        }
+
+        config_service.git.get_changed_files.return_value = ["services/common/utils.js"]
+        self.assertEqual(config_service._get_service_names_with_changes("feature"), ["frontend", "backend", "api"])
+
+        # Dependencies only go one way: the frontend changing doesn't change the backend.
+        config_service.git.get_changed_files.return_value = ["services/frontend/index.js"]
+        self.assertEqual(config_service._get_service_names_with_changes("feature"), ["frontend"])
+
+        config_service.git.get_changed_files.return_value = ["protos/service.proto", "helm/values.yaml"]
+        self.assertEqual(
+            config_service._get_service_names_with_changes("feature"), ["frontend", "backend", "api", "docs"]
+        )
+
+    @parameterized.expand([
+        [{"watch_paths": "services/common"}],
+        [{"watch_paths": ["services/common", 1]}],
+        [{"depends_on_services": "backend"}],
+        [{"depends_on_services": [{"service": "backend"}]}],
+    ])
+    def test_invalid_watched_paths_abort_when_loading_the_config(self, service_config):
+        config = {"__services": {"frontend": dict({"folder": "frontend"}, **service_config)}}
+
+        with self.assertRaises(click.Abort):
+            config_store.ConfigStore(config=config, reset_instance=True)
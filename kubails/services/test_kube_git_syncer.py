@@ -1,5 +1,6 @@
 from parameterized import parameterized
-from unittest import TestCase
+from unittest import mock, TestCase
+from kubails.external_services import dependency_checker
 from . import kube_git_syncer
 
 
@@ -17,3 +18,19 @@ class TestKubeGitSyncer(TestCase):
     def test_can_get_unused_namespaces(self, remote_branches, existing_namespaces, expected):
         result = kube_git_syncer._get_unused_namespaces(remote_branches, existing_namespaces)
         self.assertEqual(result, expected)
+
+    @parameterized.expand([
+        [None],
+        [[]],
+    ])
+    def test_no_namespaces_are_deleted_without_remote_branches(self, remote_branches):
+        with mock.patch.object(dependency_checker, "_get_missing_dependencies", return_value=[]):
+            syncer = kube_git_syncer.KubeGitSyncer()
+
+        syncer.git = mock.Mock()
+        syncer.kubectl = mock.Mock()
+        syncer.git.get_remote_heads.return_value = remote_branches
+        syncer.kubectl.get_namespaces.return_value = ["master", "feature"]
+
+        self.assertFalse(syncer.cleanup_namespaces())
+        syncer.kubectl.delete_namespace.assert_not_called()
@@ -0,0 +1,483 @@
+import click
+import json
+import os
+import tempfile
+from parameterized import parameterized
+from unittest import mock, TestCase
+from kubails.external_services import dependency_checker, gcloud
+from kubails.utils import cache
+from . import config_store, service
+
+
+class TestService(TestCase):
+    def setUp(self):
+        self.maxDiff = None
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.project_dir = temp_dir.name
+        self.addCleanup(temp_dir.cleanup)
+
+        # The external tools don't need to be installed, since none of them actually get called.
+        dependencies_patcher = mock.patch.object(dependency_checker, "_get_missing_dependencies", return_value=[])
+        dependencies_patcher.start()
+        self.addCleanup(dependencies_patcher.stop)
+
+        # Keep the test results and durations out of the real cache.
+        cache_backend = cache.DirectoryBackend(os.path.join(self.project_dir, ".cache"))
+        cache_patcher = mock.patch.object(cache, "get_default_backends", return_value=[cache_backend])
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+        self._write_file("services/frontend/Dockerfile", "FROM node:14\nCOPY . .\n")
+        self._write_file("services/frontend/index.js", "console.log('frontend');\n")
+        self._write_file("services/backend/Dockerfile", "FROM python:3 AS deps\nFROM deps\nCOPY . .\n")
+
+        self.service = self._create_service({
+            "frontend": {"folder": "frontend", "image": "frontend"},
+            "backend": {"folder": "backend", "image": "backend", "image_stages": ["deps"]}
+        })
+
+    def test_ci_builds_push_branch_and_commit_tags(self):
+        self.assertEqual(self.service._get_images_to_push("backend", "feature", "abc1234"), {
+            "gcr.io/gcp-project/project-deps": ["feature", "abc1234"],
+            "gcr.io/gcp-project/project-backend": ["feature", "abc1234"]
+        })
+
+    def test_production_builds_also_push_latest_tag(self):
+        self.assertEqual(self.service._get_images_to_push("frontend", "master", "abc1234"), {
+            "gcr.io/gcp-project/project-frontend": ["master", "abc1234", "latest"]
+        })
+
+    def test_local_builds_push_latest_tag(self):
+        self.assertEqual(self.service._get_images_to_push("frontend"), {
+            "gcr.io/gcp-project/project-frontend": ["latest"]
+        })
+
+    def test_concurrent_push_pushes_every_image_and_reports_failures(self):
+        self.service.docker.push_tags.side_effect = lambda repository, tags: not repository.endswith("deps")
+
+        self.assertFalse(self.service.push(["frontend", "backend"], "feature", "abc1234", jobs=3))
+        self.assertEqual(
+            sorted(call[0][0] for call in self.service.docker.push_tags.call_args_list),
+            [
+                "gcr.io/gcp-project/project-backend",
+                "gcr.io/gcp-project/project-deps",
+                "gcr.io/gcp-project/project-frontend"
+            ]
+        )
+
+    def test_sequential_push_stops_at_first_failure(self):
+        self.service.docker.push_tags.return_value = False
+
+        self.assertFalse(self.service.push(["frontend", "backend"], "feature", "abc1234"))
+        self.assertEqual(self.service.docker.push_tags.call_count, 1)
+
+    def test_context_tag_is_pushed_from_the_built_image(self):
+        self.service.docker.get_image_tags.return_value = ["abc1234", "feature", "ctx-0123abcd"]
+
+        self.assertEqual(self.service._get_images_to_push("frontend", "feature", "abc1234"), {
+            "gcr.io/gcp-project/project-frontend": ["feature", "abc1234", "ctx-0123abcd"]
+        })
+
+        self.service.docker.get_image_tags.assert_called_once_with("gcr.io/gcp-project/project-frontend:abc1234")
+
+    def test_build_steps_are_tagged_with_the_context_hash(self):
+        steps = self.service._get_build_steps("frontend", "feature", "abc1234", with_context_tag=True)
+        context_image = steps[0]["context_image"]
+
+        self.assertTrue(context_image.startswith("gcr.io/gcp-project/project-frontend:ctx-"))
+        self.assertIn(context_image, steps[0]["tags"])
+
+        # The hash only changes when the context does.
+        same_steps = self.service._get_build_steps("frontend", "feature", "def5678", with_context_tag=True)
+        self.assertEqual(same_steps[0]["context_image"], context_image)
+
+        self._write_file("services/frontend/index.js", "console.log('changed');\n")
+
+        changed_steps = self.service._get_build_steps("frontend", "feature", "def5678", with_context_tag=True)
+        self.assertNotEqual(changed_steps[0]["context_image"], context_image)
+
+    def test_unchanged_builds_are_retagged_instead_of_built(self):
+        self.service.docker.image_exists_in_registry.return_value = True
+        self.service.docker.tag.return_value = True
+
+        self.assertTrue(self.service.build(["frontend"], "feature", "abc1234", skip_unchanged=True))
+
+        self.service.docker.build.assert_not_called()
+        self.assertEqual(
+            sorted(call[0][1] for call in self.service.docker.tag.call_args_list),
+            [
+                "gcr.io/gcp-project/project-frontend",
+                "gcr.io/gcp-project/project-frontend:abc1234",
+                "gcr.io/gcp-project/project-frontend:feature",
+                "gcr.io/gcp-project/project-frontend:latest"
+            ]
+        )
+
+    def test_changed_builds_are_built(self):
+        self.service.docker.image_exists_in_registry.side_effect = lambda image: "ctx-" not in image
+        self.service.docker.build.return_value = True
+
+        self.assertTrue(self.service.build(["frontend"], "feature", "abc1234", skip_unchanged=True))
+
+        self.service.docker.tag.assert_not_called()
+        self.assertEqual(self.service.docker.build.call_count, 1)
+
+    def test_registry_cache_services_build_every_stage_in_one_step(self):
+        self.service.config.services["backend"]["registry_cache"] = True
+
+        self.assertEqual(self.service._get_build_steps("backend", "feature", "abc1234"), [{
+            "tags": [
+                "gcr.io/gcp-project/project-backend",
+                "gcr.io/gcp-project/project-backend:latest",
+                "gcr.io/gcp-project/project-backend:feature",
+                "gcr.io/gcp-project/project-backend:abc1234"
+            ],
+            "target_stage": None,
+            "cache_images": [],
+            "remote_cache_images": [],
+            "registry_cache_from": [
+                "gcr.io/gcp-project/project-backend:buildcache-feature",
+                "gcr.io/gcp-project/project-backend:buildcache-master"
+            ],
+            "registry_cache_to": "gcr.io/gcp-project/project-backend:buildcache-feature",
+            "context_image": None
+        }])
+
+        # Local builds don't use the registry cache.
+        self.assertEqual(
+            [step.get("registry_cache_to") for step in self.service._get_build_steps("backend")],
+            [None, None]
+        )
+
+    def test_registry_cache_services_are_built_with_buildx(self):
+        self.service.config.services["backend"]["registry_cache"] = True
+        self.service.docker.build_with_registry_cache.return_value = True
+
+        self.assertTrue(self.service.build(["backend"], "feature", "abc1234"))
+
+        self.service.docker.build.assert_not_called()
+        self.service.docker.get_from_images.assert_not_called()
+        self.assertEqual(
+            self.service.docker.build_with_registry_cache.call_args[1]["cache_to"],
+            "gcr.io/gcp-project/project-backend:buildcache-feature"
+        )
+
+        # Only the final image gets pushed; the stages are in the registry cache.
+        self.assertEqual(list(self.service._get_images_to_push("backend", "feature", "abc1234")), [
+            "gcr.io/gcp-project/project-backend"
+        ])
+
+    def test_bake_definition_has_a_target_per_build_step(self):
+        build_steps = {"backend": self.service._get_build_steps("backend", "feature", "abc1234")}
+        bake_definition, targets = self.service._generate_bake_definition(build_steps, "feature")
+
+        self.assertEqual(bake_definition["group"], {"default": {"targets": ["backend", "backend-deps"]}})
+        self.assertEqual(bake_definition["target"]["backend-deps"], {
+            "context": os.path.join(self.project_dir, "services", "backend"),
+            "dockerfile": "Dockerfile",
+            "target": "deps",
+            "tags": [
+                "gcr.io/gcp-project/project-deps",
+                "gcr.io/gcp-project/project-deps:latest",
+                "gcr.io/gcp-project/project-deps:feature",
+                "gcr.io/gcp-project/project-deps:abc1234"
+            ],
+            "args": {"BUILDKIT_INLINE_CACHE": "1", "branch": "feature"},
+            "cache-from": ["gcr.io/gcp-project/project-deps:feature", "gcr.io/gcp-project/project-deps:latest"]
+        })
+
+        # The final stage doesn't need a target, and its cache comes from the deps stage in the same session.
+        self.assertNotIn("target", bake_definition["target"]["backend"])
+        self.assertEqual(bake_definition["target"]["backend"]["cache-from"], [
+            "gcr.io/gcp-project/project-backend:feature", "gcr.io/gcp-project/project-backend:latest"
+        ])
+
+        self.assertEqual(targets["backend-deps"]["stage"], "deps")
+        self.assertEqual(targets["backend"]["service"], "backend")
+
+    def test_bake_build_writes_a_summary_with_image_digests(self):
+        def bake(bake_file, metadata_file, use_kubails_builder=False):
+            with open(metadata_file, "w") as file:
+                json.dump({"frontend": {"containerimage.digest": "sha256:abc"}}, file)
+
+            return True
+
+        self.service.docker.bake.side_effect = bake
+
+        self.assertTrue(self.service.build(["frontend"], "feature", "abc1234", bake=True))
+        self.service.docker.build.assert_not_called()
+
+        with open(os.path.join(self.project_dir, service.BAKE_SUMMARY_FILE), "r") as file:
+            summary = json.load(file)
+
+        self.assertEqual(summary["result"], "success")
+        self.assertEqual(summary["targets"]["frontend"]["digest"], "sha256:abc")
+
+    def test_local_builds_of_services_with_cache_sources_skip_cache_hit_reporting(self):
+        self.service.config.services["frontend"]["cache_sources"] = ["branch", "production"]
+        self.service.docker.build.return_value = True
+
+        self.assertTrue(self.service.build(["frontend"]))
+        self.service.docker.get_image_layers.assert_called_once_with("gcr.io/gcp-project/project-frontend:latest")
+
+    def test_cache_sources_fall_back_in_order(self):
+        self.service.config.services["frontend"]["cache_sources"] = [
+            "branch", "production_commits:2", "production", "latest", "unknown"
+        ]
+        self.service.git.get_recent_commits.return_value = ["a" * 40, "b" * 40]
+
+        self.assertEqual(self.service._get_cache_sources("frontend", "frontend", "feature"), [
+            "gcr.io/gcp-project/project-frontend:feature",
+            "gcr.io/gcp-project/project-frontend:aaaaaaa",
+            "gcr.io/gcp-project/project-frontend:bbbbbbb",
+            "gcr.io/gcp-project/project-frontend:master",
+            "gcr.io/gcp-project/project-frontend:latest"
+        ])
+
+        self.service.git.get_recent_commits.assert_called_once_with("master", 2)
+
+    def test_invalid_cache_source_counts_abort(self):
+        for cache_source in ["production_commits:two", "production_commits:0"]:
+            self.service.config.services["frontend"]["cache_sources"] = [cache_source]
+
+            with self.assertRaises(click.Abort):
+                self.service._get_cache_sources("frontend", "frontend", "feature")
+
+    def test_missing_cache_sources_are_dropped(self):
+        self.service.config.services["frontend"]["cache_sources"] = ["branch", "production"]
+        self.service.docker.image_exists_in_registry.side_effect = lambda image: image.endswith(":master")
+
+        build_steps = {"frontend": self.service._get_build_steps("frontend", "feature", "abc1234")}
+        self.service._drop_missing_cache_sources(build_steps)
+
+        self.assertEqual(build_steps["frontend"][0]["remote_cache_images"], [
+            "gcr.io/gcp-project/project-frontend:master"
+        ])
+        self.assertEqual(build_steps["frontend"][0]["cache_images"], [
+            "gcr.io/gcp-project/project-frontend:master"
+        ])
+
+    def test_retag_pushes_once_and_tags_the_rest_in_the_registry(self):
+        self.service.docker.get_local_digests.return_value = ["sha256:new"]
+        self.service.docker.image_exists_in_registry.return_value = False
+        self.service.docker.push.return_value = True
+        self.service.gcloud.add_image_tags.return_value = True
+
+        self.assertTrue(self.service.push(["frontend"], "feature", "abc1234", strategy="retag"))
+
+        self.service.docker.push.assert_called_once_with("gcr.io/gcp-project/project-frontend:feature")
+        self.service.gcloud.add_image_tags.assert_called_once_with(
+            "gcr.io/gcp-project/project-frontend:feature", ["gcr.io/gcp-project/project-frontend:abc1234"]
+        )
+
+    def test_retag_only_tags_images_already_in_the_registry(self):
+        self.service.docker.get_local_digests.return_value = ["sha256:old"]
+        self.service.docker.image_exists_in_registry.return_value = True
+        self.service.gcloud.add_image_tags.return_value = True
+
+        self.assertTrue(self.service._push_and_retag("gcr.io/gcp-project/project-frontend", ["feature", "abc1234"]))
+
+        self.service.docker.push.assert_not_called()
+        self.service.docker.image_exists_in_registry.assert_called_once_with(
+            "gcr.io/gcp-project/project-frontend@sha256:old"
+        )
+        self.service.gcloud.add_image_tags.assert_called_once_with(
+            "gcr.io/gcp-project/project-frontend@sha256:old",
+            ["gcr.io/gcp-project/project-frontend:feature", "gcr.io/gcp-project/project-frontend:abc1234"]
+        )
+
+    def test_promote_tags_last_built_images_with_branch_and_commit(self):
+        self.service.gcloud.get_last_built_tag_for_service.side_effect = lambda project, image: {
+            "deps": "old1234", "backend": "old1234", "frontend": ""
+        }[image]
+        self.service.gcloud.add_image_tags.return_value = True
+
+        self.assertTrue(self.service.promote(["backend"], "feature", "abc1234"))
+        self.assertEqual(self.service.gcloud.add_image_tags.call_args_list, [
+            mock.call(
+                "gcr.io/gcp-project/project-deps:old1234",
+                ["gcr.io/gcp-project/project-deps:abc1234", "gcr.io/gcp-project/project-deps:feature"]
+            ),
+            mock.call(
+                "gcr.io/gcp-project/project-backend:old1234",
+                ["gcr.io/gcp-project/project-backend:abc1234", "gcr.io/gcp-project/project-backend:feature"]
+            )
+        ])
+
+        # Services that were never built can't be promoted.
+        self.assertFalse(self.service.promote(["frontend"], "feature", "abc1234"))
+
+    def test_promote_defaults_to_unchanged_services(self):
+        self.service.config.unchanged_services_with_code = []
+
+        self.assertTrue(self.service.promote([], "feature", "abc1234"))
+        self.service.gcloud.add_image_tags.assert_not_called()
+
+    @parameterized.expand([
+        ["warn", False, True],
+        ["fail", False, False],
+        ["warn", True, True],
+        ["fail", True, False],
+    ])
+    def test_image_size_budget_is_enforced(self, action, bake, expected_result):
+        self.service.config.services["frontend"]["image_size_budget"] = {"max_size": "1MB", "action": action}
+        self.service.docker.build.return_value = True
+        self.service.docker.bake.return_value = True
+        self.service.docker.get_image_size.return_value = 2000000
+
+        self.assertEqual(self.service.build(["frontend"], bake=bake), expected_result)
+
+        with open(os.path.join(self.project_dir, service.BUILD_REPORT_FILE), "r") as file:
+            report = json.load(file)["services"]["frontend"]
+
+        self.assertTrue(report["image"]["over_budget"])
+        self.assertEqual(report["result"], expected_result)
+
+    def test_images_within_budget_pass(self):
+        self.service.config.services["frontend"]["image_size_budget"] = "1MB"
+        self.service.docker.build.return_value = True
+        self.service.docker.get_image_size.return_value = 1000
+
+        self.assertTrue(self.service.build(["frontend"]))
+
+    @parameterized.expand([
+        [{"max_size": "1MB", "action": "explode"}],
+        [{"max_size": "lots"}],
+        [{"max_layers": "many"}],
+        ["1 megabyte"],
+    ])
+    def test_invalid_image_size_budgets_abort_before_building(self, budget):
+        self.service.config.services["frontend"]["image_size_budget"] = budget
+
+        with self.assertRaises(click.Abort):
+            self.service.build(["frontend"])
+
+        self.service.docker.build.assert_not_called()
+
+    def test_make_command_skips_remaining_services_after_a_failure(self):
+        with mock.patch.object(service, "call_command", return_value=False) as call_command:
+            with self.assertLogs("kubails.services.service", level="INFO") as logs:
+                self.assertFalse(self.service.lint(["frontend", "backend"], "feature"))
+
+        self.assertEqual(call_command.call_count, 1)
+        self.assertEqual(call_command.call_args[0][0][:4], [
+            "make", "-C", os.path.join(self.project_dir, "services", "frontend"), "lint"
+        ])
+
+        summary = [line for line in logs.output if "FAIL" in line or "SKIPPED" in line]
+        self.assertEqual(len(summary), 2)
+        self.assertIn("frontend", summary[0])
+        self.assertIn("backend", summary[1])
+
+    def test_make_command_can_keep_going_after_a_failure(self):
+        with mock.patch.object(service, "call_command", side_effect=[False, True]) as call_command:
+            self.assertFalse(self.service.lint(["frontend", "backend"], "feature", keep_going=True))
+
+        self.assertEqual(call_command.call_count, 2)
+
+    def test_concurrent_make_commands_prefix_their_output(self):
+        with mock.patch.object(service, "capture_command", return_value=(True, "line 1\nline 2\n")):
+            with mock.patch("builtins.print") as print_function:
+                self.assertTrue(self.service.lint(["frontend", "backend"], "feature", jobs=2))
+
+        printed_lines = [call[0][0] for call in print_function.call_args_list if call[0]]
+
+        for line in ["[frontend] line 1", "[frontend] line 2", "[backend ] line 1", "[backend ] line 2"]:
+            self.assertIn(line, printed_lines)
+
+    def test_services_that_already_passed_with_the_same_contents_are_skipped(self):
+        with mock.patch.object(service, "call_command", return_value=True) as call_command:
+            self.assertTrue(self.service.test(["frontend", "backend"], "feature"))
+            self.assertTrue(self.service.test(["frontend", "backend"], "feature"))
+            self.assertEqual(call_command.call_count, 2)
+
+            # Changing a service's contents means it has to pass again.
+            self._write_file("services/frontend/index.js", "console.log('changed');\n")
+            self.assertTrue(self.service.test(["frontend", "backend"], "feature"))
+            self.assertEqual(call_command.call_count, 3)
+
+            # As does turning the cache off.
+            self.assertTrue(self.service.test(["frontend", "backend"], "feature", use_cache=False))
+            self.assertEqual(call_command.call_count, 5)
+
+    def test_changes_to_watched_paths_invalidate_cached_test_results(self):
+        self.service.config.services["frontend"]["watch_paths"] = ["services/common", "protos/api.proto"]
+        self.service.config.services["frontend"]["depends_on_services"] = ["backend"]
+        self._write_file("services/common/utils.js", "module.exports = 1;\n")
+        self._write_file("protos/api.proto", "syntax = \"proto3\";\n")
+
+        with mock.patch.object(service, "call_command", return_value=True) as call_command:
+            self.assertTrue(self.service.test(["frontend"], "feature"))
+            self.assertTrue(self.service.test(["frontend"], "feature"))
+            self.assertEqual(call_command.call_count, 1)
+
+            for path in ["services/common/utils.js", "protos/api.proto", "services/backend/app.py"]:
+                self._write_file(path, "changed\n")
+                self.assertTrue(self.service.test(["frontend"], "feature"))
+
+            self.assertEqual(call_command.call_count, 4)
+
+    def test_services_without_a_dockerfile_can_cache_their_test_results(self):
+        os.remove(os.path.join(self.project_dir, "services", "frontend", "Dockerfile"))
+
+        with mock.patch.object(service, "call_command", return_value=True) as call_command:
+            self.assertTrue(self.service.test(["frontend"], "feature"))
+            self.assertTrue(self.service.test(["frontend"], "feature"))
+
+        self.assertEqual(call_command.call_count, 1)
+
+    def test_failed_services_are_not_cached(self):
+        with mock.patch.object(service, "call_command", side_effect=[False, True]) as call_command:
+            self.assertFalse(self.service.test(["frontend"], "feature"))
+            self.assertTrue(self.service.test(["frontend"], "feature"))
+
+        self.assertEqual(call_command.call_count, 2)
+
+    def test_shards_are_split_by_previous_durations(self):
+        duration_history = cache.Cache(service.DURATIONS_CACHE_NAMESPACE)
+        duration_history.set(600.0, "ci", "frontend")
+        duration_history.set(100.0, "ci", "backend")
+
+        with mock.patch.object(service, "get_workspace_backends", return_value=[]):
+            self.assertEqual(self.service._get_shard_services("ci", ["frontend", "backend"], (1, 2)), ["frontend"])
+            self.assertEqual(self.service._get_shard_services("ci", ["frontend", "backend"], (2, 2)), ["backend"])
+
+    def test_shards_without_durations_warn_and_split_by_count(self):
+        with mock.patch.object(service, "get_workspace_backends", return_value=[]):
+            with self.assertLogs("kubails.services.service", level="WARNING") as logs:
+                shard = self.service._get_shard_services("ci", ["frontend", "backend"], (1, 2))
+
+        self.assertEqual(len(shard), 1)
+        self.assertIn(cache.CACHE_BUCKET_ENV_VARIABLE, logs.output[0])
+
+    def _create_service(self, services_config, **config):
+        store = config_store.ConfigStore(config=dict({
+            "__project_name": "project",
+            "__gcp_project_id": "gcp-project",
+            "__production_namespace": "master",
+            "__services": services_config
+        }, **config), reset_instance=True)
+
+        store.config_dir = self.project_dir
+
+        kubails_service = service.Service()
+        kubails_service.docker = mock.Mock()
+        kubails_service.docker.get_from_images.return_value = []
+        kubails_service.docker.get_image_tags.return_value = []
+        kubails_service.docker.get_image_size.return_value = 0
+        kubails_service.docker.get_image_layers.return_value = []
+        kubails_service.docker.get_image_history.return_value = []
+        kubails_service.git = mock.Mock()
+
+        # Only the commands are mocked, so that the images are still formatted for real.
+        kubails_service.gcloud = mock.Mock(wraps=gcloud.GoogleCloud("gcp-project", "region", "zone"))
+
+        return kubails_service
+
+    def _write_file(self, path, content):
+        full_path = os.path.join(self.project_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        with open(full_path, "w") as file:
+            file.write(content)
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import re
+from typing import Any, Dict, List, Pattern, Set, Tuple
+from kubails.utils.dockerfile import parse_dockerfile_content
+
+
+DOCKERFILE = "Dockerfile"
+DOCKERIGNORE = ".dockerignore"
+
+# Type alias for a compiled .dockerignore pattern and whether it is an exception (i.e. starts with '!').
+IgnorePattern = Tuple[Pattern, bool]
+
+
+def hash_build_context(context: str, build_args: Dict[str, str] = {}, dockerfile: str = DOCKERFILE) -> str:
+    """
+    Computes a deterministic hash of everything that goes into a Docker build:
+    the files in the build context (minus the ones excluded by .dockerignore), the Dockerfile,
+    and the build args that the Dockerfile actually declares.
+
+    Build args that the Dockerfile doesn't declare can't change the resulting image,
+    so they're left out of the hash (otherwise, e.g. the 'branch' arg would make every branch's hash different).
+
+    :param context: The path to the build context.
+    :param build_args: The build args passed to the build.
+    :param dockerfile: The name of the Dockerfile, relative to the context.
+
+    :return: The hex digest of the hash.
+    """
+    context_hash = hashlib.sha256()
+    dockerfile_path = os.path.join(context, dockerfile)
+
+    with open(dockerfile_path, "rb") as file:
+        dockerfile_content = file.read()
+
+    context_hash.update(b"dockerfile\0" + dockerfile_content + b"\0")
+
+    declared_args = _get_declared_args(dockerfile_content.decode("utf8", errors="replace"))
+
+    for key, value in sorted(build_args.items()):
+        if key in declared_args:
+            context_hash.update("arg\0{}={}\0".format(key, value).encode("utf8"))
+
+    _hash_files(context_hash, context, get_context_files(context))
+
+    return context_hash.hexdigest()
+
+
+def hash_folder(folder: str) -> str:
+    """
+    Computes a deterministic hash of the files in a folder (minus the ones excluded by its .dockerignore).
+
+    Unlike `hash_build_context`, the folder doesn't need to have a Dockerfile.
+
+    :param folder: The path to the folder.
+
+    :return: The hex digest of the hash.
+    """
+    folder_hash = hashlib.sha256()
+    _hash_files(folder_hash, folder, get_context_files(folder))
+
+    return folder_hash.hexdigest()
+
+
+def get_context_files(context: str) -> List[str]:
+    """Lists (in sorted order) the files that would be sent as part of a build context, relative to the context."""
+    patterns = read_dockerignore(context)
+    has_exceptions = any(is_exception for _, is_exception in patterns)
+    context_files = []
+
+    for root, dirs, files in os.walk(context):
+        relative_root = os.path.relpath(root, context)
+        relative_root = "" if relative_root == "." else relative_root
+
+        # If nothing can be re-included with an exception pattern, then there's no point
+        # walking into an ignored directory.
+        if not has_exceptions:
+            dirs[:] = [d for d in dirs if not is_ignored(_join_path(relative_root, d), patterns)]
+
+        for file_name in files:
+            relative_path = _join_path(relative_root, file_name)
+            full_path = os.path.join(root, file_name)
+
+            if os.path.isfile(full_path) and not is_ignored(relative_path, patterns):
+                context_files.append(relative_path)
+
+    return sorted(context_files)
+
+
+def read_dockerignore(context: str) -> List[IgnorePattern]:
+    dockerignore = os.path.join(context, DOCKERIGNORE)
+
+    if not os.path.isfile(dockerignore):
+        return []
+
+    with open(dockerignore, "r") as file:
+        return parse_dockerignore(file.read().split("\n"))
+
+
+def parse_dockerignore(lines: List[str]) -> List[IgnorePattern]:
+    patterns = []
+
+    for line in lines:
+        line = line.strip()
+
+        if not line or line.startswith("#"):
+            continue
+
+        is_exception = line.startswith("!")
+
+        if is_exception:
+            line = line[1:].strip()
+
+        # Docker cleans the patterns like file paths, so that e.g. '/node_modules/' matches 'node_modules'.
+        line = os.path.normpath(line).lstrip("/")
+
+        patterns.append((re.compile(_pattern_to_regex(line)), is_exception))
+
+    return patterns
+
+
+def is_ignored(relative_path: str, patterns: List[IgnorePattern]) -> bool:
+    """
+    Determines whether a path (relative to the build context) is excluded by the .dockerignore patterns.
+
+    Like Docker, the last matching pattern wins and a pattern that matches a directory
+    also matches everything inside of it.
+    """
+    ignored = False
+    path_parts = relative_path.split("/")
+
+    # Every parent directory of the path, plus the path itself.
+    candidate_paths = ["/".join(path_parts[:index]) for index in range(1, len(path_parts) + 1)]
+
+    for pattern, is_exception in patterns:
+        if any(pattern.match(path) for path in candidate_paths):
+            ignored = not is_exception
+
+    return ignored
+
+
+def _pattern_to_regex(pattern: str) -> str:
+    regex = ""
+    index = 0
+
+    while index < len(pattern):
+        char = pattern[index]
+
+        if pattern.startswith("**/", index):
+            # Matches any number of directories, including none.
+            regex += "(.*/)?"
+            index += 3
+            continue
+        elif pattern.startswith("**", index):
+            regex += ".*"
+            index += 2
+            continue
+        elif char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        else:
+            regex += re.escape(char)
+
+        index += 1
+
+    return "^{}$".format(regex)
+
+
+def _hash_files(files_hash: Any, folder: str, relative_paths: List[str]) -> None:
+    for relative_path in relative_paths:
+        full_path = os.path.join(folder, relative_path)
+        is_executable = os.access(full_path, os.X_OK)
+
+        files_hash.update("file\0{}\0{}\0".format(relative_path, int(is_executable)).encode("utf8"))
+
+        with open(full_path, "rb") as file:
+            for chunk in iter(lambda: file.read(65536), b""):
+                files_hash.update(chunk)
+
+        files_hash.update(b"\0")
+
+
+def _get_declared_args(dockerfile_content: str) -> Set[str]:
+    dockerfile = parse_dockerfile_content(dockerfile_content)
+    declared_args = set(dockerfile.global_args)
+
+    for stage in dockerfile.stages:
+        declared_args.update(stage.args)
+
+    return declared_args
+
+
+def _join_path(root: str, name: str) -> str:
+    return "{}/{}".format(root, name) if root else name
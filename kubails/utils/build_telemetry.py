@@ -0,0 +1,88 @@
+import re
+import time
+from typing import Any, Dict, List
+
+
+# BuildKit's plain progress output prefixes every line with the ID of the step it belongs to (e.g. "#5 ...").
+STEP_LINE_REGEX = re.compile(r"^#(\d+) (.*)$")
+STEP_DONE_REGEX = re.compile(r"^DONE (\d+(?:\.\d+)?)s$")
+
+# The number of slowest steps to include in the telemetry.
+SLOWEST_STEPS_COUNT = 5
+
+
+class BuildTelemetry:
+    """
+    Collects telemetry for a single `docker build --progress=plain` by parsing its output line by line.
+
+    For example, given the following output:
+
+        #5 [build-env 2/4] COPY package.json ./
+        #5 CACHED
+        #6 [build-env 3/4] RUN npm ci
+        #6 DONE 42.1s
+
+    step #5 is counted as cached and step #6 as executed (taking 42.1 seconds).
+    """
+
+    def __init__(self) -> None:
+        self.steps = {}  # type: Dict[str, Dict[str, Any]]
+        self.start_time = time.time()
+        self.end_time = None  # type: float
+
+    def parse_line(self, line: str) -> None:
+        match = STEP_LINE_REGEX.match(line.strip())
+
+        if not match:
+            return
+
+        step_id, content = match.groups()
+        step = self.steps.setdefault(step_id, {"name": "", "cached": False, "duration": None, "error": False})
+
+        if content.startswith("[") and not step["name"]:
+            step["name"] = content
+        elif content == "CACHED":
+            step["cached"] = True
+        elif content.startswith("ERROR"):
+            step["error"] = True
+        else:
+            done_match = STEP_DONE_REGEX.match(content)
+
+            if done_match:
+                step["duration"] = float(done_match.group(1))
+
+    def finish(self) -> None:
+        self.end_time = time.time()
+
+    def summary(self) -> Dict[str, Any]:
+        # Only count the steps from the Dockerfile; not the internal ones like loading the build context.
+        dockerfile_steps = [
+            step for step in self.steps.values() if step["name"] and not step["name"].startswith("[internal]")
+        ]
+
+        executed_steps = [step for step in dockerfile_steps if not step["cached"]]
+        slowest_steps = sorted(
+            [step for step in executed_steps if step["duration"] is not None],
+            key=lambda step: step["duration"],
+            reverse=True
+        )[:SLOWEST_STEPS_COUNT]
+
+        end_time = self.end_time if self.end_time is not None else time.time()
+
+        return {
+            "duration": round(end_time - self.start_time, 2),
+            "cached_steps": len(dockerfile_steps) - len(executed_steps),
+            "executed_steps": len(executed_steps),
+            "failed_steps": [step["name"] for step in dockerfile_steps if step["error"]],
+            "slowest_steps": [{"name": step["name"], "duration": step["duration"]} for step in slowest_steps]
+        }
+
+
+def summarize_steps(stage_summaries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combines the telemetry summaries of each stage of a service's build into a summary for the whole service."""
+    return {
+        "duration": round(sum(stage["duration"] for stage in stage_summaries), 2),
+        "cached_steps": sum(stage["cached_steps"] for stage in stage_summaries),
+        "executed_steps": sum(stage["executed_steps"] for stage in stage_summaries),
+        "stages": stage_summaries
+    }
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+# The volume that Cloud Build mounts into every step of a build.
+CLOUD_BUILD_FOLDER = "/workspace"
+
+# Where the cache is kept, relative to the Cloud Build workspace or the home folder.
+CACHE_FOLDER = os.path.join(".kubails", "cache")
+
+# A folder that acts as a bucket, i.e. shared between builds (e.g. a Cloud Storage bucket mounted with gcsfuse,
+# or just a local folder standing in for one).
+CACHE_BUCKET_ENV_VARIABLE = "KUBAILS_CACHE_BUCKET"
+
+# Type variable for Cache.get_or_compute()
+ValueType = TypeVar("ValueType")
+
+
+class DirectoryBackend:
+    """
+    Stores each cache record as its own JSON file under `<folder>/<namespace>/<key>.json`,
+    so that concurrent writers (e.g. services being tested at the same time) never touch the same file.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+
+    def get(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._get_record_path(namespace, key), "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            # A missing or corrupt record is just a cache miss.
+            return None
+
+    def put(self, namespace: str, key: str, record: Dict[str, Any]) -> None:
+        namespace_folder = os.path.join(self.folder, namespace)
+        os.makedirs(namespace_folder, exist_ok=True)
+
+        # Write to a temporary file first and then move it into place, so that a reader never sees half a record.
+        file_descriptor, temp_path = tempfile.mkstemp(dir=namespace_folder, suffix=".tmp")
+
+        with os.fdopen(file_descriptor, "w") as file:
+            json.dump(record, file, sort_keys=True)
+
+        os.replace(temp_path, self._get_record_path(namespace, key))
+
+    def delete(self, namespace: str, key: str) -> None:
+        try:
+            os.remove(self._get_record_path(namespace, key))
+        except FileNotFoundError:
+            pass
+
+    def _get_record_path(self, namespace: str, key: str) -> str:
+        return os.path.join(self.folder, namespace, "{}.json".format(key))
+
+
+def get_workspace_backends() -> List[DirectoryBackend]:
+    """The backend for things that only hold for a single build (i.e. the Cloud Build workspace, if there is one)."""
+    if os.path.isdir(CLOUD_BUILD_FOLDER):
+        return [DirectoryBackend(os.path.join(CLOUD_BUILD_FOLDER, CACHE_FOLDER))]
+
+    return []
+
+
+def get_default_backends() -> List[DirectoryBackend]:
+    """
+    The backends for things that hold across builds: the Cloud Build workspace (or, when not running in Cloud Build,
+    the home folder, so that the cache is shared between projects), followed by the bucket (if there is one).
+    """
+    backends = get_workspace_backends() or [DirectoryBackend(os.path.join(os.path.expanduser("~"), CACHE_FOLDER))]
+
+    if os.environ.get(CACHE_BUCKET_ENV_VARIABLE):
+        backends.append(DirectoryBackend(os.environ[CACHE_BUCKET_ENV_VARIABLE]))
+
+    return backends
+
+
+def hash_inputs(*inputs: Any) -> str:
+    """Derives a cache key from (JSON serializable) inputs, e.g. a branch, a commit, and a hash of the config."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf8")).hexdigest()
+
+
+class Cache:
+    """
+    A namespaced cache of JSON values, keyed by whatever inputs produced them.
+
+    Values are read from the first backend that has them (and copied into the backends before it,
+    so that e.g. a value from the bucket only has to be read from there once per build)
+    and are written to every backend.
+    """
+
+    def __init__(self, namespace: str, backends: List[DirectoryBackend] = None, ttl: float = None) -> None:
+        """
+        :param namespace: Keeps the keys of different kinds of values apart.
+        :param backends: Where the values are stored, in order of preference; defaults to get_default_backends().
+        :param ttl: How long (in seconds) a value is valid for; values don't expire by default.
+        """
+        self.namespace = namespace
+        self.backends = backends if backends is not None else get_default_backends()
+        self.ttl = ttl
+
+    def get(self, *inputs: Any) -> Optional[Any]:
+        """:return: The value for the inputs, or None if there isn't one (or it has expired)."""
+        record = self._get_record(hash_inputs(*inputs))
+        return record["value"] if record else None
+
+    def set(self, value: Any, *inputs: Any) -> None:
+        created_at = time.time()
+
+        record = {
+            "value": value,
+            "created_at": created_at,
+            "expires_at": created_at + self.ttl if self.ttl is not None else None
+        }
+
+        self._put_record(hash_inputs(*inputs), record)
+
+    def delete(self, *inputs: Any) -> None:
+        """Invalidates the value for the inputs (e.g. when whatever it was computed from has changed)."""
+        key = hash_inputs(*inputs)
+
+        for backend in self.backends:
+            try:
+                backend.delete(self.namespace, key)
+            except OSError as e:
+                logger.debug("Couldn't delete from the cache in {}: {}".format(backend.folder, e))
+
+    def get_or_compute(self, callback: Callable[[], ValueType], *inputs: Any) -> ValueType:
+        key = hash_inputs(*inputs)
+        record = self._get_record(key)
+
+        if record:
+            logger.debug("Cache hit for {}: {}".format(self.namespace, record["value"]))
+            return record["value"]
+
+        value = callback()
+        self.set(value, *inputs)
+
+        return value
+
+    def _get_record(self, key: str) -> Optional[Dict[str, Any]]:
+        for index, backend in enumerate(self.backends):
+            record = backend.get(self.namespace, key)
+
+            if record is None or "value" not in record:
+                continue
+
+            if record.get("expires_at") is not None and record["expires_at"] < time.time():
+                continue
+
+            # Copy the record into the (faster) backends that didn't have it.
+            for previous_backend in self.backends[:index]:
+                self._put_record_in_backend(previous_backend, key, record)
+
+            return record
+
+        return None
+
+    def _put_record(self, key: str, record: Dict[str, Any]) -> None:
+        for backend in self.backends:
+            self._put_record_in_backend(backend, key, record)
+
+    def _put_record_in_backend(self, backend: DirectoryBackend, key: str, record: Dict[str, Any]) -> None:
+        # Not being able to write to the cache (e.g. a read-only home folder) shouldn't fail the command.
+        try:
+            backend.put(self.namespace, key, record)
+        except OSError as e:
+            logger.debug("Couldn't write to the cache in {}: {}".format(backend.folder, e))
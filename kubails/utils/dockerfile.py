@@ -0,0 +1,233 @@
+import os
+import re
+import threading
+from typing import Dict, List, Match, NamedTuple, Optional, Set, Tuple  # noqa
+
+
+# The base 'image' that means a stage starts from nothing.
+SCRATCH_IMAGE = "scratch"
+
+# Matches `$VAR`, `${VAR}`, `${VAR:-default}` and `${VAR:+alternative}`.
+ARG_REFERENCE_REGEX = re.compile(r"\$(?:\{([A-Za-z_][A-Za-z0-9_]*)(?::([-+])([^}]*))?\}|([A-Za-z_][A-Za-z0-9_]*))")
+FROM_FLAG_REGEX = re.compile(r"--from=(\S+)")
+
+Stage = NamedTuple("Stage", [
+    ("index", int),
+    ("name", str),
+    ("base", str),
+    ("platform", str),
+    # Everything that the stage copies or mounts files from (i.e. other stages or external images).
+    ("dependencies", List[str]),
+    # The ARGs declared within the stage, with their default values.
+    ("args", Dict[str, str])
+])
+
+# Parsed Dockerfiles, keyed by path. Each entry also stores the file's mtime, so that edits get re-parsed.
+_parse_cache = {}  # type: Dict[str, Tuple[float, Dockerfile]]
+_parse_cache_lock = threading.Lock()
+
+
+class Dockerfile:
+    """
+    A (minimal) parsed representation of a Dockerfile: its global ARGs and its stages.
+
+    This only understands enough of the Dockerfile syntax to work out which images a build needs:
+    line continuations, comments, ARG defaults (and substitution), `FROM [--platform=...] image [AS name]`,
+    `COPY --from=...` and `RUN --mount=...,from=...`.
+    """
+
+    def __init__(self, global_args: Dict[str, str], stages: List[Stage]) -> None:
+        self.global_args = global_args
+        self.stages = stages
+
+    @property
+    def stage_names(self) -> List[str]:
+        return [stage.name for stage in self.stages if stage.name]
+
+    def get_external_images(self, build_args: Dict[str, str] = {}, target_stage: str = None) -> List[str]:
+        """
+        Determines the minimal set of external images that building the target stage needs
+        (i.e. not stage aliases and not 'scratch'), with all ARG references resolved.
+
+        :param build_args: The build args passed to the build; these override the ARG defaults.
+        :param target_stage: The stage to build; defaults to the last stage.
+
+        :return: The sorted list of external images.
+        """
+        if not self.stages:
+            return []
+
+        args = dict(self.global_args)
+        args.update({key: value for key, value in build_args.items() if key in self.global_args})
+
+        stages_by_name = {stage.name: stage for stage in self.stages if stage.name}
+        stages_by_index = {str(stage.index): stage for stage in self.stages}
+
+        target = stages_by_name.get(target_stage.lower()) if target_stage else self.stages[-1]
+
+        if target is None:
+            raise ValueError("Stage '{}' doesn't exist in the Dockerfile.".format(target_stage))
+
+        images = set()  # type: Set[str]
+        visited = set()  # type: Set[int]
+        stages_to_visit = [target]
+
+        while stages_to_visit:
+            stage = stages_to_visit.pop()
+
+            if stage.index in visited:
+                continue
+
+            visited.add(stage.index)
+
+            stage_args = dict(stage.args)
+            stage_args.update({key: value for key, value in build_args.items() if key in stage.args})
+
+            base = _substitute_args(stage.base, args)
+            dependencies = [_substitute_args(dependency, dict(args, **stage_args)) for dependency in stage.dependencies]
+
+            for reference in [base] + dependencies:
+                # A stage can only refer to stages that come before it.
+                referenced_stage = stages_by_name.get(reference.lower()) or stages_by_index.get(reference)
+
+                if referenced_stage is not None and referenced_stage.index < stage.index:
+                    stages_to_visit.append(referenced_stage)
+                elif reference and reference.lower() != SCRATCH_IMAGE:
+                    images.add(reference)
+
+        return sorted(images)
+
+
+def parse_dockerfile(path: str) -> Dockerfile:
+    """
+    Parses a Dockerfile, re-using the previous result if the file hasn't been modified since it was last parsed.
+    """
+    mtime = os.path.getmtime(path)
+
+    with _parse_cache_lock:
+        cached = _parse_cache.get(path)
+
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    with open(path, "r") as file:
+        dockerfile = parse_dockerfile_content(file.read())
+
+    with _parse_cache_lock:
+        _parse_cache[path] = (mtime, dockerfile)
+
+    return dockerfile
+
+
+def parse_dockerfile_content(content: str) -> Dockerfile:
+    global_args = {}  # type: Dict[str, str]
+    stages = []  # type: List[Stage]
+
+    for instruction, arguments in _get_instructions(content):
+        if instruction == "FROM":
+            platform, base, name = _parse_from(arguments)
+            stages.append(Stage(len(stages), name, base, platform, [], {}))
+        elif instruction == "ARG":
+            # ARGs before the first FROM are global (i.e. usable in FROM lines); the rest belong to their stage.
+            # A stage ARG without a default inherits the global ARG's value.
+            args = global_args if not stages else stages[-1].args
+
+            for key, value in _parse_args(arguments):
+                args[key] = value if value is not None else global_args.get(key, "")
+        elif stages and instruction in ("COPY", "ADD", "RUN"):
+            stages[-1].dependencies.extend(_parse_dependencies(instruction, arguments))
+
+    return Dockerfile(global_args, stages)
+
+
+def _get_instructions(content: str) -> List[Tuple[str, str]]:
+    """Splits a Dockerfile into (INSTRUCTION, arguments) pairs, joining line continuations and dropping comments."""
+    instructions = []
+    current_line = ""
+
+    for line in content.split("\n"):
+        stripped_line = line.strip()
+
+        # Comments (and blank lines) can even appear in the middle of a continued instruction.
+        if not stripped_line or stripped_line.startswith("#"):
+            continue
+
+        if stripped_line.endswith("\\"):
+            current_line += stripped_line[:-1] + " "
+            continue
+
+        current_line += stripped_line
+        parts = current_line.split(None, 1)
+        instructions.append((parts[0].upper(), parts[1] if len(parts) > 1 else ""))
+        current_line = ""
+
+    return instructions
+
+
+def _parse_from(arguments: str) -> Tuple[str, str, str]:
+    platform = ""
+    parts = arguments.split()
+
+    while parts and parts[0].startswith("--"):
+        flag = parts.pop(0)
+
+        if flag.startswith("--platform="):
+            platform = flag[len("--platform="):]
+
+    base = parts[0] if parts else ""
+    name = parts[2].lower() if len(parts) >= 3 and parts[1].lower() == "as" else ""
+
+    return platform, base, name
+
+
+def _parse_args(arguments: str) -> List[Tuple[str, Optional[str]]]:
+    """Parses the arguments of an ARG instruction; ARGs without a default have a value of None."""
+    args = []  # type: List[Tuple[str, Optional[str]]]
+
+    for arg in arguments.split():
+        key, has_default, value = arg.partition("=")
+        args.append((key, value.strip("\"'") if has_default else None))
+
+    return args
+
+
+def _parse_dependencies(instruction: str, arguments: str) -> List[str]:
+    flags = []
+
+    for part in arguments.split():
+        if not part.startswith("--"):
+            break
+
+        flags.append(part)
+
+    dependencies = []
+
+    for flag in flags:
+        if instruction in ("COPY", "ADD"):
+            match = FROM_FLAG_REGEX.match(flag)
+
+            if match:
+                dependencies.append(match.group(1))
+        elif flag.startswith("--mount="):
+            # e.g. `RUN --mount=type=cache,from=build-env,target=/root/.npm`
+            options = dict(option.partition("=")[::2] for option in flag[len("--mount="):].split(","))
+
+            if options.get("from"):
+                dependencies.append(options["from"])
+
+    return dependencies
+
+
+def _substitute_args(value: str, args: Dict[str, str]) -> str:
+    def substitute(match: Match) -> str:
+        name, modifier, word, bare_name = match.groups()
+        arg_value = args.get(name or bare_name, "")
+
+        if modifier == "-":
+            return arg_value if arg_value else word
+        elif modifier == "+":
+            return word if arg_value else ""
+
+        return arg_value
+
+    return ARG_REFERENCE_REGEX.sub(substitute, value)
@@ -0,0 +1,89 @@
+import re
+from typing import Any, Dict, List, Union
+
+
+# The number of largest layers to include in an image's size report.
+LARGEST_LAYERS_COUNT = 5
+
+SIZE_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?i?B?)\s*$", re.IGNORECASE)
+
+# Like Docker, sizes use decimal units (i.e. 1MB is 1000KB).
+SIZE_UNITS = {"": 1, "K": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4}
+BINARY_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(size: Union[int, str]) -> int:
+    """
+    Parses a size (e.g. "500MB", "1.5GB", "200MiB", or a plain number of bytes) into a number of bytes.
+
+    :raises ValueError: When the size can't be parsed.
+    """
+    if isinstance(size, int):
+        return size
+
+    match = SIZE_REGEX.match(size)
+
+    if not match:
+        raise ValueError("Invalid size: '{}'".format(size))
+
+    value, unit = match.groups()
+    unit = unit.upper()
+    units = BINARY_SIZE_UNITS if "I" in unit else SIZE_UNITS
+
+    return int(float(value) * units[unit.rstrip("IB")])
+
+
+def format_size(size: int) -> str:
+    for unit in ["GB", "MB", "kB"]:
+        unit_size = SIZE_UNITS[unit[0].upper()]
+
+        if size >= unit_size:
+            return "{:.1f}{}".format(size / unit_size, unit)
+
+    return "{}B".format(size)
+
+
+def summarize_image(size: int, layers: List[str], history: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Summarizes the size of an image.
+
+    :param size: The size of the image, in bytes.
+    :param layers: The IDs of the image's layers.
+    :param history: The image's history (i.e. the size and created_by of each instruction).
+
+    :return: The image's size, layer count, and largest layers.
+    """
+    # Instructions like ENV or WORKDIR show up in the history, but don't create any (non-empty) layers.
+    largest_layers = sorted(
+        [entry for entry in history if entry["size"] > 0],
+        key=lambda entry: entry["size"],
+        reverse=True
+    )[:LARGEST_LAYERS_COUNT]
+
+    return {
+        "size": size,
+        "layers": len(layers),
+        "largest_layers": largest_layers
+    }
+
+
+def get_budget_violations(summary: Dict[str, Any], budget: Dict[str, Any]) -> List[str]:
+    """
+    Compares an image's size summary to a budget, returning a message for each way that the image is over budget.
+
+    :param budget: The `max_size` (in bytes, or a size like "500MB") and/or `max_layers` of the image.
+    """
+    violations = []
+
+    if budget.get("max_size") is not None:
+        max_size = parse_size(budget["max_size"])
+
+        if summary["size"] > max_size:
+            violations.append("size {} is over the budget of {}".format(
+                format_size(summary["size"]), format_size(max_size)
+            ))
+
+    if budget.get("max_layers") is not None and summary["layers"] > budget["max_layers"]:
+        violations.append("{} layers is over the budget of {} layers".format(summary["layers"], budget["max_layers"]))
+
+    return violations
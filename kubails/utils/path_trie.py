@@ -0,0 +1,42 @@
+import posixpath
+from typing import Any, Dict, List  # noqa
+
+
+class PathTrie:
+    """
+    A trie of folder paths (split into their components), used to quickly find every folder
+    that contains a given path.
+
+    For example, after inserting 'services/frontend' and 'services/frontend/admin',
+    'services/frontend/admin/index.js' is in both folders, while 'services/backend/app.py' is in neither.
+    """
+
+    def __init__(self) -> None:
+        self.root = {"children": {}, "values": []}  # type: Dict[str, Any]
+
+    def insert(self, folder: str, value: Any) -> None:
+        node = self.root
+
+        for part in self._split_path(folder):
+            node = node["children"].setdefault(part, {"children": {}, "values": []})
+
+        node["values"].append(value)
+
+    def find_containing(self, path: str) -> List[Any]:
+        """Finds the values of every folder that contains the path (or that is the path itself)."""
+        node = self.root
+        values = list(node["values"])
+
+        for part in self._split_path(path):
+            node = node["children"].get(part)
+
+            if node is None:
+                break
+
+            values.extend(node["values"])
+
+        return values
+
+    def _split_path(self, path: str) -> List[str]:
+        normalized_path = posixpath.normpath(path.replace("\\", "/")).strip("/")
+        return [part for part in normalized_path.split("/") if part and part != "."]
@@ -4,7 +4,8 @@ import logging
 import os
 import shlex
 import subprocess
-from typing import Callable, Dict, List, Sequence, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Sequence, Tuple, TypeVar, Union
 
 
 logger = logging.getLogger(__name__)
@@ -15,6 +16,10 @@ OptionValueType = Union[str, bool, Sequence[str]]
 OptionsType = List[Tuple[OptionKeyType, OptionValueType]]
 OptionsMapType = Dict[OptionKeyType, Callable[[OptionValueType], str]]
 
+# Type variables for run_concurrently()
+ItemType = TypeVar("ItemType")
+ResultType = TypeVar("ResultType")
+
 STDERR_INTO_OUTPUT = "STDERR_INTO_OUTPUT"
 STDERR_SUPPRESS = "STDERR_SUPPRESS"
 STDERR_DISPLAY = "STDERR_DISPLAY"
@@ -50,7 +55,7 @@ def get_command_output(
         # out is a utf-8 encoded byte string that must be converted to a literal string for use
         # rstrip() takes off the seemingly always present \n that's at the end of the result
         # strip("'") removes the single quotes that surround the result
-        cleaned_out = out.decode("utf8").rstrip().strip("'")
+        cleaned_out = out.decode("utf8", errors="replace").rstrip().strip("'")
         logger.debug("Command output: " + cleaned_out)
 
         if cleaned_out == "null":  # Some of the docker commands like to return literal "null"
@@ -58,7 +63,7 @@ def get_command_output(
         else:
             return cleaned_out
     except subprocess.CalledProcessError as e:  # Return code was 1 or some other error code
-        out = e.output.decode("utf8").rstrip()
+        out = e.output.decode("utf8", errors="replace").rstrip()
 
         logger.debug(
             "Exception occured while trying to get command output: {}"
@@ -91,6 +96,108 @@ def call_command(command: List[str], shell: bool = False, **kwargs) -> bool:
     return not bool(exit_code)
 
 
+def stream_command(command: List[str], line_callback: Callable[[str], None], shell: bool = False, **kwargs) -> bool:
+    """
+    Calls a command like call_command, but also passes each line of its output (stdout and stderr)
+    to a callback as the command runs. The output is still printed as it comes in.
+
+    :param command: The command (in list form) to call
+    :param line_callback: The function to call with each line of output
+    :param shell: Whether or not to run the command using a system shell
+    :param kwargs: Extra args to be passed to subprocess.Popen; see its docs for options
+
+    :return: Whether or not the command was successful
+    """
+    log_command(command)
+
+    process = subprocess.Popen(
+        _format_command(command, shell),
+        shell=shell,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        **kwargs
+    )
+
+    for raw_line in process.stdout:  # type: ignore
+        # Commands (e.g. builds) can output anything, so don't let a stray non-UTF-8 byte crash the whole command.
+        line = raw_line.decode("utf8", errors="replace")
+
+        print(line, end="", flush=True)
+        line_callback(line.rstrip("\r\n"))
+
+    exit_code = process.wait()
+    logger.debug("Command exit code: {}".format(exit_code))
+
+    return not bool(exit_code)
+
+
+def capture_command(command: List[str], shell: bool = False, **kwargs) -> Tuple[bool, str]:
+    """
+    Calls a command like call_command, but captures its output (stdout and stderr, interleaved)
+    instead of printing it, so that the output of concurrent commands doesn't get mixed together.
+
+    :param command: The command (in list form) to call
+    :param shell: Whether or not to run the command using a system shell
+    :param kwargs: Extra args to be passed to subprocess.run; see its docs for options
+
+    :return: Whether or not the command was successful, and its output
+    """
+    log_command(command)
+
+    completed_process = subprocess.run(
+        _format_command(command, shell),
+        shell=shell,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        **kwargs
+    )
+
+    logger.debug("Command exit code: {}".format(completed_process.returncode))
+
+    return not bool(completed_process.returncode), completed_process.stdout.decode("utf8", errors="replace")
+
+
+def run_concurrently(
+    function: Callable[[ItemType], ResultType],
+    items: Sequence[ItemType],
+    jobs: int = 1
+) -> Dict[ItemType, ResultType]:
+    """
+    Runs a function with each of the items using a pool of (at most) `jobs` threads.
+
+    Since the functions we run this way spend all of their time waiting on external commands,
+    threads are good enough; the GIL isn't a concern.
+
+    :param function: The function to call with each item.
+    :param items: The items to call the function with.
+    :param jobs: The maximum number of function calls to run at once.
+
+    :return: A map of each item to its result, in the same order as the given items.
+
+    :raises: The first exception raised by any of the function calls, but only once every call has finished;
+             the exceptions of the other calls are logged, so that one failure doesn't hide the others.
+    """
+    results = {}  # type: Dict[ItemType, ResultType]
+    exceptions = []  # type: List[Exception]
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [(item, executor.submit(function, item)) for item in items]
+
+        for item, future in futures:
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                if exceptions:
+                    logger.error("Error while running {}: {}".format(item, e))
+
+                exceptions.append(e)
+
+    if exceptions:
+        raise exceptions[0]
+
+    return results
+
+
 def log_command(command: List[str]) -> None:
     """Logs the given command."""
     logger.debug("Command: " + " ".join(command))
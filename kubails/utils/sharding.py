@@ -0,0 +1,49 @@
+import re
+from typing import Dict, List, Tuple
+
+
+SHARD_REGEX = re.compile(r"^(\d+)/(\d+)$")
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parses a shard like "2/4" (i.e. the second of four shards) into its (1-based) index and the shard count.
+
+    :raises ValueError: When the shard isn't of the form "i/N", with 1 <= i <= N.
+    """
+    match = SHARD_REGEX.match(shard.strip())
+
+    if not match:
+        raise ValueError("Invalid shard '{}'; expected something like '1/4'.".format(shard))
+
+    index, count = int(match.group(1)), int(match.group(2))
+
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard '{}'; the index must be between 1 and {}.".format(shard, count))
+
+    return index, count
+
+
+def shard_by_duration(durations: Dict[str, float], shard_count: int) -> List[List[str]]:
+    """
+    Splits items into shards with (roughly) equal total durations, using the longest-processing-time-first
+    heuristic: the longest items are placed first, each into the shard with the lowest total so far.
+
+    The result is deterministic (ties are broken by name and then by shard index), which is important since
+    every shard computes the split independently and they all need to agree on it.
+
+    :param durations: The (expected) duration of each item.
+    :param shard_count: The number of shards to split the items into.
+
+    :return: The items in each shard.
+    """
+    shards = [[] for _ in range(shard_count)]  # type: List[List[str]]
+    totals = [0.0] * shard_count
+
+    for item in sorted(durations, key=lambda item: (-durations[item], item)):
+        shard_index = min(range(shard_count), key=lambda index: (totals[index], index))
+
+        shards[shard_index].append(item)
+        totals[shard_index] += durations[item]
+
+    return shards
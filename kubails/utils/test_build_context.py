@@ -0,0 +1,90 @@
+import os
+import tempfile
+from parameterized import parameterized
+from unittest import TestCase
+from . import build_context
+
+
+class TestBuildContext(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.context = self.temp_dir.name
+
+        self._write_file("Dockerfile", "FROM node:14\nARG branch\nCOPY . .\n")
+        self._write_file(".dockerignore", "node_modules\n*.log\n")
+        self._write_file("src/app.js", "console.log('hello');\n")
+        self._write_file("node_modules/lib/index.js", "module.exports = {};\n")
+        self._write_file("debug.log", "some logs\n")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @parameterized.expand([
+        # Plain names match at the root of the context, as well as everything inside of them.
+        [["node_modules"], "node_modules", True],
+        [["node_modules"], "node_modules/lib/index.js", True],
+        [["node_modules"], "src/node_modules", False],
+
+        # Single stars don't cross directories, but double stars do.
+        [["*.log"], "debug.log", True],
+        [["*.log"], "logs/debug.log", False],
+        [["**/*.log"], "logs/debug.log", True],
+
+        # Leading and trailing slashes are cleaned up.
+        [["/build/"], "build/index.js", True],
+
+        # Exceptions re-include paths, and the last matching pattern wins.
+        [["*.md", "!README.md"], "README.md", False],
+        [["*.md", "!README.md"], "CHANGELOG.md", True],
+        [["!README.md", "*.md"], "README.md", True],
+    ])
+    def test_can_check_ignored_paths(self, lines, path, expected):
+        patterns = build_context.parse_dockerignore(lines)
+        self.assertEqual(build_context.is_ignored(path, patterns), expected)
+
+    def test_context_files_honour_dockerignore(self):
+        files = build_context.get_context_files(self.context)
+        self.assertEqual(files, [".dockerignore", "Dockerfile", "src/app.js"])
+
+    def test_hash_is_deterministic(self):
+        first_hash = build_context.hash_build_context(self.context, {"branch": "master"})
+        second_hash = build_context.hash_build_context(self.context, {"branch": "master"})
+
+        self.assertEqual(first_hash, second_hash)
+
+    def test_hash_ignores_excluded_files(self):
+        original_hash = build_context.hash_build_context(self.context)
+        self._write_file("node_modules/lib/other.js", "module.exports = 1;\n")
+
+        self.assertEqual(build_context.hash_build_context(self.context), original_hash)
+
+    def test_hash_changes_with_context_files(self):
+        original_hash = build_context.hash_build_context(self.context)
+        self._write_file("src/app.js", "console.log('goodbye');\n")
+
+        self.assertNotEqual(build_context.hash_build_context(self.context), original_hash)
+
+    def test_hash_only_uses_declared_build_args(self):
+        master_hash = build_context.hash_build_context(self.context, {"branch": "master", "other": "a"})
+        feature_hash = build_context.hash_build_context(self.context, {"branch": "feature"})
+        other_hash = build_context.hash_build_context(self.context, {"branch": "master", "other": "b"})
+
+        self.assertNotEqual(feature_hash, master_hash)
+        self.assertEqual(other_hash, master_hash)
+
+    def test_folders_without_a_dockerfile_can_be_hashed(self):
+        os.remove(os.path.join(self.context, "Dockerfile"))
+
+        original_hash = build_context.hash_folder(self.context)
+        self._write_file("node_modules/lib/other.js", "module.exports = 1;\n")
+        self.assertEqual(build_context.hash_folder(self.context), original_hash)
+
+        self._write_file("src/app.js", "console.log('goodbye');\n")
+        self.assertNotEqual(build_context.hash_folder(self.context), original_hash)
+
+    def _write_file(self, relative_path, content):
+        path = os.path.join(self.context, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "w") as file:
+            file.write(content)
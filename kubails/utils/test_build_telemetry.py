@@ -0,0 +1,50 @@
+from unittest import TestCase
+from . import build_telemetry
+
+
+BUILD_OUTPUT = """
+#1 [internal] load build definition from Dockerfile
+#1 DONE 0.1s
+#2 [build-env 1/4] FROM docker.io/library/node:14
+#2 CACHED
+#3 [build-env 2/4] COPY package.json ./
+#3 CACHED
+#4 [build-env 3/4] RUN npm ci
+#4 0.512 added 1000 packages
+#4 DONE 42.1s
+#5 [build-env 4/4] RUN npm run build
+#5 DONE 12.5s
+#6 exporting to image
+#6 DONE 1.0s
+"""
+
+
+class TestBuildTelemetry(TestCase):
+    def setUp(self):
+        self.telemetry = build_telemetry.BuildTelemetry()
+
+        for line in BUILD_OUTPUT.split("\n"):
+            self.telemetry.parse_line(line)
+
+        self.telemetry.finish()
+
+    def test_can_count_cached_and_executed_steps(self):
+        summary = self.telemetry.summary()
+
+        self.assertEqual(summary["cached_steps"], 2)
+        self.assertEqual(summary["executed_steps"], 2)
+        self.assertEqual(summary["failed_steps"], [])
+
+    def test_can_find_slowest_steps(self):
+        summary = self.telemetry.summary()
+
+        self.assertEqual(summary["slowest_steps"], [
+            {"name": "[build-env 3/4] RUN npm ci", "duration": 42.1},
+            {"name": "[build-env 4/4] RUN npm run build", "duration": 12.5}
+        ])
+
+    def test_can_find_failed_steps(self):
+        self.telemetry.parse_line("#7 [stage 1/1] RUN exit 1")
+        self.telemetry.parse_line("#7 ERROR: process \"/bin/sh -c exit 1\" did not complete successfully")
+
+        self.assertEqual(self.telemetry.summary()["failed_steps"], ["[stage 1/1] RUN exit 1"])
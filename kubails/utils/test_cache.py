@@ -0,0 +1,84 @@
+import os
+import tempfile
+from unittest import mock, TestCase
+from . import cache
+
+
+class TestCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+        self.workspace = cache.DirectoryBackend(os.path.join(self.temp_dir.name, "workspace"))
+        self.bucket = cache.DirectoryBackend(os.path.join(self.temp_dir.name, "bucket"))
+
+        self.cache = cache.Cache("things", backends=[self.workspace, self.bucket])
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_missing_values_are_cache_misses(self):
+        self.assertIsNone(self.cache.get("master", "abc123"))
+
+    def test_can_set_and_get_json_values(self):
+        self.cache.set({"services": ["frontend", "backend"], "changed": True}, "master", "abc123")
+
+        self.assertEqual(self.cache.get("master", "abc123"), {"services": ["frontend", "backend"], "changed": True})
+        self.assertIsNone(self.cache.get("master", "def456"))
+
+    def test_can_delete_values(self):
+        self.cache.set("value", "key")
+        self.cache.delete("key")
+        self.cache.delete("missing")
+
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_keys_are_namespaced(self):
+        self.cache.set(True, "master")
+        other_cache = cache.Cache("other", backends=[self.workspace, self.bucket])
+
+        self.assertIsNone(other_cache.get("master"))
+
+    def test_values_expire_after_their_ttl(self):
+        expiring_cache = cache.Cache("things", backends=[self.workspace], ttl=60)
+
+        with mock.patch("time.time", return_value=1000):
+            expiring_cache.set("value", "key")
+
+        with mock.patch("time.time", return_value=1059):
+            self.assertEqual(expiring_cache.get("key"), "value")
+
+        with mock.patch("time.time", return_value=1061):
+            self.assertIsNone(expiring_cache.get("key"))
+
+    def test_values_are_only_computed_once(self):
+        callback = mock.Mock(return_value=["frontend"])
+
+        self.assertEqual(self.cache.get_or_compute(callback, "master"), ["frontend"])
+        self.assertEqual(self.cache.get_or_compute(callback, "master"), ["frontend"])
+        self.assertEqual(callback.call_count, 1)
+
+    def test_values_from_later_backends_are_copied_to_earlier_backends(self):
+        cache.Cache("things", backends=[self.bucket]).set(42.0, "durations")
+        self.assertIsNone(cache.Cache("things", backends=[self.workspace]).get("durations"))
+
+        self.assertEqual(self.cache.get("durations"), 42.0)
+        self.assertEqual(cache.Cache("things", backends=[self.workspace]).get("durations"), 42.0)
+
+    def test_corrupt_records_are_cache_misses(self):
+        self.cache.set("value", "key")
+
+        for folder in ["workspace", "bucket"]:
+            record_path = os.path.join(self.temp_dir.name, folder, "things", cache.hash_inputs("key") + ".json")
+
+            with open(record_path, "w") as file:
+                file.write("{not json")
+
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_default_backends_include_the_bucket(self):
+        bucket_folder = os.path.join(self.temp_dir.name, "bucket")
+
+        with mock.patch.dict(os.environ, {cache.CACHE_BUCKET_ENV_VARIABLE: bucket_folder}):
+            backends = cache.get_default_backends()
+
+        self.assertEqual(backends[-1].folder, bucket_folder)
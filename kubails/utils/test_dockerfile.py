@@ -0,0 +1,94 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+from . import dockerfile
+
+
+MULTI_STAGE_DOCKERFILE = """
+# syntax=docker/dockerfile:1
+ARG NODE_VERSION=14
+ARG REGISTRY
+
+FROM --platform=$BUILDPLATFORM node:${NODE_VERSION} AS build-env
+ARG branch
+WORKDIR /app
+COPY package.json \\
+    # Comments can appear in the middle of continued lines.
+    package-lock.json ./
+RUN --mount=type=cache,target=/root/.npm npm ci
+
+FROM build-env AS test
+RUN npm test
+
+FROM ${REGISTRY:-gcr.io}/distroless/nodejs AS release
+COPY --from=build-env /app /app
+COPY --from=nginx:alpine /etc/nginx/nginx.conf /etc/nginx/nginx.conf
+
+FROM scratch AS export
+COPY --from=release /app /
+"""
+
+
+class TestDockerfile(TestCase):
+    def setUp(self):
+        self.dockerfile = dockerfile.parse_dockerfile_content(MULTI_STAGE_DOCKERFILE)
+
+    def test_can_parse_stages(self):
+        self.assertEqual(self.dockerfile.stage_names, ["build-env", "test", "release", "export"])
+        self.assertEqual(self.dockerfile.global_args, {"NODE_VERSION": "14", "REGISTRY": ""})
+        self.assertEqual(self.dockerfile.stages[0].platform, "$BUILDPLATFORM")
+        self.assertEqual(self.dockerfile.stages[0].args, {"branch": ""})
+
+    def test_stage_aliases_and_scratch_are_not_external_images(self):
+        self.assertEqual(
+            self.dockerfile.get_external_images(),
+            ["gcr.io/distroless/nodejs", "nginx:alpine", "node:14"]
+        )
+
+    def test_target_stage_limits_the_external_images(self):
+        self.assertEqual(self.dockerfile.get_external_images(target_stage="test"), ["node:14"])
+        self.assertEqual(self.dockerfile.get_external_images(target_stage="build-env"), ["node:14"])
+
+    def test_build_args_override_arg_defaults(self):
+        images = self.dockerfile.get_external_images(
+            {"NODE_VERSION": "16", "REGISTRY": "eu.gcr.io", "unused": "value"},
+            "release"
+        )
+
+        self.assertEqual(images, ["eu.gcr.io/distroless/nodejs", "nginx:alpine", "node:16"])
+
+    def test_missing_target_stage_raises_error(self):
+        with self.assertRaises(ValueError):
+            self.dockerfile.get_external_images(target_stage="missing")
+
+    def test_stages_can_be_referenced_by_index(self):
+        parsed = dockerfile.parse_dockerfile_content("FROM python:3.8\nFROM alpine\nCOPY --from=0 /app /app\n")
+        self.assertEqual(parsed.get_external_images(), ["alpine", "python:3.8"])
+
+    def test_mounts_from_images_are_external_images(self):
+        parsed = dockerfile.parse_dockerfile_content(
+            "FROM alpine\nRUN --mount=type=bind,from=busybox:latest,target=/busybox ls /busybox\n"
+        )
+
+        self.assertEqual(parsed.get_external_images(), ["alpine", "busybox:latest"])
+
+    def test_parsed_dockerfiles_are_cached_until_modified(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "Dockerfile")
+            self._write_file(path, "FROM alpine\n")
+
+            first = dockerfile.parse_dockerfile(path)
+            self.assertIs(dockerfile.parse_dockerfile(path), first)
+
+            self._write_file(path, "FROM ubuntu\n")
+
+            # Make sure the mtime actually changes, regardless of the filesystem's timestamp resolution.
+            modified_time = time.time() + 10
+            os.utime(path, (modified_time, modified_time))
+
+            self.assertEqual(dockerfile.parse_dockerfile(path).get_external_images(), ["ubuntu"])
+
+    def _write_file(self, path, content):
+        with open(path, "w") as file:
+            file.write(content)
@@ -0,0 +1,57 @@
+from parameterized import parameterized
+from unittest import TestCase
+from . import image_size
+
+
+class TestImageSize(TestCase):
+    @parameterized.expand([
+        [1024, 1024],
+        ["1024", 1024],
+        ["500MB", 500 * 1000 ** 2],
+        ["1.5GB", 1500 * 1000 ** 2],
+        ["200 mb", 200 * 1000 ** 2],
+        ["200MiB", 200 * 1024 ** 2],
+        ["64k", 64 * 1000],
+    ])
+    def test_can_parse_sizes(self, size, expected):
+        self.assertEqual(image_size.parse_size(size), expected)
+
+    def test_invalid_sizes_raise_error(self):
+        with self.assertRaises(ValueError):
+            image_size.parse_size("big")
+
+    @parameterized.expand([
+        [512, "512B"],
+        [1500, "1.5kB"],
+        [123400000, "123.4MB"],
+        [2 * 1000 ** 3, "2.0GB"],
+    ])
+    def test_can_format_sizes(self, size, expected):
+        self.assertEqual(image_size.format_size(size), expected)
+
+    def test_summary_only_includes_largest_non_empty_layers(self):
+        history = [
+            {"size": 0, "created_by": "CMD [\"node\", \"index.js\"]"},
+            {"size": 300, "created_by": "COPY . ."},
+            {"size": 100, "created_by": "RUN npm ci"},
+        ] + [{"size": 10 + index, "created_by": "RUN step {}".format(index)} for index in range(5)]
+
+        summary = image_size.summarize_image(1000, ["sha256:a", "sha256:b"], history)
+
+        self.assertEqual(summary["size"], 1000)
+        self.assertEqual(summary["layers"], 2)
+        self.assertEqual(
+            [layer["created_by"] for layer in summary["largest_layers"]],
+            ["COPY . .", "RUN npm ci", "RUN step 4", "RUN step 3", "RUN step 2"]
+        )
+
+    @parameterized.expand([
+        [{}, 0],
+        [{"max_size": "1GB", "max_layers": 20}, 0],
+        [{"max_size": "100MB"}, 1],
+        [{"max_layers": 5}, 1],
+        [{"max_size": 1000, "max_layers": 5}, 2],
+    ])
+    def test_can_check_budgets(self, budget, expected_violations):
+        summary = {"size": 500 * 1000 ** 2, "layers": 10, "largest_layers": []}
+        self.assertEqual(len(image_size.get_budget_violations(summary, budget)), expected_violations)
@@ -0,0 +1,31 @@
+from parameterized import parameterized
+from unittest import TestCase
+from . import path_trie
+
+
+class TestPathTrie(TestCase):
+    def setUp(self):
+        self.trie = path_trie.PathTrie()
+
+        self.trie.insert("services/frontend", "frontend")
+        self.trie.insert("services/frontend/admin/", "admin")
+        self.trie.insert("./services/backend", "backend")
+        self.trie.insert("services/backend", "backend-worker")
+
+    @parameterized.expand([
+        ["services/frontend/src/index.js", ["frontend"]],
+        ["services/frontend/admin/index.js", ["frontend", "admin"]],
+        ["services/backend/app.py", ["backend", "backend-worker"]],
+        ["services/frontend", ["frontend"]],
+
+        # Folders only match whole path components.
+        ["services/frontend-old/index.js", []],
+        ["services/back", []],
+        ["README.md", []],
+    ])
+    def test_can_find_containing_folders(self, path, expected):
+        self.assertEqual(self.trie.find_containing(path), expected)
+
+    def test_root_folder_contains_everything(self):
+        self.trie.insert(".", "everything")
+        self.assertEqual(self.trie.find_containing("README.md"), ["everything"])
@@ -16,3 +16,40 @@ class TestServiceHelpers(TestCase):
     def test_can_sanitize_name(self, name, expected):
         result = service_helpers.sanitize_name(name)
         self.assertEqual(result, expected)
+
+    def test_run_concurrently_collects_every_result_in_order(self):
+        result = service_helpers.run_concurrently(lambda x: x % 2 == 0, [3, 2, 1, 4], jobs=2)
+
+        self.assertEqual(list(result.keys()), [3, 2, 1, 4])
+        self.assertEqual(list(result.values()), [False, True, False, True])
+
+    def test_run_concurrently_finishes_every_item_before_raising(self):
+        finished_items = []
+
+        def function(item):
+            if item < 0:
+                raise ValueError(item)
+
+            finished_items.append(item)
+            return item
+
+        with self.assertRaises(ValueError) as context:
+            service_helpers.run_concurrently(function, [-1, 1, -2, 2], jobs=2)
+
+        self.assertEqual(context.exception.args, (-1,))
+        self.assertEqual(sorted(finished_items), [1, 2])
+
+    def test_capture_command_returns_result_and_output(self):
+        result, output = service_helpers.capture_command(["echo out; echo err >&2; exit 3"], shell=True)
+
+        self.assertFalse(result)
+        self.assertEqual(output, "out\nerr\n")
+
+    def test_non_utf8_output_does_not_crash_commands(self):
+        command = ["printf 'caf\\351\\n'"]
+        lines = []
+
+        self.assertEqual(service_helpers.get_command_output(command, shell=True), "caf\ufffd")
+        self.assertEqual(service_helpers.capture_command(command, shell=True), (True, "caf\ufffd\n"))
+        self.assertTrue(service_helpers.stream_command(command, lines.append, shell=True))
+        self.assertEqual(lines, ["caf\ufffd"])
@@ -0,0 +1,43 @@
+from parameterized import parameterized
+from unittest import TestCase
+from . import sharding
+
+
+class TestSharding(TestCase):
+    @parameterized.expand([
+        ["1/1", (1, 1)],
+        ["2/4", (2, 4)],
+        [" 3/3 ", (3, 3)],
+    ])
+    def test_can_parse_shards(self, shard, expected):
+        self.assertEqual(sharding.parse_shard(shard), expected)
+
+    @parameterized.expand([
+        ["0/4"],
+        ["5/4"],
+        ["1-4"],
+        ["a/b"],
+    ])
+    def test_invalid_shards_raise_error(self, shard):
+        with self.assertRaises(ValueError):
+            sharding.parse_shard(shard)
+
+    def test_longest_items_are_spread_across_shards(self):
+        durations = {"api": 600.0, "web": 300.0, "worker": 280.0, "docs": 20.0, "backup": 15.0}
+        shards = sharding.shard_by_duration(durations, 2)
+
+        self.assertEqual(shards, [["api", "backup"], ["web", "worker", "docs"]])
+
+    def test_every_item_is_in_exactly_one_shard(self):
+        durations = {"service-{}".format(index): float(index % 4) for index in range(11)}
+        shards = sharding.shard_by_duration(durations, 3)
+
+        self.assertEqual(sorted(item for shard in shards for item in shard), sorted(durations))
+
+    def test_equal_durations_are_split_evenly_and_deterministically(self):
+        durations = {"d": 1.0, "a": 1.0, "c": 1.0, "b": 1.0}
+
+        self.assertEqual(sharding.shard_by_duration(durations, 2), [["a", "c"], ["b", "d"]])
+
+    def test_extra_shards_are_empty(self):
+        self.assertEqual(sharding.shard_by_duration({"api": 1.0}, 3), [["api"], [], []])